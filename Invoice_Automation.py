@@ -1,43 +1,71 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
-import base64
-import pandas as pd
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
+import sys
+import time
+import signal
+import hashlib
+import pathlib
+import multiprocessing
+import urllib.parse
+import urllib.request
 from datetime import datetime, timezone
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
-
-try:
-    from weasyprint import HTML as WeasyHTML, CSS as WeasyCSS
-    WEASYPRINT_AVAILABLE = True
-except ImportError:
-    WEASYPRINT_AVAILABLE = False
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from email_sender import SMTP_SERVER, SMTP_PORT, get_sender
+from mime import MessageTemplate
+from digest import DIGEST_MODE, DIGEST_ATTACH_PDFS, Digest
+from sheets import read_values, read_rows_for_dates
+from schema import INVOICES
+from records import InvoiceLine, read_records, group_by
+from templates import Template
+from dispatch import CHANNEL_LIMITS, dispatch, dispatch_one, deadline_skipped, DispatchSummary
+from resilience import deadline, timeouts
+from pipeline import Stage, run_pipeline
+from outbox import Outbox, message_key, log_outbox, run_mode
+from render_only import is_render_mode, parse_render_args, load_sheet_json, render_outbox, write_rendered
+from metrics import stage_timer, write_run_metrics
 
 # ---------------- CONFIGURATION -----------------
 SPREADSHEET_ID = "1mhTdW15u6E-jODDpXdlJjZohVU2NHbmzF2R8TZEpIls"
 RANGE_NAME = "Invoices"
+OUTBOX_JOB = "invoices"
+timer = stage_timer(OUTBOX_JOB)
 
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 465
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 
+ADMIN_EMAILS = ["alhuraibia@gmail.com", "dalmaznaee@gmail.com"]
+
+# From header, BCC list and MIME skeleton shared by every invoice email.
+# In digest mode the admins get one summary (optionally with the PDFs zipped) instead of BCC copies.
+INVOICE_MESSAGE = MessageTemplate(
+    f"New Dimension Academy <{EMAIL_USER}>",
+    bcc=[] if DIGEST_MODE else ADMIN_EMAILS,
+)
+digest = Digest(
+    OUTBOX_JOB,
+    "Invoices sent",
+    ["Invoice", "Student", "Email", "Month", "Lines", "Total"],
+    f"New Dimension Academy <{EMAIL_USER}>",
+    admins=ADMIN_EMAILS,
+)
+
 HEADER_IMAGE_URL2 = os.getenv("HEADER_IMAGE_URL2", "")
 FOOTER_IMAGE_URL  = os.getenv("FOOTER_IMAGE_URL", "")
+ASSET_CACHE_DIR   = os.getenv("ASSET_CACHE_DIR", ".asset_cache")
 
-# ---------------- SERVICE ACCOUNT -----------------
-if "SERVICE_ACCOUNT_JSON" not in os.environ:
-    raise ValueError("SERVICE_ACCOUNT_JSON environment variable is not set!")
+# PDF rendering is CPU-bound, so it runs in a process pool (one worker per core by default)
+PDF_WORKERS         = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+PDF_TIMEOUT_SECONDS = int(os.getenv("PDF_TIMEOUT_SECONDS", "120"))
 
-SERVICE_ACCOUNT_INFO = json.loads(
-    base64.b64decode(os.environ["SERVICE_ACCOUNT_JSON"]).decode("utf-8")
-)
+# compose_invoices runs group -> email HTML -> PDF -> queue -> send as overlapping
+# stages; PDF_WORKERS sets the PDF stage, these the others
+INVOICE_RENDER_WORKERS = int(os.getenv("INVOICE_RENDER_WORKERS", "1"))
+INVOICE_SEND_WORKERS   = int(os.getenv("INVOICE_SEND_WORKERS", str(CHANNEL_LIMITS["email"])))
+
+# Only parse and render invoices that are new or changed since the last run (0 = every invoice)
+INVOICE_INCREMENTAL = os.getenv("INVOICE_INCREMENTAL", "1") != "0"
 
 # ---------------- LOG FUNCTION -----------------
 def log_message(message: str):
@@ -70,6 +98,9 @@ def clean_numeric(value) -> str:
 
 # ---------------- FORMAT CURRENCY -----------------
 def fmt_currency(value) -> str:
+    # Typed sheets hand over numbers already (NaN for blank cells)
+    if isinstance(value, (int, float)):
+        return "—" if value != value else f"{value:,.2f}"
     try:
         return f"{float(clean_numeric(value)):,.2f}"
     except (ValueError, TypeError):
@@ -79,7 +110,12 @@ def fmt_currency(value) -> str:
 def safe_sum(rows, column) -> float:
     total = 0.0
     for row in rows:
-        raw = clean_numeric(row.get(column, ''))
+        value = row.get(column, '')
+        if isinstance(value, (int, float)):
+            if value == value:
+                total += value
+            continue
+        raw = clean_numeric(value)
         if raw:
             try:
                 total += float(raw)
@@ -88,83 +124,148 @@ def safe_sum(rows, column) -> float:
     return total
 
 # ---------------- READ GOOGLE SHEET -----------------
-def read_google_sheet():
+def read_google_sheet(dates=None, select=None):
+    """
+    Read the Invoices tab into InvoiceLine records (only lines dated on one
+    of `dates`, when given). `select(values)` can drop raw rows before they
+    are parsed.
+    """
     log_message("📌 read_google_sheet() called")
     try:
-        creds = Credentials.from_service_account_info(
-            SERVICE_ACCOUNT_INFO,
-            scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
-        )
-        service = build("sheets", "v4", credentials=creds)
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=RANGE_NAME
-        ).execute()
-        values = result.get("values", [])
+        with timer.span("fetch"):
+            if dates:
+                values = read_rows_for_dates(SPREADSHEET_ID, RANGE_NAME, "Invoice Date", dates)
+            else:
+                values = read_values(SPREADSHEET_ID, RANGE_NAME)
         if not values:
             log_message("❌ No data found in Google Sheet.")
             return None
+        if len(values) < 2:
+            log_message("ℹ️ No matching rows in Google Sheet.")
+            return None
 
-        df = pd.DataFrame(values[1:], columns=[c.strip() for c in values[0]])
-        df = df.loc[:, df.columns != ""]
-        df = df.fillna("")
-        log_message(f"✅ Google Sheet read successfully. Rows: {len(df)}")
-        log_message(f"[📄] Columns detected: {list(df.columns)}")
-        return df
+        if select is not None:
+            with timer.span("watermark"):
+                values = select(values)
+            if len(values) < 2:
+                log_message("ℹ️ No new or changed invoices since the last run.")
+                return None
+
+        with timer.span("parse"):
+            lines = list(read_records(values, INVOICES, InvoiceLine, date_column="Invoice Date", dates=dates))
+        log_message(f"✅ Google Sheet read successfully. Rows: {len(lines)}")
+        log_message(f"[📄] Columns detected: {[str(c).strip() for c in values[0]]}")
+        return lines
 
     except Exception as e:
         log_message(f"❌ Failed to read Google Sheet: {e}")
         return None
 
+# ---------------- INCREMENTAL WATERMARK -----------------
+def invoice_column(names) -> str:
+    return "Invoice Numeber" if "Invoice Numeber" in names else "Invoice Number"
+
+def group_invoice_rows(values) -> dict:
+    """invoice number -> its raw sheet rows, in sheet order (header row excluded)"""
+    header = [str(c).strip() for c in values[0]]
+    inv_col = invoice_column(header)
+    if inv_col not in header:
+        return {}
+    idx = header.index(inv_col)
+    groups = {}
+    for row in values[1:]:
+        invoice_num = str(row[idx]).strip() if len(row) > idx else ""
+        groups.setdefault(invoice_num, []).append(row)
+    return groups
+
+def invoice_digest(header, rows) -> str:
+    """Content hash of one invoice's line items; any edited cell changes it."""
+    h = hashlib.sha1("\x1f".join(str(c).strip() for c in header).encode("utf-8"))
+    for row in rows:
+        cells = [str(c).strip() for c in row[:len(header)]]
+        while cells and not cells[-1]:
+            cells.pop()
+        h.update(b"\x1e" + "\x1f".join(cells).encode("utf-8"))
+    return h.hexdigest()
+
+def select_changed_invoices(values, seen: dict):
+    """
+    -> (values, digests): the header plus the rows of invoices that are new or
+    whose line items changed since `seen` (invoice number -> digest), and the
+    digest of each invoice kept.
+    """
+    groups = group_invoice_rows(values)
+    if not groups:
+        return values, {}
+    digests = {num: invoice_digest(values[0], rows) for num, rows in groups.items()}
+    changed = {num: d for num, d in digests.items() if seen.get(num) != d}
+    if len(changed) < len(digests):
+        log_message(f"⏭️  {len(digests) - len(changed)} invoice(s) unchanged since the last run — skipped.")
+    return [values[0]] + [row for num in changed for row in groups[num]], changed
+
 # ---------------- BUILD COURSE DETAILS ROWS -----------------
+COURSE_DETAIL_ROW_TEMPLATE = Template("""
+        <tr style="background:{{bg}}">
+            <td style="padding:8px 10px;border:1px solid #e8ecef">{{course}}</td>
+            <td style="padding:8px 10px;border:1px solid #e8ecef">{{course_type}}</td>
+            <td style="padding:8px 10px;border:1px solid #e8ecef">{{level}}</td>
+            <td style="padding:8px 10px;border:1px solid #e8ecef">{{teacher}}</td>
+            <td style="padding:8px 10px;border:1px solid #e8ecef;text-align:center">{{classes}}</td>
+        </tr>""")
+
 def build_course_details_rows(rows):
-    html = ""
-    for i, row in enumerate(rows):
-        bg          = "#f9fafb" if i % 2 == 0 else "#ffffff"
-        course      = row.get('Course_', row.get('Course', ''))
-        course_type = row.get('Course Type', '')
-        level       = row.get('Level', '')
-        teacher     = row.get('Teacher', '')
-        classes     = row.get('COUNT of Class No', '')
-
-        html += f"""
-        <tr style="background:{bg}">
-            <td style="padding:8px 10px;border:1px solid #e8ecef">{course}</td>
-            <td style="padding:8px 10px;border:1px solid #e8ecef">{course_type}</td>
-            <td style="padding:8px 10px;border:1px solid #e8ecef">{level}</td>
-            <td style="padding:8px 10px;border:1px solid #e8ecef">{teacher}</td>
-            <td style="padding:8px 10px;border:1px solid #e8ecef;text-align:center">{classes}</td>
-        </tr>"""
-    return html
+    return COURSE_DETAIL_ROW_TEMPLATE.render_many(
+        dict(
+            bg          = "#f9fafb" if i % 2 == 0 else "#ffffff",
+            course      = row.get('Course_', row.get('Course', '')),
+            course_type = row.get('Course Type', ''),
+            level       = row.get('Level', ''),
+            teacher     = row.get('Teacher', ''),
+            classes     = row.get('COUNT of Class No', ''),
+        )
+        for i, row in enumerate(rows)
+    )
 
 # ---------------- BUILD INVOICE LINE ITEMS -----------------
-def build_line_item_rows(rows):
-    html = ""
-    for row in rows:
-        course      = row.get('Course_', row.get('Course', ''))
-        course_type = row.get('Course Type', '')
-        classes     = row.get('COUNT of Class No', '')
-        rate        = fmt_currency(row.get('Rate', ''))
-        amount      = fmt_currency(row.get('Amount', ''))
-
-        html += f"""
+LINE_ITEM_ROW_TEMPLATE = Template("""
         <tr>
             <td style="padding:10px 12px;border:1px solid #e0e0e0">
-                {course} — {course_type}
+                {{course}} — {{course_type}}
             </td>
-            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:center">{classes}</td>
-            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:right">{rate}</td>
-            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:right">{amount}</td>
-        </tr>"""
-    return html
+            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:center">{{classes}}</td>
+            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:right">{{rate}}</td>
+            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:right">{{amount}}</td>
+        </tr>""")
+
+def build_line_item_rows(rows):
+    return LINE_ITEM_ROW_TEMPLATE.render_many(
+        dict(
+            course      = row.get('Course_', row.get('Course', '')),
+            course_type = row.get('Course Type', ''),
+            classes     = row.get('COUNT of Class No', ''),
+            rate        = fmt_currency(row.get('Rate', '')),
+            amount      = fmt_currency(row.get('Amount', '')),
+        )
+        for row in rows
+    )
 
 # ---------------- BUILD DISCOUNT ROWS -----------------
+DISCOUNT_ROW_TEMPLATE = Template("""
+    <tr>
+        <td colspan="3" style="padding:10px 12px;border:1px solid #e0e0e0;color:#c0392b">
+            Discount — {{label_text}}
+        </td>
+        <td style="padding:10px 12px;border:1px solid #e0e0e0;color:#c0392b;text-align:right">
+            − {{discount_amount}}
+        </td>
+    </tr>""")
+
 def build_discount_rows(invoice_rows, subtotal: float, total_due: float):
     discount_labels = []
 
     for row in invoice_rows:
         for i in range(1, 4):
-            d = str(row.get(f"Discount Type {i}", "")).strip()
+            d = row.get(f"Discount Type {i}", "")
             if d and d not in discount_labels:
                 discount_labels.append(d)
 
@@ -175,22 +276,25 @@ def build_discount_rows(invoice_rows, subtotal: float, total_due: float):
 
     label_text = " / ".join(discount_labels) if discount_labels else "Discount"
 
-    return f"""
-    <tr>
-        <td colspan="3" style="padding:10px 12px;border:1px solid #e0e0e0;color:#c0392b">
-            Discount — {label_text}
-        </td>
-        <td style="padding:10px 12px;border:1px solid #e0e0e0;color:#c0392b;text-align:right">
-            − {fmt_currency(discount_amount)}
-        </td>
-    </tr>"""
+    return DISCOUNT_ROW_TEMPLATE.render(dict(
+        label_text      = label_text,
+        discount_amount = fmt_currency(discount_amount),
+    ))
 
 # ---------------- BUILD INVOICE SECTIONS (shared) -----------------
+SUBTOTAL_ROW_TEMPLATE = Template("""
+        <tr style="background:#f9fafb">
+            <td colspan="3" style="padding:10px 12px;border:1px solid #e0e0e0;font-weight:bold">Subtotal</td>
+            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:right;font-weight:bold">
+                {{subtotal}}
+            </td>
+        </tr>""")
+
 def build_invoice_sections(invoice_rows):
     """Build all the inner table sections shared between email and PDF."""
     first = invoice_rows[0]
 
-    invoice_num  = str(first.get('Invoice Numeber', first.get('Invoice Number', ''))).strip()
+    invoice_num  = first.get('Invoice Numeber', first.get('Invoice Number', ''))
     invoice_date = first.get('Invoice Date', '')
     student      = first.get('Student', '')
     cust_email   = first.get('Customer Email', '')
@@ -203,7 +307,7 @@ def build_invoice_sections(invoice_rows):
     amount_after_discount = fmt_currency(total_due)
 
     has_discount = any(
-        str(row.get(f"Discount Type {i}", "")).strip()
+        row.get(f"Discount Type {i}", "")
         for row in invoice_rows
         for i in range(1, 4)
     )
@@ -212,13 +316,7 @@ def build_invoice_sections(invoice_rows):
     line_item_rows     = build_line_item_rows(invoice_rows)
     discount_rows      = build_discount_rows(invoice_rows, subtotal, total_due)
 
-    subtotal_row = f"""
-        <tr style="background:#f9fafb">
-            <td colspan="3" style="padding:10px 12px;border:1px solid #e0e0e0;font-weight:bold">Subtotal</td>
-            <td style="padding:10px 12px;border:1px solid #e0e0e0;text-align:right;font-weight:bold">
-                {subtotal_fmt}
-            </td>
-        </tr>""" if has_discount else ""
+    subtotal_row = SUBTOTAL_ROW_TEMPLATE.render(dict(subtotal=subtotal_fmt)) if has_discount else ""
 
     return dict(
         invoice_num=invoice_num,
@@ -234,22 +332,15 @@ def build_invoice_sections(invoice_rows):
     )
 
 # ---------------- BUILD EMAIL HTML -----------------
-def build_email_html(invoice_rows, month_name: str) -> str:
-    """HTML optimised for email clients (table-based layout, remote images)."""
-    s = build_invoice_sections(invoice_rows)
-
-    header_img_html = f'<tr><td><img src="{HEADER_IMAGE_URL2}" width="620" style="display:block;width:100%"></td></tr>' if HEADER_IMAGE_URL2 else ""
-    footer_img_html = f'<tr><td><img src="{FOOTER_IMAGE_URL}" width="620" style="display:block;width:100%"></td></tr>' if FOOTER_IMAGE_URL else ""
-
-    return f"""<!DOCTYPE html>
+EMAIL_HTML_TEMPLATE = Template("""<!DOCTYPE html>
 <html>
-<head><meta charset="UTF-8"><title>Invoice #{s['invoice_num']}</title></head>
+<head><meta charset="UTF-8"><title>Invoice #{{invoice_num}}</title></head>
 <body style="margin:0;padding:0;background:#f4f6f8;font-family:Arial,sans-serif">
 <table width="100%" cellpadding="0" cellspacing="0">
 <tr><td align="center" style="padding:30px 0">
   <table width="620" style="background:#fff;border-radius:10px;overflow:hidden;border-collapse:collapse;box-shadow:0 2px 8px rgba(0,0,0,0.08)">
 
-    {header_img_html}
+    {{header_img_html}}
 
     <!-- Billed To + Invoice Meta -->
     <tr>
@@ -258,16 +349,16 @@ def build_email_html(invoice_rows, month_name: str) -> str:
           <tr>
             <td style="vertical-align:top;width:55%">
               <p style="margin:0 0 6px;font-size:11px;text-transform:uppercase;color:#7f8c8d;letter-spacing:1px">Billed To</p>
-              <p style="margin:0;font-size:18px;font-weight:bold;color:#043C4C">{s['student']}</p>
-              <p style="margin:4px 0 0;font-size:13px;color:#043C4C">{s['cust_email']}</p>
-              <p style="margin:2px 0 0;font-size:13px;color:#7f8c8d">{s['cust_mobile']}</p>
+              <p style="margin:0;font-size:18px;font-weight:bold;color:#043C4C">{{student}}</p>
+              <p style="margin:4px 0 0;font-size:13px;color:#043C4C">{{cust_email}}</p>
+              <p style="margin:2px 0 0;font-size:13px;color:#7f8c8d">{{cust_mobile}}</p>
             </td>
             <!-- spacer -->
             <td style="width:20px"></td>
             <td align="right" style="vertical-align:top;width:45%">
               <h2 style="margin:0;font-size:22px;letter-spacing:1px;color:#043C4C">INVOICE</h2>
-              <p style="margin:2px 0 0;font-size:20px;font-weight:bold;color:#f0c040">#{s['invoice_num']}</p>
-              <p style="margin:8px 0 0;font-size:12px;color:#aab8c4">Date: {s['invoice_date']}</p>
+              <p style="margin:2px 0 0;font-size:20px;font-weight:bold;color:#f0c040">#{{invoice_num}}</p>
+              <p style="margin:8px 0 0;font-size:12px;color:#aab8c4">Date: {{invoice_date}}</p>
             </td>
           </tr>
         </table>
@@ -286,7 +377,7 @@ def build_email_html(invoice_rows, month_name: str) -> str:
             <td style="padding:9px 10px">Teacher</td>
             <td style="padding:9px 10px;text-align:center">Classes</td>
           </tr>
-          {s['course_detail_rows']}
+          {{course_detail_rows}}
         </table>
       </td>
     </tr>
@@ -302,13 +393,13 @@ def build_email_html(invoice_rows, month_name: str) -> str:
             <td style="padding:10px 12px;text-align:right">Rate</td>
             <td style="padding:10px 12px;text-align:right">Amount</td>
           </tr>
-          {s['line_item_rows']}
-          {s['subtotal_row']}
-          {s['discount_rows']}
+          {{line_item_rows}}
+          {{subtotal_row}}
+          {{discount_rows}}
           <tr style="background:#043C4C;color:#fff">
             <td colspan="3" style="padding:12px;font-weight:bold;font-size:15px">Total Due</td>
             <td style="padding:12px;text-align:right;font-weight:bold;font-size:16px;color:#f0c040">
-              {s['amount_after_discount']}
+              {{amount_after_discount}}
             </td>
           </tr>
         </table>
@@ -323,47 +414,43 @@ def build_email_html(invoice_rows, month_name: str) -> str:
       </td>
     </tr>
 
-    {footer_img_html}
+    {{footer_img_html}}
 
   </table>
 </td></tr>
 </table>
 </body>
-</html>"""
+</html>""")
 
-# ---------------- BUILD PDF HTML -----------------
-def build_pdf_html(invoice_rows, month_name: str) -> str:
-    """
-    HTML optimised for WeasyPrint PDF rendering.
-    - @page rule centres the content with equal margins on all sides.
-    - The header section uses explicit padding-right on the left cell
-      and padding-left on the right cell to guarantee visible space.
-    - Fixed 620px width matches the email layout exactly.
-    """
+def build_email_html(invoice_rows, month_name: str) -> str:
+    """HTML optimised for email clients (table-based layout, remote images)."""
     s = build_invoice_sections(invoice_rows)
 
-    header_img_html = f'<img src="{HEADER_IMAGE_URL2}" style="display:block;width:100%;max-width:620px">' if HEADER_IMAGE_URL2 else ""
-    footer_img_html = f'<img src="{FOOTER_IMAGE_URL}" style="display:block;width:100%;max-width:620px">' if FOOTER_IMAGE_URL else ""
+    header_img_html = f'<tr><td><img src="{HEADER_IMAGE_URL2}" width="620" style="display:block;width:100%"></td></tr>' if HEADER_IMAGE_URL2 else ""
+    footer_img_html = f'<tr><td><img src="{FOOTER_IMAGE_URL}" width="620" style="display:block;width:100%"></td></tr>' if FOOTER_IMAGE_URL else ""
 
-    return f"""<!DOCTYPE html>
-<html>
-<head>
-<meta charset="UTF-8">
-<title>Invoice #{s['invoice_num']}</title>
-<style>
+    return EMAIL_HTML_TEMPLATE.render(dict(
+        s,
+        header_img_html = header_img_html,
+        footer_img_html = footer_img_html,
+    ))
+
+# ---------------- PDF STYLESHEET -----------------
+# Parsed once per process into a WeasyPrint CSS object and shared by every invoice
+INVOICE_PDF_CSS = """
   /* ── Page setup: A4, centred with equal margins ── */
-  @page {{
+  @page {
     size: A4;
     margin: 25mm 20mm 25mm 20mm;
-  }}
+  }
 
-  * {{
+  * {
     box-sizing: border-box;
     -webkit-print-color-adjust: exact;
     print-color-adjust: exact;
-  }}
+  }
 
-  body {{
+  body {
     margin: 0;
     padding: 0;
     font-family: Arial, sans-serif;
@@ -376,160 +463,241 @@ def build_pdf_html(invoice_rows, month_name: str) -> str:
     align-items: center;
     justify-content: center;
     min-height: 100%;
-  }}
+  }
 
   /* ── Outer card ── */
-  .invoice-card {{
+  .invoice-card {
     width: 620px;
     background: #ffffff;
     border-radius: 10px;
     overflow: hidden;
     border: 1px solid #e0e0e0;
     box-shadow: 0 2px 8px rgba(0,0,0,0.08);
-  }}
+  }
 
   /* ── Header image ── */
-  .header-img {{ display:block; width:100%; }}
+  .header-img { display:block; width:100%; }
 
   /* ── Billed-To / Invoice-Meta bar ── */
-  .meta-bar {{
+  .meta-bar {
     background: #f0f4f8;
     padding: 24px 28px;
-  }}
-  .meta-table {{
+  }
+  .meta-table {
     width: 100%;
     border-collapse: collapse;
-  }}
+  }
   /* LEFT cell — billed-to */
-  .meta-left {{
+  .meta-left {
     vertical-align: top;
     width: 55%;
     padding-right: 40px;   /* ← the gap between the two halves */
-  }}
+  }
   /* RIGHT cell — invoice number */
-  .meta-right {{
+  .meta-right {
     vertical-align: top;
     width: 45%;
     text-align: right;
     padding-left: 20px;    /* extra breathing room on the right */
-  }}
-  .label {{
+  }
+  .label {
     margin: 0 0 6px;
     font-size: 10px;
     text-transform: uppercase;
     color: #7f8c8d;
     letter-spacing: 1px;
-  }}
-  .student-name {{
+  }
+  .student-name {
     margin: 0;
     font-size: 17px;
     font-weight: bold;
     color: #043C4C;
-  }}
-  .meta-sub {{
+  }
+  .meta-sub {
     margin: 3px 0 0;
     font-size: 12px;
     color: #043C4C;
-  }}
-  .meta-mobile {{
+  }
+  .meta-mobile {
     margin: 2px 0 0;
     font-size: 12px;
     color: #7f8c8d;
-  }}
-  .invoice-title {{
+  }
+  .invoice-title {
     margin: 0;
     font-size: 20px;
     letter-spacing: 1px;
     color: #043C4C;
-  }}
-  .invoice-num {{
+  }
+  .invoice-num {
     margin: 2px 0 0;
     font-size: 19px;
     font-weight: bold;
     color: #f0c040;
-  }}
-  .invoice-date {{
+  }
+  .invoice-date {
     margin: 8px 0 0;
     font-size: 11px;
     color: #aab8c4;
-  }}
+  }
 
   /* ── Section label ── */
-  .section-label {{
+  .section-label {
     margin: 0 0 12px;
     font-size: 10px;
     text-transform: uppercase;
     color: #7f8c8d;
     letter-spacing: 1px;
-  }}
+  }
 
   /* ── Generic inner sections ── */
-  .section {{ padding: 20px 28px; }}
-  .section-bottom {{ padding: 0 28px 20px; }}
+  .section { padding: 20px 28px; }
+  .section-bottom { padding: 0 28px 20px; }
 
   /* ── Data tables ── */
-  .data-table {{
+  .data-table {
     width: 100%;
     border-collapse: collapse;
     font-size: 13px;
-  }}
-  .data-table th {{
+  }
+  .data-table th {
     background: #043C4C;
     color: #fff;
     padding: 9px 10px;
     text-align: left;
-  }}
-  .data-table th.right {{ text-align: right; }}
-  .data-table th.center {{ text-align: center; }}
-  .data-table td {{
+  }
+  .data-table th.right { text-align: right; }
+  .data-table th.center { text-align: center; }
+  .data-table td {
     padding: 9px 10px;
     border: 1px solid #e8ecef;
-  }}
-  .data-table td.right {{ text-align: right; }}
-  .data-table td.center {{ text-align: center; }}
+  }
+  .data-table td.right { text-align: right; }
+  .data-table td.center { text-align: center; }
 
   /* ── Total row ── */
-  .total-row td {{
+  .total-row td {
     background: #043C4C;
     color: #fff;
     padding: 12px;
     font-weight: bold;
     font-size: 14px;
     border: none;
-  }}
-  .total-amount {{
+  }
+  .total-amount {
     color: #f0c040 !important;
     font-size: 15px !important;
     text-align: right;
-  }}
+  }
 
   /* ── Subtotal row ── */
-  .subtotal-row td {{
+  .subtotal-row td {
     background: #f9fafb;
     font-weight: bold;
     border: 1px solid #e0e0e0;
-  }}
+  }
 
   /* ── Discount row ── */
-  .discount-row td {{
+  .discount-row td {
     color: #c0392b;
     border: 1px solid #e0e0e0;
-  }}
+  }
 
   /* ── Footer note ── */
-  .footer-note {{
+  .footer-note {
     padding: 16px 28px;
     text-align: center;
     font-size: 11px;
     color: #7f8c8d;
     border-top: 1px solid #eee;
-  }}
-</style>
+  }
+"""
+
+# ---------------- WEASYPRINT (LOADED ON FIRST PDF) -----------------
+_weasyprint = None
+
+def load_weasyprint():
+    """The weasyprint module, or None if it is not installed."""
+    global _weasyprint
+    if _weasyprint is None:
+        try:
+            import weasyprint
+            _weasyprint = weasyprint
+        except ImportError:
+            _weasyprint = False
+    return _weasyprint or None
+
+_invoice_stylesheet = None
+
+def get_invoice_stylesheet():
+    global _invoice_stylesheet
+    if _invoice_stylesheet is None:
+        _invoice_stylesheet = load_weasyprint().CSS(string=INVOICE_PDF_CSS)
+    return _invoice_stylesheet
+
+# ---------------- PDF ASSET CACHE -----------------
+# Header/footer images are downloaded once and referenced as local files,
+# so WeasyPrint never re-fetches them over HTTP for each invoice.
+_asset_uris = {}
+
+# Render mode never downloads: images come from ASSET_CACHE_DIR or are left out
+_assets_offline = False
+
+def use_offline_assets():
+    """Take PDF images only from the local asset cache (handed on to the PDF workers)."""
+    global _assets_offline
+    _assets_offline = True
+
+def cached_asset_uri(url: str) -> str:
+    """Local file URI for `url`; "" when offline and the image was never cached."""
+    if not url:
+        return url
+    if url in _asset_uris:
+        return _asset_uris[url]
+
+    ext  = os.path.splitext(urllib.parse.urlparse(url).path)[1] or ".img"
+    path = os.path.join(ASSET_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest()[:16] + ext)
+    try:
+        if not os.path.exists(path) and _assets_offline:
+            log_message(f"⚠️  PDF asset {url} is not in {ASSET_CACHE_DIR} — left out of the offline render")
+            _asset_uris[url] = ""
+            return ""
+        if not os.path.exists(path):
+            os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+            with urllib.request.urlopen(url, timeout=timeouts("assets")[1]) as response:
+                data = response.read()
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            log_message(f"🖼️  Cached PDF asset {url} ({len(data):,} bytes)")
+        uri = pathlib.Path(path).resolve().as_uri()
+    except Exception as e:
+        log_message(f"⚠️  Could not cache PDF asset {url}: {e}")
+        uri = url
+
+    _asset_uris[url] = uri
+    return uri
+
+def warm_pdf_resources():
+    """Parse the stylesheet and fetch images up front (before starting PDF workers)."""
+    if load_weasyprint() is None:
+        return
+    get_invoice_stylesheet()
+    cached_asset_uri(HEADER_IMAGE_URL2)
+    cached_asset_uri(FOOTER_IMAGE_URL)
+
+# ---------------- BUILD PDF HTML -----------------
+PDF_HTML_TEMPLATE = Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8">
+<title>Invoice #{{invoice_num}}</title>
 </head>
 <body>
 <div class="invoice-card">
 
-  {f'<div>{header_img_html}</div>' if header_img_html else ''}
+  {{header_block}}
 
   <!-- Billed To + Invoice Meta -->
   <div class="meta-bar">
@@ -537,14 +705,14 @@ def build_pdf_html(invoice_rows, month_name: str) -> str:
       <tr>
         <td class="meta-left">
           <p class="label">Billed To</p>
-          <p class="student-name">{s['student']}</p>
-          <p class="meta-sub">{s['cust_email']}</p>
-          <p class="meta-mobile">{s['cust_mobile']}</p>
+          <p class="student-name">{{student}}</p>
+          <p class="meta-sub">{{cust_email}}</p>
+          <p class="meta-mobile">{{cust_mobile}}</p>
         </td>
         <td class="meta-right">
           <h2 class="invoice-title">INVOICE</h2>
-          <p class="invoice-num">#{s['invoice_num']}</p>
-          <p class="invoice-date">Date: {s['invoice_date']}</p>
+          <p class="invoice-num">#{{invoice_num}}</p>
+          <p class="invoice-date">Date: {{invoice_date}}</p>
         </td>
       </tr>
     </table>
@@ -561,7 +729,7 @@ def build_pdf_html(invoice_rows, month_name: str) -> str:
         <th>Teacher</th>
         <th class="center">Classes</th>
       </tr>
-      {s['course_detail_rows']}
+      {{course_detail_rows}}
     </table>
   </div>
 
@@ -575,12 +743,12 @@ def build_pdf_html(invoice_rows, month_name: str) -> str:
         <th class="right">Rate</th>
         <th class="right">Amount</th>
       </tr>
-      {s['line_item_rows']}
-      {s['subtotal_row']}
-      {s['discount_rows']}
+      {{line_item_rows}}
+      {{subtotal_row}}
+      {{discount_rows}}
       <tr class="total-row">
         <td colspan="3">Total Due</td>
-        <td class="total-amount">{s['amount_after_discount']}</td>
+        <td class="total-amount">{{amount_after_discount}}</td>
       </tr>
     </table>
   </div>
@@ -591,90 +759,233 @@ def build_pdf_html(invoice_rows, month_name: str) -> str:
     Please settle the due amount via e-Transfer using info@ndacademy.ca
   </div>
 
-  {f'<div>{footer_img_html}</div>' if footer_img_html else ''}
+  {{footer_block}}
 
 </div>
 </body>
-</html>"""
+</html>""")
+
+def build_pdf_html(invoice_rows, month_name: str) -> str:
+    """
+    HTML optimised for WeasyPrint PDF rendering; styles live in INVOICE_PDF_CSS.
+    - @page rule centres the content with equal margins on all sides.
+    - The header section uses explicit padding-right on the left cell
+      and padding-left on the right cell to guarantee visible space.
+    - Fixed 620px width matches the email layout exactly.
+    """
+    s = build_invoice_sections(invoice_rows)
+
+    header_uri = cached_asset_uri(HEADER_IMAGE_URL2)
+    footer_uri = cached_asset_uri(FOOTER_IMAGE_URL)
+    header_img_html = f'<img src="{header_uri}" style="display:block;width:100%;max-width:620px">' if header_uri else ""
+    footer_img_html = f'<img src="{footer_uri}" style="display:block;width:100%;max-width:620px">' if footer_uri else ""
+
+    return PDF_HTML_TEMPLATE.render(dict(
+        s,
+        header_block = f'<div>{header_img_html}</div>' if header_img_html else '',
+        footer_block = f'<div>{footer_img_html}</div>' if footer_img_html else '',
+    ))
 
 # ---------------- GENERATE PDF BYTES -----------------
 def generate_pdf(invoice_rows, month_name: str, invoice_num: str) -> bytes | None:
-    if not WEASYPRINT_AVAILABLE:
+    weasyprint = load_weasyprint()
+    if weasyprint is None:
         log_message("⚠️  WeasyPrint not installed — skipping PDF attachment.")
         return None
     try:
         html = build_pdf_html(invoice_rows, month_name)
-        pdf_bytes = WeasyHTML(string=html).write_pdf()
+        pdf_bytes = weasyprint.HTML(string=html).write_pdf(stylesheets=[get_invoice_stylesheet()])
         log_message(f"✅ PDF generated for invoice #{invoice_num} ({len(pdf_bytes):,} bytes)")
         return pdf_bytes
     except Exception as e:
         log_message(f"❌ PDF generation failed for invoice #{invoice_num}: {e}")
         return None
 
+# ---------------- PARALLEL PDF RENDERING -----------------
+def _pdf_timeout_handler(signum, frame):
+    raise TimeoutError(f"PDF rendering exceeded {PDF_TIMEOUT_SECONDS}s")
+
+def _init_pdf_worker(offline: bool, asset_uris: dict):
+    """
+    Pool initializer. Workers start from a fresh interpreter, so they get the
+    parent's offline setting and resolved image URIs explicitly; the images
+    are then never fetched again, and render mode stays offline.
+    """
+    global _assets_offline
+    _assets_offline = offline
+    _asset_uris.update(asset_uris)
+    warm_pdf_resources()
+
+def _render_pdf_in_worker(invoice_num: str, invoice_rows, month_name: str):
+    """
+    Runs inside a pool worker; SIGALRM enforces the per-document timeout.
+    The render time is returned because metrics recorded here stay in the worker.
+    """
+    signal.signal(signal.SIGALRM, _pdf_timeout_handler)
+    signal.setitimer(signal.ITIMER_REAL, PDF_TIMEOUT_SECONDS)
+    started = time.perf_counter()
+    try:
+        pdf_bytes = generate_pdf(invoice_rows, month_name, invoice_num)
+        return invoice_num, pdf_bytes, time.perf_counter() - started
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+@contextmanager
+def pdf_renderer(workers: int):
+    """
+    Yields render(invoice_num, invoice_rows, month_name) -> pdf_bytes | None.
+    With more than one worker, documents render in a process pool across the
+    cores; render() is then safe to call from several threads at once and
+    blocks only the calling thread.
+    """
+    if load_weasyprint() is None or workers <= 1:
+        def render(invoice_num, invoice_rows, month_name):
+            started = time.perf_counter()
+            pdf_bytes = generate_pdf(invoice_rows, month_name, invoice_num)
+            if pdf_bytes is not None:
+                timer.observe("pdf", time.perf_counter() - started)
+            return pdf_bytes
+
+        yield render
+        return
+
+    log_message(f"🖨️  Rendering PDFs on {workers} worker(s)")
+    warm_pdf_resources()
+    # Not fork: the pipeline's threads may hold locks (logging, SQLite, SMTP) at fork time
+    context = multiprocessing.get_context(
+        "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_pdf_worker,
+                             initargs=(_assets_offline, dict(_asset_uris))) as pool:
+        def render(invoice_num, invoice_rows, month_name):
+            try:
+                _, pdf_bytes, elapsed = pool.submit(
+                    _render_pdf_in_worker, invoice_num, invoice_rows, month_name
+                ).result()
+            except Exception as e:
+                log_message(f"❌ PDF worker failed for invoice #{invoice_num}: {e}")
+                return None
+            if pdf_bytes is not None:
+                timer.observe("pdf", elapsed)
+            return pdf_bytes
+
+        yield render
+
 # ---------------- SEND EMAIL -----------------
+def build_invoice_message(to_email, subject, body, pdf_bytes: bytes | None = None, pdf_filename: str = "Invoice.pdf"):
+    attachments = []
+    if pdf_bytes:
+        attachments.append((pdf_filename, "application/pdf", pdf_bytes))
+        log_message(f"📎 PDF attached: {pdf_filename}")
+    return INVOICE_MESSAGE.build(to_email, subject, body, attachments)
+
 def send_email(to_email, subject, body, pdf_bytes: bytes | None = None, pdf_filename: str = "Invoice.pdf"):
     try:
-        msg = MIMEMultipart()
-        msg["From"]    = f"New Dimension Academy <{EMAIL_USER}>"
-        msg["To"]      = to_email
-        msg["Subject"] = subject
-
-        msg.attach(MIMEText(body, "html"))
-
-        if pdf_bytes:
-            part = MIMEBase("application", "pdf")
-            part.set_payload(pdf_bytes)
-            encoders.encode_base64(part)
-            part.add_header("Content-Disposition", "attachment", filename=pdf_filename)
-            msg.attach(part)
-            log_message(f"📎 PDF attached: {pdf_filename}")
-
-        bcc_list   = ["alhuraibia@gmail.com", "dalmaznaee@gmail.com"]
-        recipients = [to_email] + bcc_list
-        msg["Bcc"] = ", ".join(bcc_list)
-
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-            server.login(EMAIL_USER, EMAIL_PASSWORD)
-            server.sendmail(EMAIL_USER, recipients, msg.as_string())
-
-        log_message(f"✅ Invoice sent → TO: {to_email} | BCC: {', '.join(bcc_list)}")
+        message = build_invoice_message(to_email, subject, body, pdf_bytes, pdf_filename)
+
+        sender = get_sender(EMAIL_USER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT)
+        elapsed = sender.send_message(message)
+
+        log_message(
+            f"✅ Invoice sent → TO: {to_email} | BCC: {', '.join(INVOICE_MESSAGE.bcc)} "
+            f"({message.size:,} bytes, {elapsed * 1000:.0f} ms)"
+        )
+        return True
     except Exception as e:
         log_message(f"❌ Failed to send invoice to {to_email}: {e}")
+        raise  # dispatch records the reason in the outbox
+
+# ---------------- SEND QUEUED INVOICE -----------------
+def send_outbox_entry(entry) -> bool:
+    p = entry.payload
+    log_message(f"📨 Sending invoice #{p['invoice_num']} → {p['to_email']} ({p['line_count']} line(s))")
+    ok = send_email(
+        to_email     = p["to_email"],
+        subject      = p["subject"],
+        body         = p["body"],
+        pdf_bytes    = entry.attachment,
+        pdf_filename = p["pdf_filename"]
+    )
+    if ok and DIGEST_MODE:
+        digest.add(
+            p.get("summary") or dict(Invoice=p["invoice_num"], Email=p["to_email"], Lines=p["line_count"]),
+            attachment=(p["pdf_filename"], entry.attachment) if DIGEST_ATTACH_PDFS else None,
+        )
+    return ok
 
-# ---------------- PROCESS INVOICES -----------------
-def process_invoices():
-    df = read_google_sheet()
-    if df is None:
-        log_message("No data to process.")
-        return
+# ---------------- ADMIN DIGEST -----------------
+def send_digest():
+    sender = get_sender(EMAIL_USER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT)
+    return digest.send(sender.send_message)
 
-    today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    log_message(f"📅 Processing invoices for today: {today_str}")
+def send_invoice_batch(entries):
+    return dispatch("email", [(e.recipient, dict(entry=e)) for e in entries], send_outbox_entry)
+
+# ---------------- COMPOSE INVOICES -----------------
+def compose_invoices(outbox, today_str, send_as_ready: bool = False) -> DispatchSummary | None:
+    """
+    Queue today's invoices in the outbox. Invoices already in the outbox are
+    skipped before any rendering happens.
+
+    Invoices stream through group -> email HTML -> PDF -> queue (-> send with
+    send_as_ready) stages joined by bounded queues, so invoice N+1 renders
+    while invoice N uploads, and a slow stage holds back the ones before it.
+
+    In incremental mode, invoices whose rows hash the same as when they were
+    last queued are dropped before parsing. An invoice whose line items
+    changed is queued again as a new revision.
+    """
+    seen    = outbox.watermarks(OUTBOX_JOB) if INVOICE_INCREMENTAL else None
+    digests = {}
 
-    def match_today(val):
-        return str(val).strip().split(" ")[0] == today_str
+    def select(values):
+        kept, changed = select_changed_invoices(values, seen)
+        digests.update(changed)
+        return kept
 
-    df_today = df[df["Invoice Date"].apply(match_today)].copy()
+    lines = read_google_sheet(dates=[today_str], select=select if seen is not None else None)
+    if lines is None:
+        log_message("No data to process.")
+        return None
 
-    if df_today.empty:
+    if not lines:
         log_message("ℹ️  No invoices scheduled for today.")
-        return
+        return None
 
-    inv_col = "Invoice Numeber" if "Invoice Numeber" in df_today.columns else "Invoice Number"
-    grouped = df_today.groupby(df_today[inv_col].str.strip())
+    grouped = group_by(lines, "Invoice Number")
+    counts  = dict(queued=0, skipped=0, already=0)
 
-    sent_count    = 0
-    skipped_count = 0
+    # ---- stage 1 (source): group rows per invoice, drop ones already queued ----
+    def invoice_groups():
+        for invoice_num, invoice_rows in sorted(grouped.items()):
+            digest   = digests.get(invoice_num)
+            identity = invoice_num
+            if digest and seen and seen.get(invoice_num) not in (None, digest):
+                identity = (invoice_num, digest)
+                log_message(f"🔁 Invoice #{invoice_num} changed since it was last queued — re-issuing.")
 
-    for invoice_num, group in grouped:
-        invoice_rows = group.to_dict(orient="records")
-        first        = invoice_rows[0]
+            key = message_key(f"{SPREADSHEET_ID}/{RANGE_NAME}", identity, "email", today_str)
+            if outbox.has(key):
+                counts["already"] += 1
+                if digest:
+                    outbox.set_watermark(OUTBOX_JOB, invoice_num, digest)
+                continue
 
-        customer_email = str(first.get("Customer Email", "")).strip()
-        if not customer_email:
-            log_message(f"⚠️  Skipping invoice #{invoice_num} — no Customer Email.")
-            skipped_count += 1
-            continue
+            first = invoice_rows[0]
+
+            customer_email = first.get("Customer Email", "")
+            if not customer_email:
+                log_message(f"⚠️  Skipping invoice #{invoice_num} — no Customer Email.")
+                counts["skipped"] += 1
+                continue
+
+            yield invoice_num, digest, key, customer_email, invoice_rows
+
+    # ---- stage 2: email HTML ----
+    def render_html(item):
+        invoice_num, digest, key, customer_email, invoice_rows = item
+        first = invoice_rows[0]
 
         student    = first.get("Student", "")
         month_raw  = first.get("Service Month", "")
@@ -687,22 +998,136 @@ def process_invoices():
         )
 
         # Email body and PDF are built from separate optimised templates
-        email_html = build_email_html(invoice_rows, month_name)
-        pdf_bytes  = generate_pdf(invoice_rows, month_name, invoice_num)
-        pdf_filename = f"Invoice_{invoice_num}_{student.replace(' ', '_')}_{month_name}_{year}.pdf"
-
-        log_message(f"📨 Sending invoice #{invoice_num} → {customer_email} ({len(invoice_rows)} line(s))")
-        send_email(
-            to_email     = customer_email,
-            subject      = subject,
-            body         = email_html,
-            pdf_bytes    = pdf_bytes,
-            pdf_filename = pdf_filename
+        with timer.span("render"):
+            email_html = build_email_html(invoice_rows, month_name)
+
+        return dict(
+            invoice_num    = invoice_num,
+            key            = key,
+            digest         = digest,
+            rows           = invoice_rows,
+            customer_email = customer_email,
+            subject        = subject,
+            body           = email_html,
+            month_name     = month_name,
+            pdf_filename   = f"Invoice_{invoice_num}_{student.replace(' ', '_')}_{month_name}_{year}.pdf",
+            summary        = dict(
+                Invoice = invoice_num,
+                Student = student,
+                Email   = customer_email,
+                Month   = f"{month_name} {year}",
+                Lines   = len(invoice_rows),
+                Total   = fmt_currency(safe_sum(invoice_rows, "Amount after Discount")),
+            ),
+        )
+
+    # ---- stage 3: PDF (process pool) ----
+    def render_pdf(inv):
+        inv["pdf_bytes"] = render_pdf_bytes(inv["invoice_num"], inv["rows"], inv["month_name"])
+        return inv
+
+    # ---- stage 4: queue in the outbox ----
+    def enqueue(inv):
+        outbox.enqueue(inv["key"], OUTBOX_JOB, "email", inv["customer_email"], dict(
+            invoice_num  = inv["invoice_num"],
+            line_count   = len(inv["rows"]),
+            to_email     = inv["customer_email"],
+            subject      = inv["subject"],
+            body         = inv["body"],
+            pdf_filename = inv["pdf_filename"],
+            summary      = inv["summary"],
+        ), attachment=inv["pdf_bytes"], send_date=today_str)
+        if inv["digest"]:
+            outbox.set_watermark(OUTBOX_JOB, inv["invoice_num"], inv["digest"])
+        counts["queued"] += 1
+        return (inv["key"], inv["customer_email"]) if send_as_ready else None
+
+    # ---- stage 5: send ----
+    def send(item):
+        key, recipient = item
+        if deadline.expired():
+            return [deadline_skipped(recipient)]  # stays pending in the outbox
+        entries = outbox.claim(OUTBOX_JOB, key=key)
+        # Same shared email limit and error handling as send_invoice_batch
+        summary = DispatchSummary(channel="email", results=[
+            dispatch_one("email", e.recipient, send_outbox_entry, dict(entry=e)) for e in entries
+        ])
+        outbox.record(entries, summary)
+        return summary.results
+
+    stages = [
+        Stage("html", render_html, INVOICE_RENDER_WORKERS),
+        Stage("pdf", render_pdf, max(1, min(PDF_WORKERS, len(grouped)))),
+        Stage("queue", enqueue),
+    ]
+    if send_as_ready:
+        stages.append(Stage("send", send, INVOICE_SEND_WORKERS))
+
+    sent = DispatchSummary(channel="email")
+    with pdf_renderer(stages[1].workers) as render_pdf_bytes:
+        for results in run_pipeline(OUTBOX_JOB, invoice_groups(), stages):
+            sent.results.extend(results)
+
+    if counts["already"]:
+        log_message(f"ℹ️  {counts['already']} invoice(s) already in the outbox — not re-rendered.")
+    log_message(f"📝 Invoices queued: {counts['queued']} | Skipped: {counts['skipped']}")
+    return sent
+
+# ---------------- PROCESS INVOICES -----------------
+def process_invoices(compose=True, send=True):
+    today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    log_message(f"📅 Processing invoices for today: {today_str}")
+
+    outbox = Outbox()
+    summary = DispatchSummary(channel=OUTBOX_JOB)
+    started = time.perf_counter()
+    # Invoices the pipeline already tried to send in this run are not retried by the drain
+    run_start = time.time()
+
+    if compose:
+        streamed = compose_invoices(outbox, today_str, send_as_ready=send)
+        if streamed is not None:
+            summary.results.extend(streamed.results)
+
+    if send:
+        # Anything left outstanding by this or an interrupted earlier run
+        leftovers = outbox.drain(OUTBOX_JOB, send_invoice_batch, retry_before=run_start)
+        summary.results.extend(leftovers.results)
+
+    summary.elapsed = time.perf_counter() - started
+    timer.observe_results("send", summary.results)
+    log_outbox(outbox, OUTBOX_JOB)
+    log_message(
+        f"🎉 Done. Sent: {summary.sent} | Failed: {summary.failed}"
+        + (f" | Left unsent at the run deadline: {summary.unsent}" if summary.unsent else "")
+    )
+    if DIGEST_MODE and send:
+        send_digest()
+    return summary
+
+# ---------------- RENDER ONLY -----------------
+def render_invoices(args) -> int:
+    """Compose the invoices for args.date and write them to args.out as .eml + .pdf; nothing is sent."""
+    log_message(f"📅 Rendering invoices for {args.date} → {args.out}")
+    use_offline_assets()
+    if args.sheet_json:
+        load_sheet_json(args.sheet_json, SPREADSHEET_ID, RANGE_NAME)
+
+    def build(entry):
+        p = entry.payload
+        return f"Invoice_{p['invoice_num']}", build_invoice_message(
+            p["to_email"], p["subject"], p["body"], entry.attachment, p["pdf_filename"]
         )
-        sent_count += 1
 
-    log_message(f"🎉 Done. Sent: {sent_count} | Skipped: {skipped_count}")
+    outbox = render_outbox()
+    compose_invoices(outbox, args.date)
+    return write_rendered(outbox, OUTBOX_JOB, args.out, build)
 
 # ---------------- MAIN -----------------
 if __name__ == "__main__":
-    process_invoices()
+    if is_render_mode(sys.argv):
+        render_invoices(parse_render_args(sys.argv, OUTBOX_JOB))
+        write_run_metrics(f"{OUTBOX_JOB}_render")
+    else:
+        process_invoices(*run_mode(sys.argv))
+        write_run_metrics(OUTBOX_JOB)
@@ -1,36 +1,50 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
-import base64
-import pandas as pd
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import sys
 from datetime import datetime, timezone
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
+from email_sender import SMTP_SERVER, SMTP_PORT, get_sender
+from mime import MessageTemplate
+from digest import DIGEST_MODE, Digest
+from sheets import read_values, read_rows_for_dates
+from schema import CURRENT_REPORT
+from records import ProgressReport, read_records
+from templates import Template
+from outbox import Outbox, message_key, dispatch_batch, log_outbox, run_mode
+from render_only import is_render_mode, parse_render_args, load_sheet_json, render_outbox, write_rendered
+from lookahead import is_prepare_mode, parse_prepare_args, lookahead_dates, source_digest, prepare_rows, PreparedMessages
+from metrics import stage_timer, write_run_metrics
 
 # ---------------- CONFIGURATION -----------------
 SPREADSHEET_ID = "1kfrSDM1c8Z9MBtI85IjDjJABL2KXuN1k8yPyAfWKh0U"
 RANGE_NAME = "Current_Report"
+OUTBOX_JOB = "progress_reports"
+timer = stage_timer(OUTBOX_JOB)
 
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 465
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")  # App password
 
+ADMIN_EMAILS = ["alhuraibia@gmail.com", "dalmaznaee@gmail.com"]
+
+# From header, BCC list and MIME skeleton shared by every report email.
+# In digest mode admins and teachers get one summary at the end instead of BCC copies.
+REPORT_MESSAGE = MessageTemplate(
+    f"New Dimension Academy <{EMAIL_USER}>",
+    bcc=[] if DIGEST_MODE else ADMIN_EMAILS,
+)
+digest = Digest(
+    OUTBOX_JOB,
+    "Progress reports sent",
+    ["Student", "Email", "Course", "Level", "Teacher", "Month"],
+    f"New Dimension Academy <{EMAIL_USER}>",
+    admins=ADMIN_EMAILS,
+)
+
 HEADER_IMAGE_URL = os.getenv("HEADER_IMAGE_URL", "")
 FOOTER_IMAGE_URL = os.getenv("FOOTER_IMAGE_URL", "")
 
-# ---------------- SERVICE ACCOUNT -----------------
-if "SERVICE_ACCOUNT_JSON" not in os.environ:
-    raise ValueError("SERVICE_ACCOUNT_JSON environment variable is not set!")
-
-# Decode base64 JSON (works with GitHub Actions secret)
-SERVICE_ACCOUNT_INFO = json.loads(
-    base64.b64decode(os.environ["SERVICE_ACCOUNT_JSON"]).decode("utf-8")
-)
+# Prepared reports from an older version of this script or the shared rendering modules, or with other images, are re-rendered
+PREPARE_VERSION = f"{source_digest(__file__)}|{HEADER_IMAGE_URL}|{FOOTER_IMAGE_URL}"
 
 # ---------------- LOG FUNCTION -----------------
 def log_message(message: str):
@@ -38,37 +52,33 @@ def log_message(message: str):
     print(f"[{ts}] {message}")
 
 # ---------------- READ GOOGLE SHEET -----------------
-def read_google_sheet():
+def read_google_sheet(dates=None):
     log_message("📌 read_google_sheet() called")
     try:
-        creds = Credentials.from_service_account_info(
-            SERVICE_ACCOUNT_INFO,
-            scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
-        )
-        service = build("sheets", "v4", credentials=creds)
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=RANGE_NAME
-        ).execute()
-        values = result.get("values", [])
+        with timer.span("fetch"):
+            if dates:
+                values = read_rows_for_dates(SPREADSHEET_ID, RANGE_NAME, "Report_Date", dates)
+            else:
+                values = read_values(SPREADSHEET_ID, RANGE_NAME)
         if not values:
             log_message("❌ No data found in Google Sheet.")
             return None
+        if len(values) < 2:
+            log_message("ℹ️ No matching rows in Google Sheet.")
+            return None
 
-        df = pd.DataFrame(values[1:], columns=[c.strip() for c in values[0]])
-        df = df.loc[:, df.columns != ""]  # remove empty columns
-        df = df.fillna("")  # replace NaN with empty string
-        log_message(f"✅ Google Sheet read successfully. Rows: {len(df)}")
-        log_message(f"[📄] Columns detected: {list(df.columns)}")
-        return df
+        with timer.span("parse"):
+            rows = list(read_records(values, CURRENT_REPORT, ProgressReport, date_column="Report_Date", dates=dates))
+        log_message(f"✅ Google Sheet read successfully. Rows: {len(rows)}")
+        log_message(f"[📄] Columns detected: {[str(c).strip() for c in values[0]]}")
+        return rows
 
     except Exception as e:
         log_message(f"❌ Failed to read Google Sheet: {e}")
         return None
 
 # ---------------- BUILD EMAIL -----------------
-def build_email(row):
-    return f"""
+PROGRESS_REPORT_TEMPLATE = Template("""
     <!DOCTYPE html>
     <html>
     <head><meta charset="UTF-8"><title>Student Progress Report</title></head>
@@ -80,22 +90,22 @@ def build_email(row):
         <table width="600" style="background:#fff;border-radius:8px;overflow:hidden;border-collapse:collapse">
 
             <!-- Header Image -->
-            <tr><td><img src="{HEADER_IMAGE_URL}" width="600" style="display:block;width:100%"></td></tr>
+            <tr><td><img src="{{header_image_url}}" width="600" style="display:block;width:100%"></td></tr>
 
             <!-- Student Info -->
             <tr>
                 <td style="padding:20px;text-align:center;background:#f9fafb">
                     <h2 style="margin:0">Student Progress Report</h2>
-                    <p style="margin:6px 0 0; font-size:14px; color:#7f8c8d;">{row.get('Course_Month','')} {row.get('Course_Year','')}</p>
+                    <p style="margin:6px 0 0; font-size:14px; color:#7f8c8d;">{{course_month}} {{course_year}}</p>
                 </td>
             </tr>
 
             <tr><td style="padding:20px">
                 <table width="100%" cellpadding="8" cellspacing="0" style="border-collapse:collapse">
-                    <tr><td style="background:#eef2f5"><strong>Student Name</strong></td><td>{row.get('Student_Name','')}</td></tr>
-                    <tr><td style="background:#eef2f5"><strong>Course</strong></td><td>{row.get('Course','')}</td></tr>
-                    <tr><td style="background:#eef2f5"><strong>Level</strong></td><td>{row.get('Level','')}</td></tr>
-                    <tr><td style="background:#eef2f5"><strong>Teacher</strong></td><td>{row.get('Teacher','')}</td></tr>
+                    <tr><td style="background:#eef2f5"><strong>Student Name</strong></td><td>{{student_name}}</td></tr>
+                    <tr><td style="background:#eef2f5"><strong>Course</strong></td><td>{{course}}</td></tr>
+                    <tr><td style="background:#eef2f5"><strong>Level</strong></td><td>{{level}}</td></tr>
+                    <tr><td style="background:#eef2f5"><strong>Teacher</strong></td><td>{{teacher}}</td></tr>
                 </table>
             </td></tr>
 
@@ -103,7 +113,7 @@ def build_email(row):
             <tr><td style="padding:20px">
                 <table width="100%" cellpadding="10" cellspacing="0" style="border-collapse:collapse">
                     <tr><td style="background:#34495e; color:#fff"><strong>Cognitive Goals</strong></td></tr>
-                    <tr><td style="border:1px solid #e0e0e0;line-height:1.6">{row.get('Cognitive_Goals','')}</td></tr>
+                    <tr><td style="border:1px solid #e0e0e0;line-height:1.6">{{cognitive_goals}}</td></tr>
                 </table>
             </td></tr>
 
@@ -111,7 +121,7 @@ def build_email(row):
             <tr><td style="padding:20px">
                 <table width="100%" cellpadding="10" cellspacing="0" style="border-collapse:collapse">
                     <tr><td style="background:#34495e; color:#fff"><strong>Teacher's Comments</strong></td></tr>
-                    <tr><td style="border:1px solid #e0e0e0;line-height:1.6">{row.get("Teacher's_Comments",'')}</td></tr>
+                    <tr><td style="border:1px solid #e0e0e0;line-height:1.6">{{teachers_comments}}</td></tr>
                 </table>
             </td></tr>
 
@@ -119,17 +129,17 @@ def build_email(row):
             <tr><td style="padding:20px">
                 <table width="100%" cellpadding="10" cellspacing="0" style="border-collapse:collapse">
                     <tr><td style="background:#34495e; color:#fff"><strong>General Comment</strong></td></tr>
-                    <tr><td style="border:1px solid #e0e0e0;line-height:1.6">{row.get('General_Comment','')}</td></tr>
+                    <tr><td style="border:1px solid #e0e0e0;line-height:1.6">{{general_comment}}</td></tr>
                 </table>
             </td></tr>
 
             <!-- Footer -->
             <tr><td style="padding:20px;text-align:center;font-size:13px;color:#7f8c8d">
-                Report Date: {row.get('Report_Date','')}<br>
+                Report Date: {{report_date}}<br>
             </td></tr>
 
             <!-- Footer Image -->
-            <tr><td><img src="{FOOTER_IMAGE_URL}" width="600" style="display:block;width:100%"></td></tr>
+            <tr><td><img src="{{footer_image_url}}" width="600" style="display:block;width:100%"></td></tr>
 
         </table>
 
@@ -138,63 +148,169 @@ def build_email(row):
 
     </body>
     </html>
-    """
+    """)
 
-# ---------------- SEND EMAIL -----------------
-def send_email(to_email, teacher_email, subject, body):
-    try:
-        msg = MIMEMultipart()
-        msg["From"] = f"New Dimension Academy <{EMAIL_USER}>"
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "html"))
+def build_email(row):
+    return PROGRESS_REPORT_TEMPLATE.render(dict(
+        header_image_url  = HEADER_IMAGE_URL,
+        footer_image_url  = FOOTER_IMAGE_URL,
+        course_month      = row.get('Course_Month', ''),
+        course_year       = row.get('Course_Year', ''),
+        student_name      = row.get('Student_Name', ''),
+        course            = row.get('Course', ''),
+        level             = row.get('Level', ''),
+        teacher           = row.get('Teacher', ''),
+        cognitive_goals   = row.get('Cognitive_Goals', ''),
+        teachers_comments = row.get("Teacher's_Comments", ''),
+        general_comment   = row.get('General_Comment', ''),
+        report_date       = row.get('Report_Date', ''),
+    ))
 
-        bcc_list = ["alhuraibia@gmail.com", "dalmaznaee@gmail.com"]
-        if teacher_email.strip():
-            bcc_list.append(teacher_email)
+# ---------------- SEND EMAIL -----------------
+def build_report_message(to_email, teacher_email, subject, body):
+    return REPORT_MESSAGE.build(to_email, subject, body, bcc=[] if DIGEST_MODE else [teacher_email])
 
-        recipients = [to_email] + bcc_list
-        msg["Bcc"] = ", ".join(bcc_list)
+def send_email(to_email, teacher_email, subject, body, summary=None):
+    try:
+        message = build_report_message(to_email, teacher_email, subject, body)
 
-        context = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
-        context.login(EMAIL_USER, EMAIL_PASSWORD)
-        context.sendmail(EMAIL_USER, recipients, msg.as_string())
-        context.quit()
+        sender = get_sender(EMAIL_USER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT)
+        elapsed = sender.send_message(message)
 
-        log_message(f"✅ Email sent → TO: {to_email} | BCC: {', '.join(bcc_list)}")
+        log_message(
+            f"✅ Email sent → TO: {to_email} | BCC: {', '.join(message.recipients[1:])} "
+            f"({elapsed * 1000:.0f} ms)"
+        )
+        if DIGEST_MODE:
+            digest.add(summary or dict(Email=to_email), teacher=teacher_email)
+        return True
     except Exception as e:
         log_message(f"❌ Failed to send email to {to_email}: {e}")
+        raise  # dispatch records the reason in the outbox
+
+# ---------------- ADMIN / TEACHER DIGEST -----------------
+def send_digest():
+    sender = get_sender(EMAIL_USER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT)
+    return digest.send(sender.send_message)
+
+# ---------------- COMPOSE REPORTS -----------------
+def report_key(row, date_str):
+    return message_key(
+        f"{SPREADSHEET_ID}/{RANGE_NAME}",
+        (row.get("Student_Email",''), row.get("Student_Name",''), row.get("Course",''),
+         row.get("Course_Month",''), row.get("Course_Year",'')),
+        "email",
+        date_str
+    )
+
+def build_report(row):
+    """row -> (recipient, outbox payload)"""
+    with timer.span("render"):
+        email_body = build_email(row)
+    subject = f"{row.get('Course_Month','')} {row.get('Course_Year','')} {row.get('Course','')} Progress Report for {row.get('Student_Name','')}"
+
+    return row.get("Student_Email",''), dict(
+        to_email=row.get("Student_Email",''),
+        teacher_email=row.get("Teacher_Email",''),
+        subject=subject,
+        body=email_body,
+        summary=dict(
+            Student=row.get("Student_Name", ''),
+            Email=row.get("Student_Email", ''),
+            Course=row.get("Course", ''),
+            Level=row.get("Level", ''),
+            Teacher=row.get("Teacher", ''),
+            Month=f"{row.get('Course_Month', '')} {row.get('Course_Year', '')}",
+        )
+    )
 
-# ---------------- PROCESS REPORTS -----------------
-def process_reminders():
-    df = read_google_sheet()
-    if df is None:
+def compose_reports(outbox, today_str):
+    rows = read_google_sheet(dates=[today_str])
+    if rows is None:
         log_message("No data to process")
-        return
+        return None
 
-    today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    log_message(f"📅 Processing reports for {today_str}")
+    # Rendered the evening before by `Progress_Report.py prepare`, if it ran
+    prepared = PreparedMessages(outbox, OUTBOX_JOB, today_str, PREPARE_VERSION)
 
-    sent_count = 0
-    for _, row in df.iterrows():
-        report_date = str(row.get("Report_Date",'')).split(" ")[0]
-        if report_date != today_str:
+    queued = 0
+    for row in rows:
+        key = report_key(row, today_str)
+        if outbox.has(key):
             continue
 
-        log_message(f"📨 Sending report to {row.get('Student_Email','')}")
-        email_body = build_email(row)
-        subject = f"{row.get('Course_Month','')} {row.get('Course_Year','')} {row.get('Course','')} Progress Report for {row.get('Student_Name','')}"
+        log_message(f"📨 Queuing report for {row.get('Student_Email','')}")
+        if prepared.take(key, row):
+            queued += 1
+            continue
 
-        send_email(
-            to_email=row.get("Student_Email",''),
-            teacher_email=row.get("Teacher_Email",''),
-            subject=subject,
-            body=email_body
-        )
-        sent_count += 1
+        recipient, payload = build_report(row)
+        queued += outbox.enqueue(key, OUTBOX_JOB, "email", recipient, payload, send_date=today_str)
+
+    prepared.log()
+    log_message(f"📝 Reports queued: {queued}")
+    return queued
+
+# ---------------- PREPARE AHEAD -----------------
+def prepare_reports(days, today_str=None):
+    """Render the next `days` days of reports into the outbox's prepared table; nothing is queued."""
+    today_str = today_str or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    dates = lookahead_dates(today_str, days)
+    log_message(f"🗓️ Preparing reports for {', '.join(dates)}")
+
+    rows = read_google_sheet(dates=dates)
+    if rows is None:
+        return 0
+    with timer.span("prepare"):
+        return prepare_rows(Outbox(), OUTBOX_JOB, "email", rows, "Report_Date", PREPARE_VERSION, report_key, build_report)
+
+# ---------------- PROCESS REPORTS -----------------
+def process_reminders(compose=True, send=True):
+    today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    log_message(f"📅 Processing reports for {today_str}")
 
-    log_message(f"🎉 Completed. Emails sent: {sent_count}")
+    outbox = Outbox()
+    summary = None
+    if compose:
+        compose_reports(outbox, today_str)
+
+    if send:
+        summary = outbox.drain(OUTBOX_JOB, dispatch_batch("email", send_email), send_date=today_str)
+        timer.observe_results("send", summary.results)
+        summary.log()
+        log_message(f"🎉 Completed. Emails sent: {summary.sent}")
+        if DIGEST_MODE:
+            send_digest()
+
+    log_outbox(outbox, OUTBOX_JOB)
+    return summary
+
+# ---------------- RENDER ONLY -----------------
+def render_reports(args) -> int:
+    """Compose the reports for args.date and write them to args.out as .eml files; nothing is sent."""
+    log_message(f"📅 Rendering reports for {args.date} → {args.out}")
+    if args.sheet_json:
+        load_sheet_json(args.sheet_json, SPREADSHEET_ID, RANGE_NAME)
+
+    def build(entry):
+        p = entry.payload
+        s = p.get("summary") or {}
+        # Siblings share an email address; the student and message key keep their files apart
+        name = f"Report_{p['to_email']}_{s.get('Student', '')}_{s.get('Course', '')}_{s.get('Month', '')}_{entry.key[:8]}"
+        return name, build_report_message(p["to_email"], p["teacher_email"], p["subject"], p["body"])
+
+    outbox = render_outbox()
+    compose_reports(outbox, args.date)
+    return write_rendered(outbox, OUTBOX_JOB, args.out, build)
 
 # ---------------- MAIN -----------------
 if __name__ == "__main__":
-    process_reminders()
+    if is_render_mode(sys.argv):
+        render_reports(parse_render_args(sys.argv, OUTBOX_JOB))
+        write_run_metrics(f"{OUTBOX_JOB}_render")
+    elif is_prepare_mode(sys.argv):
+        prepare_reports(parse_prepare_args(sys.argv).days)
+        write_run_metrics(f"{OUTBOX_JOB}_prepare")
+    else:
+        process_reminders(*run_mode(sys.argv))
+        write_run_metrics(OUTBOX_JOB)
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmark with local stand-ins.
+
+Runs the real job entry points (process_reminders / process_invoices, as
+listed in runner.JOBS) against local stand-ins for every external service:
+
+  - Google Sheets / Drive  synthetic Time_Table, Time_Table_2,
+                           Current_Report and Invoices tabs
+  - SMTP                   sink that accepts and discards every message
+  - Twilio                 Messages endpoint
+  - WhatsApp Graph API     messages endpoint
+
+The SMTP, Twilio and Graph stand-ins add a fixed latency per request. A
+configurable fraction of their requests fails with a throttling error.
+Each scenario runs in a fresh interpreter, so its timings and peak RSS are
+not affected by the stand-ins or by the other scenarios.
+
+Usage:
+    python benchmark.py                                  # every job
+    python benchmark.py invoices --invoices 2000
+    python benchmark.py sms_reminders --latency-ms 50 --error-rate 0.02
+    python benchmark.py --output after.json --compare before.json
+
+--output writes the results as JSON, together with the commit, the
+machine and the parameters. --compare prints the change against an
+earlier result file, so runs on different commits can be compared.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import socketserver
+import urllib.parse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from runner import JOBS
+from utils import log_message
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ---------------- DEFAULTS -----------------
+DEFAULT_REMINDERS = 5000
+DEFAULT_REPORTS = 500
+DEFAULT_INVOICES = 2000
+DEFAULT_LATENCY_MS = 5.0
+DEFAULT_SEED = 1234
+
+
+# ---------------- STAND-IN BASE -----------------
+class StandIn:
+    """Shared latency / error injection and request counters for one stand-in."""
+
+    def __init__(self, name, latency_ms=0.0, error_rate=0.0, seed=DEFAULT_SEED):
+        self.name = name
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def hit(self) -> bool:
+        """Count a request, wait the configured latency; True if it should fail."""
+        with self._lock:
+            self.requests += 1
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return fail
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors}
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standin = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing pooled keep-alive connections is expected, not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _serve(handler_cls, standin) -> _HTTPServer:
+    handler = type(handler_cls.__name__, (handler_cls,), {"standin": standin})
+    server = _HTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _url(server) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+# ---------------- SHEETS / DRIVE STAND-IN -----------------
+A1_PART_RE = re.compile(r"^([A-Z]*)(\d*)$")
+
+
+def _col_index(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n - 1
+
+
+def slice_a1(grid: list, range_name: str) -> list:
+    """Apply an A1 range such as "Tab", "Tab!1:1", "Tab!C2:C" or "Tab!A5:H9" to a grid."""
+    if "!" not in range_name:
+        return grid
+    a1 = range_name.split("!", 1)[1]
+    start, _, end = a1.partition(":")
+    end = end or start
+    c1, r1 = A1_PART_RE.match(start).groups()
+    c2, r2 = A1_PART_RE.match(end).groups()
+    row_lo = int(r1) - 1 if r1 else 0
+    row_hi = int(r2) if r2 else len(grid)
+    col_lo = _col_index(c1) if c1 else 0
+    col_hi = _col_index(c2) + 1 if c2 else None
+    return [row[col_lo:col_hi] for row in grid[row_lo:row_hi]]
+
+
+class SheetsHandler(_QuietHandler):
+    """Serves values.get, values:batchGet and Drive files.get (version only)."""
+
+    def _values(self, range_name):
+        tab = range_name.split("!", 1)[0]
+        grid = self.standin.tabs.get(tab, [])
+        return {"range": range_name, "majorDimension": "ROWS", "values": slice_a1(grid, range_name)}
+
+    def do_GET(self, query_string=None):
+        self.standin.hit()
+        parsed = urllib.parse.urlparse(self.path)
+        path = urllib.parse.unquote(parsed.path)
+        query = urllib.parse.parse_qs(parsed.query if query_string is None else query_string)
+
+        if path.startswith("/files/"):
+            return self._reply(200, {"version": self.standin.revision})
+        if path.endswith("/values:batchGet"):
+            ranges = query.get("ranges", [])
+            return self._reply(200, {"valueRanges": [self._values(r) for r in ranges]})
+        if "/values/" in path:
+            return self._reply(200, self._values(path.split("/values/", 1)[1]))
+        self._reply(404, {"error": {"code": 404, "message": f"unknown path {path}"}})
+
+    def do_POST(self):
+        # The client sends long GET requests (many ranges) as POST + X-HTTP-Method-Override
+        body = self._body().decode("utf-8")
+        if self.headers.get("X-HTTP-Method-Override", "").upper() == "GET":
+            return self.do_GET(body)
+        self._reply(405, {"error": {"code": 405, "message": "method not allowed"}})
+
+
+# ---------------- TWILIO STAND-IN -----------------
+class TwilioHandler(_QuietHandler):
+    def do_POST(self):
+        form = urllib.parse.parse_qs(self._body().decode("utf-8"))
+        if self.standin.hit():
+            return self._reply(429, {"code": 20429, "message": "Too Many Requests", "status": 429})
+        sid = f"SM{random.getrandbits(128):032x}"
+        self._reply(201, {
+            "sid": sid,
+            "status": "queued",
+            "to": form.get("To", [""])[0],
+            "from": form.get("From", [""])[0],
+            "body": form.get("Body", [""])[0],
+            "num_segments": "1",
+        })
+
+
+# ---------------- GRAPH API STAND-IN -----------------
+class GraphHandler(_QuietHandler):
+    def do_POST(self):
+        payload = json.loads(self._body() or b"{}")
+        usage = {"X-App-Usage": json.dumps({"call_count": 10, "total_cputime": 5, "total_time": 5})}
+        if self.standin.hit():
+            return self._reply(
+                429,
+                {"error": {"code": 130429, "message": "Rate limit hit"}},
+                dict(usage, **{"Retry-After": "0"}),
+            )
+        self._reply(200, {
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": payload.get("to", ""), "wa_id": payload.get("to", "")}],
+            "messages": [{"id": f"wamid.{random.getrandbits(64):016x}"}],
+        }, usage)
+
+
+# ---------------- SMTP SINK -----------------
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    standin = None
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 bench-smtp ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode("ascii", "replace").strip().split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-bench-smtp\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "AUTH":
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk == b".\r\n":
+                        break
+                if self.standin.hit():
+                    self.reply("451 4.3.0 Temporary failure, try again later")
+                else:
+                    self.reply("250 2.0.0 Queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _serve_smtp(standin) -> _SMTPServer:
+    handler = type("SMTPSinkHandler", (SMTPSinkHandler,), {"standin": standin})
+    server = _SMTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------------- SYNTHETIC DATA -----------------
+def build_tabs(reminders: int, reports: int, invoices: int, seed: int) -> dict:
+    """Synthetic sheet tabs. Half as many rows again fall on other days, to exercise date filtering."""
+    rng = random.Random(seed)
+    local_today = datetime.now().strftime("%Y-%m-%d")
+    utc_today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    other_day = "2020-01-01"
+
+    courses = ["Math", "Science", "English", "French", "Coding", "Arabic"]
+    sessions = ["9:00 AM", "11:00 AM", "4:00 PM", "6:30 PM"]
+    months = ["January", "February", "March", "April", "May", "June"]
+
+    def mixed(count):
+        # (is_today, index) for `count` today rows plus count // 2 rows on other days
+        flags = [True] * count + [False] * (count // 2)
+        rng.shuffle(flags)
+        return list(enumerate(flags))
+
+    time_table = [[
+        "Reminder_Date", "Customer", "Email", "Phone", "Course", "Session",
+        "Teacher_Email", "Zoom_link", "Meeting_id", "Passcode", "Message",
+    ]]
+    for i, today in mixed(reminders):
+        time_table.append([
+            local_today if today else other_day,
+            f"Customer {i}",
+            f"customer{i}@bench.invalid",
+            f"+1555{i:07d}",
+            rng.choice(courses),
+            rng.choice(sessions),
+            f"teacher{i % 40}@bench.invalid",
+            f"https://zoom.invalid/j/{100000 + i}",
+            str(100000 + i),
+            f"pc{i % 997}",
+            "Please join five minutes early.",
+        ])
+
+    current_report = [[
+        "Report_Date", "Student_Email", "Student_Name", "Course", "Level", "Teacher",
+        "Teacher_Email", "Course_Month", "Course_Year", "Cognitive_Goals",
+        "General_Comment", "Teacher's_Comments",
+    ]]
+    for i, today in mixed(reports):
+        current_report.append([
+            utc_today if today else other_day,
+            f"student{i}@bench.invalid",
+            f"Student {i}",
+            rng.choice(courses),
+            f"Level {1 + i % 5}",
+            f"Teacher {i % 40}",
+            f"teacher{i % 40}@bench.invalid",
+            rng.choice(months),
+            "2026",
+            "Reads fluently; solves two-step problems.",
+            "Steady progress this month.",
+            "Keep practising at home.",
+        ])
+
+    invoice_rows = [[
+        "Invoice Date", "Invoice Number", "Customer Email", "Customer Mobile No.",
+        "Student", "Service Month", "Service Year", "Course_", "Course Type", "Level",
+        "Teacher", "COUNT of Class No", "Rate", "Amount", "Amount after Discount",
+        "Discount Type 1",
+    ]]
+    for i, today in mixed(invoices):
+        for line in range(rng.randint(1, 4)):
+            classes = rng.randint(2, 8)
+            rate = rng.choice([25, 30, 35, 40])
+            amount = classes * rate
+            discounted = amount * (0.9 if i % 5 == 0 else 1.0)
+            invoice_rows.append([
+                utc_today if today else other_day,
+                f"INV-{i:06d}",
+                f"family{i}@bench.invalid",
+                f"+1555{i:07d}",
+                f"Student {i}",
+                str(1 + i % 12),
+                "2026",
+                courses[line % len(courses)],
+                "Group" if line % 2 else "Private",
+                f"Level {1 + line}",
+                f"Teacher {line}",
+                str(classes),
+                f"${rate:.2f}",
+                f"${amount:,.2f}",
+                f"${discounted:,.2f}",
+                "Sibling discount" if i % 5 == 0 else "",
+            ])
+
+    return {
+        "Time_Table": time_table,
+        "Time_Table_2": time_table,
+        "Current_Report": current_report,
+        "Invoices": invoice_rows,
+    }
+
+
+# ---------------- METRICS -----------------
+def percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of `values` (0 when empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+# ---------------- CHILD: ONE SCENARIO -----------------
+def run_child(job: str, result_file: str):
+    """Runs inside the scenario interpreter: execute the job and write its metrics."""
+    import resource
+    import importlib
+    import metrics
+
+    module_name, func_name = JOBS[job]
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    summary = getattr(module, func_name)(True, True)
+    wall = time.perf_counter() - started
+
+    results = summary.results if summary is not None else []
+    latencies = [r.elapsed * 1000 for r in results]
+    sent = sum(1 for r in results if r.ok)
+
+    result = {
+        "sent": sent,
+        "failed": len(results) - sent,
+        "wall_s": round(wall, 3),
+        "msgs_per_s": round(sent / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+    if job == "invoices":
+        result["pdf_rendering"] = module.load_weasyprint() is not None
+    # Per-stage p50 / p99 from the run's own instrumentation
+    result["stages"] = {
+        f"{component}.{stage}": {k: h[k] for k in ("count", "p50_ms", "p99_ms")}
+        for component, stages in metrics.snapshot()["stages"].items()
+        for stage, h in stages.items()
+    }
+
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+# ---------------- PARENT: ORCHESTRATION -----------------
+def _scenario_env(args, urls, workdir) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_DIR + os.pathsep + env.get("PYTHONPATH", ""),
+        "GOOGLE_API_ENDPOINT": urls["sheets"] + "/",
+        "SHEETS_CACHE_DIR": os.path.join(workdir, "sheets_cache"),
+        "OUTBOX_DB": os.path.join(workdir, "outbox.sqlite3"),
+        "SENDER_USAGE_DB": os.path.join(workdir, "senders.sqlite3"),
+        "ASSET_CACHE_DIR": os.path.join(workdir, "asset_cache"),
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(urls["smtp_port"]),
+        "SMTP_USE_SSL": "0",
+        "EMAIL_USER": "bench@bench.invalid",
+        "EMAIL_PASSWORD": "bench",
+        "EMAIL_ACCOUNTS": ",".join(f"bench{i}@bench.invalid:bench" for i in range(1, args.email_accounts)),
+        "EMAIL_MINUTE_LIMIT": str(args.email_minute_limit),
+        "TWILIO_API_BASE": urls["twilio"],
+        "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "bench",
+        "TWILIO_FROM_NUMBER": "+15550000000",
+        "TWILIO_MPS": str(args.twilio_mps),
+        "WHATSAPP_API_BASE": urls["graph"],
+        "WHATSAPP_TOKEN": "bench",
+        "WHATSAPP_PHONE_NUMBER_ID": "1000000000",
+        "SERVICE_ACCOUNT_JSON": "e30=",
+        "HEADER_IMAGE_URL": "",
+        "HEADER_IMAGE_URL2": "",
+        "FOOTER_IMAGE_URL": "",
+    })
+    return env
+
+
+def run_benchmark(args) -> dict:
+    tabs = build_tabs(args.reminders, args.reports, args.invoices, args.seed)
+
+    sheets = StandIn("sheets", latency_ms=args.sheets_latency_ms, seed=args.seed)
+    sheets.tabs = tabs
+    smtp = StandIn("smtp", args.latency_ms, args.error_rate, args.seed)
+    twilio = StandIn("twilio", args.latency_ms, args.error_rate, args.seed)
+    graph = StandIn("graph", args.latency_ms, args.error_rate, args.seed)
+
+    servers = [
+        _serve(SheetsHandler, sheets),
+        _serve(TwilioHandler, twilio),
+        _serve(GraphHandler, graph),
+        _serve_smtp(smtp),
+    ]
+    urls = {
+        "sheets": _url(servers[0]),
+        "twilio": _url(servers[1]),
+        "graph": _url(servers[2]),
+        "smtp_port": servers[3].server_address[1],
+    }
+    standins = (sheets, smtp, twilio, graph)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": {
+            "reminders": args.reminders,
+            "reports": args.reports,
+            "invoices": args.invoices,
+            "latency_ms": args.latency_ms,
+            "sheets_latency_ms": args.sheets_latency_ms,
+            "error_rate": args.error_rate,
+            "twilio_mps": args.twilio_mps,
+            "email_accounts": args.email_accounts,
+            "email_minute_limit": args.email_minute_limit,
+            "seed": args.seed,
+        },
+        "scenarios": {},
+    }
+
+    try:
+        for job in args.jobs:
+            # Fresh revision per scenario: every run starts with a cold sheet cache
+            sheets.revision = f"{int(time.time() * 1000)}"
+            before = {s.name: s.snapshot() for s in standins}
+
+            with tempfile.TemporaryDirectory(prefix=f"bench-{job}-") as workdir:
+                result_file = os.path.join(workdir, "result.json")
+                log_file = os.path.join(args.log_dir, f"{job}.log") if args.log_dir else os.devnull
+                log_message(f"⏱️  {job} ...")
+                with open(log_file, "w", encoding="utf-8") as log:
+                    proc = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "--child", job, "--result-file", result_file],
+                        cwd=workdir,
+                        env=_scenario_env(args, urls, workdir),
+                        stdout=log,
+                        stderr=subprocess.STDOUT,
+                    )
+                if proc.returncode != 0 or not os.path.exists(result_file):
+                    log_message(f"❌ {job} failed (exit {proc.returncode}); see --log-dir output")
+                    report["scenarios"][job] = {"error": f"exit {proc.returncode}"}
+                    continue
+                with open(result_file, encoding="utf-8") as f:
+                    metrics = json.load(f)
+
+            metrics["requests"] = {
+                s.name: s.snapshot()["requests"] - before[s.name]["requests"] for s in standins
+            }
+            metrics["injected_errors"] = sum(
+                s.snapshot()["errors"] - before[s.name]["errors"] for s in standins
+            )
+            report["scenarios"][job] = metrics
+            log_scenario(job, metrics)
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    return report
+
+
+def log_scenario(job: str, m: dict):
+    extra = "" if m.get("pdf_rendering", True) else " | PDFs skipped (no WeasyPrint)"
+    log_message(
+        f"📊 {job}: {m['sent']} sent, {m['failed']} failed | {m['wall_s']:.2f}s | "
+        f"{m['msgs_per_s']:.1f} msg/s | p50 {m['p50_ms']:.1f} ms | p99 {m['p99_ms']:.1f} ms | "
+        f"peak RSS {m['peak_rss_mb']:.0f} MB{extra}"
+    )
+
+
+def compare(report: dict, baseline: dict):
+    """Log per-scenario changes against an earlier result file."""
+    if baseline.get("params") != report.get("params"):
+        log_message("⚠️ Parameters differ from the baseline; numbers are not directly comparable.")
+    log_message(f"🔁 {baseline.get('commit', '?')} → {report.get('commit', '?')}")
+
+    def delta(old, new):
+        if not old:
+            return f"{new}"
+        return f"{old} → {new} ({(new - old) / old * 100:+.1f}%)"
+
+    for job, new in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(job)
+        if not old or "error" in old or "error" in new:
+            continue
+        log_message(
+            f"   {job}: msg/s {delta(old['msgs_per_s'], new['msgs_per_s'])} | "
+            f"p50 {delta(old['p50_ms'], new['p50_ms'])} | p99 {delta(old['p99_ms'], new['p99_ms'])} | "
+            f"RSS {delta(old['peak_rss_mb'], new['peak_rss_mb'])}"
+        )
+
+
+# ---------------- MAIN -----------------
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark with local stand-ins.")
+    parser.add_argument("jobs", nargs="*", help=f"jobs to benchmark (default: all of {', '.join(JOBS)})")
+    parser.add_argument("--reminders", type=int, default=DEFAULT_REMINDERS, help="reminder rows dated today")
+    parser.add_argument("--reports", type=int, default=DEFAULT_REPORTS, help="progress reports dated today")
+    parser.add_argument("--invoices", type=int, default=DEFAULT_INVOICES, help="invoices dated today")
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_LATENCY_MS,
+                        help="latency added to each SMTP / Twilio / Graph request")
+    parser.add_argument("--sheets-latency-ms", type=float, default=DEFAULT_LATENCY_MS,
+                        help="latency added to each Sheets / Drive request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of SMTP / Twilio / Graph requests that fail with a throttling error")
+    parser.add_argument("--twilio-mps", type=float, default=10000.0,
+                        help="TWILIO_MPS for the run (the real account limit would dominate otherwise)")
+    parser.add_argument("--email-accounts", type=int, default=1,
+                        help="sender accounts to rotate over (EMAIL_ACCOUNTS)")
+    parser.add_argument("--email-minute-limit", type=int, default=0,
+                        help="EMAIL_MINUTE_LIMIT per account (0 = no cap)")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="earlier JSON result file to compare against")
+    parser.add_argument("--log-dir", help="keep each scenario's script output here")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = [j for j in args.jobs if j not in JOBS]
+    if unknown:
+        parser.error(f"unknown job(s): {', '.join(unknown)}")
+    args.jobs = args.jobs or list(JOBS)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.child:
+        run_child(args.child, args.result_file)
+        sys.exit(0)
+
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+    report = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        log_message(f"💾 Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+    sys.exit(1 if any("error" in m for m in report["scenarios"].values()) else 0)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Import-time budget for the automation scripts.
+
+Imports each script in a fresh interpreter and checks two things:
+  - the import finishes within IMPORT_BUDGET_MS (best of IMPORT_RUNS runs)
+  - none of the heavy libraries (pandas, Google client, Twilio, aiohttp,
+    WeasyPrint) are loaded yet; they must only be imported on first use
+
+Usage (also run in CI by .github/workflows/startup_budget.yml):
+    python check_startup.py            # check every script
+    python check_startup.py main       # check selected scripts
+
+Exits non-zero if any script is over budget or imports a heavy library.
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+from utils import log_message
+
+# ---------------- BUDGET -----------------
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "400"))
+IMPORT_RUNS = int(os.getenv("IMPORT_RUNS", "3"))
+
+SCRIPTS = ["main", "sms_reminder", "whatsapp_reminder", "Progress_Report", "Invoice_Automation"]
+
+HEAVY_MODULES = [
+    "pandas",
+    "numpy",
+    "googleapiclient",
+    "google.oauth2",
+    "twilio",
+    "requests",
+    "aiohttp",
+    "weasyprint",
+]
+
+# Placeholder credentials: importing a script must not need real secrets
+DUMMY_ENV = {
+    "SERVICE_ACCOUNT_JSON": "e30=",  # base64 of "{}"
+    "TWILIO_ACCOUNT_SID": "AC00000000000000000000000000000000",
+    "TWILIO_AUTH_TOKEN": "dummy",
+    "TWILIO_FROM_NUMBER": "+10000000000",
+}
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"ms": elapsed * 1000, "heavy": heavy}}))
+"""
+
+
+# ---------------- MEASURE -----------------
+def measure(module: str) -> dict:
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    for name, value in DUMMY_ENV.items():
+        env.setdefault(name, value)
+
+    runs = []
+    for _ in range(IMPORT_RUNS):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=here,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return min(runs, key=lambda r: r["ms"])
+
+
+def main(argv) -> int:
+    failures = 0
+    for module in argv[1:] or SCRIPTS:
+        try:
+            result = measure(module)
+        except subprocess.CalledProcessError as e:
+            log_message(f"❌ {module}: import failed\n{e.stderr}")
+            failures += 1
+            continue
+
+        problems = []
+        if result["ms"] > IMPORT_BUDGET_MS:
+            problems.append(f"over budget ({IMPORT_BUDGET_MS:.0f} ms)")
+        if result["heavy"]:
+            problems.append(f"eagerly imports {', '.join(result['heavy'])}")
+
+        if problems:
+            failures += 1
+            log_message(f"❌ {module}: {result['ms']:.0f} ms — {'; '.join(problems)}")
+        else:
+            log_message(f"✅ {module}: {result['ms']:.0f} ms")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
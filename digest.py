@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+End-of-run digests for admins and teachers (DIGEST_MODE=1).
+
+Without digests, every student email carries BCC copies: the admins get
+every reminder, report and invoice, and teachers get their students'
+reminders and reports. Each copy counts against the Gmail recipient quota.
+
+In digest mode, a student email goes only to the customer. Each message
+that is sent successfully is recorded in the job's Digest. At the end of
+the run, every admin and teacher gets one email with a summary table of
+what went out. With DIGEST_ATTACH_PDFS=1, that email also includes a zip
+of the invoice PDFs.
+
+A digest covers the messages sent by the current run. If a run is
+interrupted, its digest is lost, but the student messages still go out.
+"""
+
+import io
+import os
+import html
+import zipfile
+import threading
+from datetime import datetime
+
+from dispatch import DispatchSummary, dispatch
+from mime import MessageTemplate
+from templates import Template
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+DIGEST_MODE = os.getenv("DIGEST_MODE", "0") == "1"
+DIGEST_ATTACH_PDFS = os.getenv("DIGEST_ATTACH_PDFS", "0") == "1"
+
+# ---------------- TEMPLATES -----------------
+DIGEST_TEMPLATE = Template("""
+    <!DOCTYPE html>
+    <html>
+    <head><meta charset="UTF-8"><title>{{title}}</title></head>
+    <body style="margin:0;padding:24px;background:#f4f6f8;font-family:Arial,sans-serif">
+        <h2 style="margin:0 0 6px;color:#1a3c5e">{{title}}</h2>
+        <p style="margin:0 0 16px;color:#555555;font-size:14px">{{intro}}</p>
+        <table cellpadding="0" cellspacing="0" style="border-collapse:collapse;background:#ffffff;font-size:13px">
+            <tr style="background:#1a3c5e;color:#ffffff">{{head}}</tr>
+            {{rows}}
+        </table>
+    </body>
+    </html>""")
+
+HEAD_CELL_TEMPLATE = Template("""
+                <th style="padding:8px 10px;border:1px solid #1a3c5e;text-align:left">{{name}}</th>""")
+
+ROW_TEMPLATE = Template("""
+            <tr style="background:{{bg}}">{{cells}}
+            </tr>""")
+
+CELL_TEMPLATE = Template("""
+                <td style="padding:8px 10px;border:1px solid #e8ecef">{{value}}</td>""")
+
+
+# ---------------- DIGEST -----------------
+class Digest:
+    """Collects what one job sent during the run and mails it as one digest per admin / teacher."""
+
+    def __init__(self, job: str, title: str, columns, from_addr: str, admins=()):
+        self.job = job
+        self.title = title
+        self.columns = list(columns)
+        self.admins = [a for a in admins if a]
+        self.message = MessageTemplate(from_addr)
+        self._items = []  # (row dict, teacher email, (filename, bytes) | None)
+        self._lock = threading.Lock()
+
+    def add(self, row: dict, teacher: str = "", attachment=None):
+        """Record one sent message; `attachment` is a (filename, bytes) pair for the zip."""
+        with self._lock:
+            self._items.append((row, str(teacher or "").strip(), attachment))
+
+    def recipients(self) -> dict:
+        """digest recipient -> items: admins get every item, teachers only their own."""
+        with self._lock:
+            items = list(self._items)
+        out = {admin: items for admin in self.admins}
+        for item in items:
+            teacher = item[1]
+            if teacher and teacher not in self.admins:
+                out.setdefault(teacher, []).append(item)
+        return out
+
+    def build_html(self, items) -> str:
+        return DIGEST_TEMPLATE.render(dict(
+            title = html.escape(self.title),
+            intro = f"{len(items)} message(s) sent on {datetime.now().strftime('%Y-%m-%d')}.",
+            head  = HEAD_CELL_TEMPLATE.render_many(dict(name=html.escape(c)) for c in self.columns),
+            rows  = ROW_TEMPLATE.render_many(
+                dict(
+                    bg    = "#f9fafb" if i % 2 == 0 else "#ffffff",
+                    cells = CELL_TEMPLATE.render_many(
+                        dict(value=html.escape(str(row.get(c, "")))) for c in self.columns
+                    ),
+                )
+                for i, (row, _, _) in enumerate(items)
+            ),
+        ))
+
+    @staticmethod
+    def build_zip(items) -> bytes | None:
+        files = [attachment for _, _, attachment in items if attachment and attachment[1]]
+        if not files:
+            return None
+        buf = io.BytesIO()
+        # PDFs are already compressed; storing them keeps the zip cheap to build
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+            for filename, data in files:
+                zf.writestr(filename, data)
+        return buf.getvalue()
+
+    def send(self, send_message) -> DispatchSummary | None:
+        """
+        Mail each recipient their digest through `send_message(MimeMessage)`.
+        Returns None when nothing was sent this run.
+        """
+        recipients = self.recipients()
+        if not any(recipients.values()):
+            return None
+
+        subject = f"{self.title} — {datetime.now().strftime('%Y-%m-%d')}"
+
+        def send_one(to_addr, items):
+            attachments = []
+            if DIGEST_ATTACH_PDFS:
+                archive = self.build_zip(items)
+                if archive:
+                    attachments.append((f"{self.job}_{datetime.now().strftime('%Y%m%d')}.zip",
+                                        "application/zip", archive))
+            message = self.message.build(to_addr, f"{subject} ({len(items)})", self.build_html(items), attachments)
+            send_message(message)
+            log_message(f"🗂️  Digest sent → {to_addr} ({len(items)} item(s))")
+
+        summary = dispatch(
+            "email",
+            [(addr, dict(to_addr=addr, items=items)) for addr, items in recipients.items() if items],
+            send_one,
+        )
+        log_message(f"🗂️  {self.job} digests: sent {summary.sent} | failed {summary.failed}")
+        return summary
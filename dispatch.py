@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded concurrent dispatch for reminder fan-out.
+
+Sending is almost entirely network wait, so each channel gets a small thread
+pool. A per-channel semaphore caps how many messages are in flight at once,
+even when several jobs dispatch on the same channel. Results come back in the
+order the jobs were submitted.
+"""
+
+import os
+import time
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+
+from resilience import DeliveryUncertain, deadline
+from utils import log_message
+
+# ---------------- CHANNEL LIMITS -----------------
+# Max messages in flight per channel; override with e.g. DISPATCH_MAX_SMS=10
+CHANNEL_LIMITS = {
+    "email": int(os.getenv("DISPATCH_MAX_EMAIL", "2")),
+    "sms": int(os.getenv("DISPATCH_MAX_SMS", "8")),
+    "whatsapp": int(os.getenv("DISPATCH_MAX_WHATSAPP", "8")),
+}
+DEFAULT_LIMIT = 4
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def _channel_semaphore(channel: str) -> threading.BoundedSemaphore:
+    with _semaphores_lock:
+        sem = _semaphores.get(channel)
+        if sem is None:
+            sem = threading.BoundedSemaphore(CHANNEL_LIMITS.get(channel, DEFAULT_LIMIT))
+            _semaphores[channel] = sem
+        return sem
+
+
+# ---------------- TOKEN BUCKET -----------------
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, bursting up to
+    `capacity`. acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# ---------------- RESULTS -----------------
+@dataclass
+class DispatchResult:
+    recipient: str
+    ok: bool
+    error: str = ""
+    elapsed: float = 0.0
+    skipped: bool = False  # not attempted: the run deadline passed first
+    uncertain: bool = False  # failed after the provider may have accepted it; never retried
+
+
+@dataclass
+class DispatchSummary:
+    channel: str
+    results: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def sent(self) -> int:
+        return sum(1 for r in self.results if r.ok)
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for r in self.results if not r.ok and not r.skipped)
+
+    @property
+    def unsent(self) -> int:
+        return sum(1 for r in self.results if r.skipped)
+
+    def log(self):
+        log_message(
+            f"📊 {self.channel}: sent {self.sent} | failed {self.failed} | "
+            + (f"left unsent {self.unsent} | " if self.unsent else "")
+            + f"{self.elapsed:.2f}s"
+        )
+        for r in self.results:
+            if r.uncertain:
+                log_message(f"   ⚠️ {r.recipient}: {r.error} (may have been delivered; not retried)")
+            elif not r.ok and not r.skipped:
+                log_message(f"   ❌ {r.recipient}: {r.error or 'send failed'}")
+
+
+# ---------------- DISPATCH -----------------
+def deadline_skipped(recipient) -> DispatchResult:
+    return DispatchResult(recipient, False, error="run deadline reached", skipped=True)
+
+
+def _run_one(sem, recipient, send_fn, kwargs) -> DispatchResult:
+    with sem:
+        if deadline.expired():
+            return deadline_skipped(recipient)
+        started = time.perf_counter()
+        uncertain = False
+        try:
+            ok = send_fn(**kwargs)
+            error = ""
+        except DeliveryUncertain as e:
+            ok, error, uncertain = False, str(e), True
+        except Exception as e:
+            ok, error = False, str(e)
+        ok = ok is not False
+        if not ok and not uncertain and deadline.expired():
+            # Cut short by the deadline (e.g. a back-off that would outlast it); not a real attempt
+            return deadline_skipped(recipient)
+        return DispatchResult(
+            recipient=recipient,
+            ok=ok,
+            error=error,
+            elapsed=time.perf_counter() - started,
+            uncertain=uncertain,
+        )
+
+
+def dispatch_one(channel: str, recipient, send_fn, kwargs) -> DispatchResult:
+    """
+    One send under the channel's shared in-flight limit, for callers that run
+    their own workers (e.g. the invoice pipeline's send stage).
+    """
+    return _run_one(_channel_semaphore(channel), recipient, send_fn, kwargs)
+
+
+def dispatch(channel: str, jobs, send_fn, max_workers: int | None = None) -> DispatchSummary:
+    """
+    Send every job concurrently through `send_fn(**kwargs)`.
+
+    `jobs` is an iterable of (recipient, kwargs) pairs. `send_fn` may raise
+    or return False to report a failure; DeliveryUncertain marks the result
+    uncertain. The results keep the job order.
+    """
+    jobs = list(jobs)
+    summary = DispatchSummary(channel=channel)
+    if not jobs:
+        return summary
+
+    sem = _channel_semaphore(channel)
+    workers = max_workers or CHANNEL_LIMITS.get(channel, DEFAULT_LIMIT)
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{channel}-send") as pool:
+        futures = [
+            pool.submit(_run_one, sem, recipient, send_fn, kwargs)
+            for recipient, kwargs in jobs
+        ]
+        summary.results = [f.result() for f in futures]
+
+    summary.elapsed = time.perf_counter() - started
+    return summary
@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+"""
+Pooled, persistent SMTP sender.
+
+One SMTPPool keeps a small number of authenticated SMTP_SSL sessions open for
+the whole run instead of doing a TLS handshake + login for every recipient.
+Dropped connections are re-opened transparently on the next send. Every
+session has connect and read timeouts (resilience.timeouts("smtp")), so a
+hung server fails the send instead of stalling the run.
+
+Messages built by mime.MessageTemplate are streamed chunk by chunk inside
+the DATA command (send_message), so a large PDF invoice is never copied
+into one string. Plain string messages take the same MAIL / RCPT / DATA steps
+as smtplib.sendmail. A session found dropped before DATA is reopened and the
+send tried once more. A dropped connection once DATA has been issued is
+raised as DeliveryUncertain instead: the server may already have queued the
+message, so the outbox records it as uncertain and does not resend it.
+
+Several Gmail accounts can share the load (EMAIL_ACCOUNTS). get_sender()
+returns a SenderRotation: it sends each message from the account with the
+most daily headroom. Usage is tracked in a small SQLite store
+(SENDER_USAGE_DB) that carries over between runs on the same day. It lives
+in its own .sender_usage folder, which every email workflow restores from
+and saves to one shared cache key, so the daily limit counts the sends of
+all jobs together. Two email workflows running at the same time each save
+only their own count. An account that
+hits a quota or rate-limit reply is backed off or retired for the day, and
+the message moves on to the next account.
+
+SMTP_SERVER / SMTP_PORT / SMTP_USE_SSL=0 can point the pool at a local
+SMTP sink for benchmarking.
+"""
+
+import os
+import ssl
+import time
+import queue
+import atexit
+import sqlite3
+import smtplib
+import threading
+from datetime import datetime, timezone
+
+from metrics import stage_timer
+from mime import MimeMessage
+from resilience import DeliveryUncertain, deadline, retry_budget, timeouts
+from utils import log_message
+
+# ---------------- EMAIL CONFIG (Gmail) -----------------
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "1") != "0"
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+
+# Sessions idle for longer than this are checked with NOOP before reuse
+SMTP_IDLE_CHECK_SECONDS = 30
+
+# ---------------- SENDER ACCOUNTS -----------------
+# Extra accounts as "user:app password" entries, comma or newline separated.
+# EMAIL_USER is always the first account. The other accounts need EMAIL_USER
+# set up as a "Send mail as" alias, or Gmail rewrites the From header.
+EMAIL_ACCOUNTS = os.getenv("EMAIL_ACCOUNTS", "")
+
+# Recipients per account per UTC day (Google Workspace: 2000, consumer Gmail: 500),
+# and per rolling minute (0 = no per-minute cap)
+EMAIL_DAILY_LIMIT = int(os.getenv("EMAIL_DAILY_LIMIT", "2000"))
+EMAIL_MINUTE_LIMIT = int(os.getenv("EMAIL_MINUTE_LIMIT", "0"))
+
+# Kept apart from the per-job outbox so all email jobs can share it (see the workflows)
+SENDER_USAGE_DB = os.getenv("SENDER_USAGE_DB", os.path.join(".sender_usage", "senders.sqlite3"))
+
+# Back-off for an account that got a rate-limit reply: doubles per hit, capped
+QUOTA_BACKOFF_SECONDS = 60
+QUOTA_BACKOFF_MAX_SECONDS = 15 * 60
+
+# Extra attempts per message once every account has been tried
+QUOTA_RETRY_ROUNDS = 2
+
+timer = stage_timer("smtp")
+
+# Errors that mean the session is gone and a fresh login should be attempted
+RECONNECT_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPConnectError,
+    ConnectionError,
+    ssl.SSLError,
+    OSError,
+)
+
+
+# ---------------- STREAMED DATA -----------------
+def _envelope(server, from_addr, recipients) -> dict:
+    """MAIL / RCPT as smtplib.sendmail() does them; returns the refused recipients."""
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for recipient in recipients:
+        code, resp = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, resp)
+    if len(refused) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+
+def _send_serialized(server, from_addr, recipients, message, on_data) -> dict:
+    """smtplib.sendmail(), calling on_data() right before the DATA command."""
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    refused = _envelope(server, from_addr, recipients)
+    on_data()
+    code, resp = server.data(message)
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _stream_message(server, from_addr, message: MimeMessage, on_data) -> dict:
+    """
+    sendmail() for a chunked message: MAIL / RCPT as usual, then the chunks are
+    written to the socket as they are. They are CRLF-terminated base64 and
+    header lines, so no line starts with "." and no dot-stuffing is needed.
+    on_data() is called right before the DATA command.
+    """
+    refused = _envelope(server, from_addr, message.recipients)
+
+    on_data()
+    code, resp = server.docmd("data")
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in message.chunks:
+        server.send(chunk)
+    server.send(b".\r\n")
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+# ---------------- SINGLE SESSION -----------------
+class _Session:
+    def __init__(self, host, port, user, password):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.server = None
+        self.last_used = 0.0
+        self.data_started = False
+
+    def connect(self):
+        self.close()
+        started = time.perf_counter()
+        connect_timeout, read_timeout = timeouts("smtp")
+        if SMTP_USE_SSL:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=connect_timeout,
+                                      context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=connect_timeout)
+        # Every later command, including each DATA chunk, gets the read timeout
+        server.sock.settimeout(read_timeout)
+        server.login(self.user, self.password)
+        self.server = server
+        self.last_used = time.monotonic()
+        elapsed = time.perf_counter() - started
+        timer.observe("connect", elapsed)
+        log_message(f"🔐 SMTP session opened to {self.host} ({elapsed * 1000:.0f} ms)")
+
+    def ensure_alive(self):
+        if self.server is None:
+            self.connect()
+            return
+        if time.monotonic() - self.last_used < SMTP_IDLE_CHECK_SECONDS:
+            return
+        try:
+            code, _ = self.server.noop()
+            if code != 250:
+                self.connect()
+        except RECONNECT_ERRORS:
+            self.connect()
+
+    def _deliver(self, from_addr, recipients, message):
+        self.data_started = False
+
+        def on_data():
+            self.data_started = True
+
+        if isinstance(message, MimeMessage):
+            return _stream_message(self.server, from_addr, message, on_data)
+        return _send_serialized(self.server, from_addr, recipients, message, on_data)
+
+    def sendmail(self, from_addr, recipients, message):
+        self.ensure_alive()
+        try:
+            result = self._deliver(from_addr, recipients, message)
+        except smtplib.SMTPResponseException:
+            # The server answered (quota, rejected recipient, ...): a fresh login would not help
+            raise
+        except RECONNECT_ERRORS as e:
+            if self.data_started:
+                # The server may already have queued the message; resending could deliver it twice
+                self.abandon()
+                raise DeliveryUncertain(f"connection lost after DATA: {type(e).__name__}: {e}") from e
+            # Server dropped us before DATA — one fresh attempt
+            self.connect()
+            result = self._deliver(from_addr, recipients, message)
+        self.last_used = time.monotonic()
+        return result
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            pass
+        self.server = None
+
+    def abandon(self):
+        """Drop a broken session without QUIT; the next send opens a new one."""
+        if self.server is None:
+            return
+        try:
+            self.server.close()
+        except Exception:
+            pass
+        self.server = None
+
+
+# ---------------- SESSION POOL -----------------
+class SMTPPool:
+    """Thread-safe pool of up to `size` authenticated SMTP sessions."""
+
+    def __init__(self, user, password, host=SMTP_SERVER, port=SMTP_PORT, size=SMTP_POOL_SIZE):
+        self.user = user
+        self.host = host
+        self.port = port
+        self._idle = queue.LifoQueue()
+        for _ in range(max(1, size)):
+            self._idle.put(_Session(host, port, user, password))
+        self._lock = threading.Lock()
+        self.timings = []
+
+    def send(self, recipients, message) -> float:
+        """Send a serialized message or a MimeMessage; returns the elapsed time in seconds."""
+        session = self._idle.get()
+        started = time.perf_counter()
+        try:
+            session.sendmail(self.user, recipients, message)
+        finally:
+            self._idle.put(session)
+        elapsed = time.perf_counter() - started
+        timer.observe("send", elapsed)
+        with self._lock:
+            self.timings.append(elapsed)
+        return elapsed
+
+    def send_message(self, message: MimeMessage) -> float:
+        """Stream a MimeMessage to its envelope recipients (To + Bcc)."""
+        return self.send(message.recipients, message)
+
+    def summary(self) -> str:
+        with self._lock:
+            timings = sorted(self.timings)
+        if not timings:
+            return "no messages sent"
+        avg = sum(timings) / len(timings)
+        return (
+            f"{len(timings)} message(s) | avg {avg * 1000:.0f} ms | "
+            f"max {timings[-1] * 1000:.0f} ms"
+        )
+
+    def close(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            session.close()
+
+
+# ---------------- SHARED POOL -----------------
+_pools = {}
+_senders = {}  # get_sender() rotations, closed together with the pools
+_pools_lock = threading.Lock()
+
+
+def get_smtp_pool(user, password, host=SMTP_SERVER, port=SMTP_PORT) -> SMTPPool:
+    """Return the process-wide pool for this account, creating it on first use."""
+    key = (host, port, user)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SMTPPool(user, password, host=host, port=port)
+            _pools[key] = pool
+        return pool
+
+
+@atexit.register
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        senders = list(_senders.values())
+        _pools.clear()
+        _senders.clear()
+    for sender in senders:
+        log_message(f"📮 Sender usage today: {sender.summary()}")
+    for pool in pools:
+        if pool.timings:
+            log_message(f"📊 SMTP {pool.user}: {pool.summary()}")
+        pool.close()
+
+
+# ---------------- QUOTA ERRORS -----------------
+class QuotaExhausted(smtplib.SMTPException):
+    """No sender account has quota left for this message."""
+
+
+def _reply_text(error: smtplib.SMTPResponseException) -> str:
+    text = error.smtp_error
+    return (text.decode("utf-8", "replace") if isinstance(text, bytes) else str(text)).lower()
+
+
+def is_daily_quota_error(error) -> bool:
+    """Gmail 550 5.4.5: daily sending quota exceeded; the account is done for the day."""
+    if not isinstance(error, smtplib.SMTPResponseException):
+        return False
+    text = _reply_text(error)
+    return "5.4.5" in text or (error.smtp_code >= 500 and "quota" in text)
+
+
+def is_rate_limit_error(error) -> bool:
+    """421 / 4.7.x replies: too many messages or connections right now; retry later."""
+    if not isinstance(error, smtplib.SMTPResponseException):
+        return False
+    return error.smtp_code == 421 or (400 <= error.smtp_code < 500 and "4.7." in _reply_text(error))
+
+
+def is_auth_error(error) -> bool:
+    return isinstance(error, smtplib.SMTPAuthenticationError)
+
+
+# ---------------- USAGE STORE -----------------
+class UsageStore:
+    """Recipients sent per account per UTC day, kept in SQLite so usage survives between runs."""
+
+    def __init__(self, path: str = SENDER_USAGE_DB):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " account TEXT NOT NULL, day TEXT NOT NULL,"
+            " recipients INTEGER NOT NULL DEFAULT 0, messages INTEGER NOT NULL DEFAULT 0,"
+            " exhausted INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (account, day))"
+        )
+
+    @staticmethod
+    def today() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    def load(self, account: str) -> tuple:
+        """-> (recipients sent today, exhausted today)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT recipients, exhausted FROM usage WHERE account = ? AND day = ?",
+                (account, self.today()),
+            ).fetchone()
+        return (row[0], bool(row[1])) if row else (0, False)
+
+    def add(self, account: str, recipients: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO usage (account, day, recipients, messages) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (account, day) DO UPDATE SET "
+                "recipients = recipients + excluded.recipients, messages = messages + 1",
+                (account, self.today(), recipients),
+            )
+
+    def mark_exhausted(self, account: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO usage (account, day, exhausted) VALUES (?, ?, 1) "
+                "ON CONFLICT (account, day) DO UPDATE SET exhausted = 1",
+                (account, self.today()),
+            )
+
+
+# ---------------- ACCOUNT ROTATION -----------------
+class _Account:
+    def __init__(self, user, pool: SMTPPool, used: int, exhausted: bool):
+        self.user = user
+        self.pool = pool
+        self.day = UsageStore.today()
+        self.used = used            # recipients today, including in-flight reservations
+        self.exhausted = exhausted  # quota reply seen today
+        self.disabled = False       # login failed; skipped for the rest of the run
+        self.backoff_until = 0.0
+        self.backoff_seconds = QUOTA_BACKOFF_SECONDS
+        self.minute = []            # (monotonic time, recipients) within the last 60 s
+
+    def headroom(self) -> int:
+        if self.exhausted or self.disabled:
+            return 0
+        return EMAIL_DAILY_LIMIT - self.used
+
+    def minute_wait(self, n: int, now: float) -> float:
+        """Seconds until `n` more recipients fit in this account's per-minute window."""
+        if EMAIL_MINUTE_LIMIT <= 0:
+            return 0.0
+        self.minute = [(t, k) for t, k in self.minute if now - t < 60]
+        used = sum(k for _, k in self.minute)
+        if used + n <= EMAIL_MINUTE_LIMIT or not self.minute:
+            return 0.0
+        # Drop the oldest entries until enough recipients have aged out
+        for t, k in self.minute:
+            used -= k
+            if used + n <= EMAIL_MINUTE_LIMIT:
+                return 60 - (now - t)
+        return 60 - (now - self.minute[-1][0])
+
+
+class SenderRotation:
+    """
+    Sends each message from the account with the most daily headroom.
+
+    Quota and rate-limit replies move the message on to another account:
+      - 550 5.4.5 (daily quota) retires the account until the next UTC day
+      - 421 / 4.7.x backs the account off, doubling up to QUOTA_BACKOFF_MAX_SECONDS
+      - a failed login disables the account for the rest of the run
+    When every account with headroom is backed off or at its per-minute cap,
+    the sender waits, unless the wait would outlast the run deadline
+    (DeadlineExceeded). When no account has headroom left, QuotaExhausted is
+    raised and the message stays in the outbox for the next run. Moving a
+    message on to another account spends the SMTP retry budget.
+    """
+
+    def __init__(self, accounts, host=SMTP_SERVER, port=SMTP_PORT, store: UsageStore | None = None):
+        if not accounts:
+            raise ValueError("No email account configured: set EMAIL_USER / EMAIL_PASSWORD or EMAIL_ACCOUNTS")
+        self.store = store or UsageStore()
+        self._lock = threading.Lock()
+        self.accounts = []
+        for user, password in accounts:
+            used, exhausted = self.store.load(user)
+            self.accounts.append(_Account(user, get_smtp_pool(user, password, host, port), used, exhausted))
+
+    def _roll_day(self, acct: _Account):
+        today = UsageStore.today()
+        if acct.day != today:
+            acct.day, acct.used, acct.exhausted = today, 0, False
+
+    def _reserve(self, n: int, tried: set) -> tuple:
+        """
+        Pick an account and reserve `n` recipients on it, waiting out back-off
+        and minute caps. Returns (account, reservation).
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                waits = []
+                best = None
+                for acct in self.accounts:
+                    self._roll_day(acct)
+                    if acct.user in tried or acct.headroom() < n:
+                        continue
+                    wait = max(acct.backoff_until - now, acct.minute_wait(n, now))
+                    if wait > 0:
+                        waits.append(wait)
+                    elif best is None or acct.headroom() > best.headroom():
+                        best = acct
+                if best is not None:
+                    reservation = (now, n)
+                    best.used += n
+                    best.minute.append(reservation)
+                    return best, reservation
+            if not waits and tried:
+                tried.clear()  # only accounts that already failed this message are left
+                continue
+            if not waits:
+                raise QuotaExhausted(
+                    f"no sender account has quota left for {n} recipient(s) "
+                    f"({len(self.accounts)} account(s), {EMAIL_DAILY_LIMIT}/day each)"
+                )
+            deadline.sleep(min(waits))
+
+    def _release(self, acct: _Account, reservation: tuple):
+        with self._lock:
+            acct.used -= reservation[1]
+            if reservation in acct.minute:
+                acct.minute.remove(reservation)
+
+    def send(self, recipients, message) -> float:
+        """Send through the best account; returns the elapsed time in seconds."""
+        n = len(recipients)
+        tried = set()
+        attempts = len(self.accounts) * (1 + QUOTA_RETRY_ROUNDS)
+        for attempt in range(1, attempts + 1):
+            acct, reservation = self._reserve(n, tried)
+            try:
+                elapsed = acct.pool.send(recipients, message)
+            except smtplib.SMTPException as e:
+                self._release(acct, reservation)
+                if not self._handle_error(acct, e) or attempt == attempts or not retry_budget("smtp").spend():
+                    raise
+                tried.add(acct.user)
+                if len(tried) == len(self.accounts):
+                    tried.clear()  # every account failed once; wait on back-off for the next round
+                continue
+            self.store.add(acct.user, n)
+            return elapsed
+
+    def send_message(self, message: MimeMessage) -> float:
+        return self.send(message.recipients, message)
+
+    def _handle_error(self, acct: _Account, error) -> bool:
+        """Update the account's state for a quota / rate / login error; False if the error is unrelated."""
+        with self._lock:
+            if is_daily_quota_error(error):
+                acct.exhausted = True
+                self.store.mark_exhausted(acct.user)
+                timer.count("quota_exhausted")
+                log_message(f"⛔ {acct.user}: daily sending quota reached — switching account")
+            elif is_rate_limit_error(error):
+                acct.backoff_until = time.monotonic() + acct.backoff_seconds
+                log_message(f"⏳ {acct.user}: rate limited — backing off {acct.backoff_seconds}s")
+                acct.backoff_seconds = min(acct.backoff_seconds * 2, QUOTA_BACKOFF_MAX_SECONDS)
+                timer.count("rate_limited")
+            elif is_auth_error(error):
+                acct.disabled = True
+                log_message(f"❌ {acct.user}: login failed — account skipped for this run")
+            else:
+                return False
+            return True
+
+    def summary(self) -> str:
+        with self._lock:
+            return " | ".join(
+                f"{a.user} {a.used}/{EMAIL_DAILY_LIMIT}" + (" (exhausted)" if a.exhausted else "")
+                for a in self.accounts
+            )
+
+
+# ---------------- SHARED SENDER -----------------
+
+def parse_accounts(primary_user, primary_password, extra: str = EMAIL_ACCOUNTS) -> list:
+    """[(user, password), ...]: the primary account first, then EMAIL_ACCOUNTS."""
+    accounts = [(primary_user, primary_password)] if primary_user else []
+    for entry in extra.replace("\n", ",").split(","):
+        user, sep, password = entry.strip().partition(":")
+        if sep and user.strip() and all(user.strip() != u for u, _ in accounts):
+            accounts.append((user.strip(), password.strip()))
+    return accounts
+
+
+def get_sender(user, password, host=SMTP_SERVER, port=SMTP_PORT) -> SenderRotation:
+    """Return the process-wide rotation over `user` plus EMAIL_ACCOUNTS, creating it on first use."""
+    key = (host, port, user)
+    with _pools_lock:
+        sender = _senders.get(key)
+    if sender is None:
+        created = SenderRotation(parse_accounts(user, password), host=host, port=port)
+        with _pools_lock:
+            sender = _senders.setdefault(key, created)
+        if len(sender.accounts) > 1:
+            log_message(f"📮 Sending from {len(sender.accounts)} accounts: {sender.summary()}")
+    return sender
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Lookahead pre-rendering: render the coming days' messages ahead of time, so
+the morning run only has to check them and send.
+
+    python main.py            prepare [--days N]
+    python sms_reminder.py    prepare [--days N]
+    python whatsapp_reminder.py prepare [--days N]
+    python Progress_Report.py prepare [--days N]
+    python runner.py          prepare [job ...]
+
+A prepare run (e.g. the evening before) reads the rows dated tomorrow
+through LOOKAHEAD_DAYS days ahead. It renders each row's message and stores
+it in the outbox's `prepared` table, under the message key and a digest of
+the row's content. Nothing is queued, so nothing can go out early.
+
+On the day, compose still reads that day's rows. The sheet cache serves
+them without a download if the spreadsheet has not changed. A row whose
+digest matches its prepared message gets that message queued as-is,
+without rendering. A row that is new or was edited after the prepare run
+is rendered as usual. A prepared message whose row has been deleted is
+never queued. The digest also covers the job's source files and the shared
+rendering modules (templates, mime, records, schema), so a deploy between
+prepare and send throws the old renders away.
+"""
+
+import os
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+
+from metrics import stage_timer
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+LOOKAHEAD_DAYS = int(os.getenv("LOOKAHEAD_DAYS", "2"))
+
+# Shared modules whose changes can alter any job's rendered output
+RENDER_MODULES = ("templates.py", "mime.py", "records.py", "schema.py")
+
+timer = stage_timer("lookahead")
+
+
+# ---------------- ARGUMENTS -----------------
+def is_prepare_mode(argv) -> bool:
+    return len(argv) > 1 and argv[1] == "prepare"
+
+
+def parse_prepare_args(argv) -> argparse.Namespace:
+    """Options after `prepare`."""
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(argv[0])} prepare",
+                                     description="Render the coming days' messages ahead of the send run.")
+    parser.add_argument("--days", type=int, default=LOOKAHEAD_DAYS,
+                        help=f"days ahead to prepare, starting tomorrow (default {LOOKAHEAD_DAYS})")
+    args = parser.parse_args(argv[2:])
+    if args.days < 1:
+        parser.error("--days must be at least 1")
+    return args
+
+
+# ---------------- DATES -----------------
+def lookahead_dates(today_str: str, days: int) -> list:
+    """The `days` dates after `today_str`, as "YYYY-MM-DD" strings."""
+    today = datetime.strptime(today_str, "%Y-%m-%d").date()
+    return [(today + timedelta(days=n)).strftime("%Y-%m-%d") for n in range(1, days + 1)]
+
+
+def row_date(cell) -> str:
+    """Date part of a sheet date cell, the same part the date filter matches on."""
+    return str(cell).strip()[:10]
+
+
+# ---------------- DIGESTS -----------------
+def source_digest(*paths) -> str:
+    """Digest of the files that turn a row into a message, plus RENDER_MODULES."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for path in (*paths, *(os.path.join(here, name) for name in RENDER_MODULES)):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def row_digest(row, version: str) -> str:
+    """Digest of one record's content plus the `version` of the code rendering it."""
+    raw = "\x1f".join([version, *(f"{column}\x1e{value}" for column, value in row.as_dict().items())])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+# ---------------- PREPARE -----------------
+def prepare_rows(outbox, job: str, channel: str, rows, date_column: str, version: str, key_fn, build_fn) -> int:
+    """
+    Render `rows` and store them as prepared `channel` messages of `job`.
+    key_fn(row, date) -> message key, build_fn(row) -> (recipient, payload).
+    Rows already queued or sent are left alone. Returns the number stored.
+    """
+    prepared = 0
+    for row in rows:
+        date = row_date(row.get(date_column, ""))
+        key = key_fn(row, date)
+        if outbox.has(key):
+            continue
+        recipient, payload = build_fn(row)
+        outbox.prepare(key, job, channel, date, row_digest(row, version), recipient, payload)
+        prepared += 1
+    log_message(f"🗂️ {job}: {prepared} message(s) prepared ahead")
+    return prepared
+
+
+# ---------------- SEND DAY -----------------
+class PreparedMessages:
+    """A job's prepared messages for one day, checked against the rows read now."""
+
+    def __init__(self, outbox, job: str, date: str, version: str):
+        self.outbox = outbox
+        self.job = job
+        self.version = version
+        self.digests = outbox.prepared(job, date)
+        self.reused = 0
+        self.stale = 0
+
+    def take(self, key: str, row) -> bool:
+        """
+        Queue the message prepared for `row` as stored, if its row is unchanged.
+        False means there is none or the row changed; render it as usual.
+        """
+        digest = self.digests.get(key)
+        if digest is None:
+            return False
+        if digest != row_digest(row, self.version) or not self.outbox.enqueue_prepared(key):
+            self.stale += 1
+            timer.count("stale")
+            return False
+        self.reused += 1
+        timer.count("reused")
+        return True
+
+    def log(self):
+        if self.digests:
+            log_message(
+                f"♻️ {self.job}: {self.reused} prepared message(s) reused, "
+                f"{self.stale} re-rendered because the row changed"
+            )
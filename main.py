@@ -1,32 +1,47 @@
 # -*- coding: utf-8 -*-
 import os
-import json
-import base64
-import smtplib
-import ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import pandas as pd
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
+import sys
 from datetime import datetime
+from email_sender import SMTP_SERVER, SMTP_PORT, get_sender
+from mime import MessageTemplate
+from digest import DIGEST_MODE, Digest
+from outbox import Outbox, message_key, dispatch_batch, log_outbox, run_mode
+from lookahead import is_prepare_mode, parse_prepare_args, lookahead_dates, source_digest, prepare_rows, PreparedMessages
+from sheets import read_values, read_rows_for_dates
+from schema import TIME_TABLE
+from records import Reminder, read_records
+from templates import Template
+from metrics import stage_timer, write_run_metrics
 
 # ---------------- GOOGLE SHEET CONFIG -----------------
 SPREADSHEET_ID = "1-gAUMbVOio3mTzfDstqjpnQdibP2oYjuF-vhX5UovCw"
 RANGE_NAME = "Time_Table"
 
+# ---------------- OUTBOX -----------------
+OUTBOX_JOB = "email_reminders"
+timer = stage_timer(OUTBOX_JOB)
+
+# Prepared messages from an older version of this script or the shared rendering modules are re-rendered
+PREPARE_VERSION = source_digest(__file__)
+
 # ---------------- EMAIL CONFIG (Gmail) -----------------
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 465
 EMAIL_USER = os.environ.get("EMAIL_USER")
 EMAIL_PASSWORD = os.environ.get("EMAIL_PASSWORD")  # App password
 
-# ---------------- SERVICE ACCOUNT FROM SECRET -----------------
-if "SERVICE_ACCOUNT_JSON" not in os.environ:
-    raise ValueError("SERVICE_ACCOUNT_JSON environment variable is not set!")
+ADMIN_EMAILS = ["alhuraibia@gmail.com"]
 
-SERVICE_ACCOUNT_INFO = json.loads(
-    base64.b64decode(os.environ["SERVICE_ACCOUNT_JSON"]).decode("utf-8")
+# From header, BCC list and MIME skeleton shared by every reminder email.
+# In digest mode admins and teachers get one summary at the end instead of BCC copies.
+REMINDER_MESSAGE = MessageTemplate(
+    f"New Dimension Academy <{EMAIL_USER}>",
+    bcc=[] if DIGEST_MODE else ADMIN_EMAILS,
+)
+digest = Digest(
+    OUTBOX_JOB,
+    "Class reminders sent",
+    ["Customer", "Email", "Course", "Session"],
+    f"New Dimension Academy <{EMAIL_USER}>",
+    admins=ADMIN_EMAILS,
 )
 
 # ---------------- LOG FUNCTION -----------------
@@ -35,25 +50,28 @@ def log_message(message):
     print(f"[{timestamp}] {message}")
 
 # ---------------- READ GOOGLE SHEET -----------------
-def read_google_sheet():
+def read_google_sheet(dates=None):
     log_message("📌 read_google_sheet() called")
     try:
-        creds = Credentials.from_service_account_info(
-            SERVICE_ACCOUNT_INFO,
-            scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
-        )
-        service = build("sheets", "v4", credentials=creds)
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=RANGE_NAME
-        ).execute()
-        values = result.get("values", [])
+        with timer.span("fetch"):
+            if dates:
+                values = read_rows_for_dates(SPREADSHEET_ID, RANGE_NAME, "Reminder_Date", dates)
+            else:
+                values = read_values(SPREADSHEET_ID, RANGE_NAME)
         if not values:
             log_message("❌ No data found in Google Sheet.")
             return None
-        df = pd.DataFrame(values[1:], columns=values[0])
-        log_message(f"✅ Google Sheet read successfully. Rows: {len(df)}")
-        return df
+        if len(values) < 2:
+            log_message("ℹ️ No matching rows in Google Sheet.")
+            return None
+        with timer.span("parse"):
+            rows = list(read_records(
+                values, TIME_TABLE, Reminder,
+                require=("Email", "Message", "Zoom_link", "Meeting_id", "Passcode"),
+                date_column="Reminder_Date", dates=dates,
+            ))
+        log_message(f"✅ Google Sheet read successfully. Rows: {len(rows)}")
+        return rows
     except Exception as e:
         log_message(f"❌ Failed to read Google Sheet: {e}")
         return None
@@ -77,61 +95,43 @@ def read_google_sheet():
 #     except Exception as e:
 #         log_message(f"❌ Failed to send email to {recipient}: {e}")
 
-def send_email(to_email, teacher_email, subject, body):
+def send_email(to_email, teacher_email, subject, body, summary=None):
     try:
-        msg = MIMEMultipart()
-        msg["From"] = f"New Dimension Academy <{EMAIL_USER}>"
-        msg["To"] = to_email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "html"))
-
-        # BCC recipients
-        bcc_list = ["alhuraibia@gmail.com"]
-
-        # Add teacher email to BCC if exists
-        if teacher_email and str(teacher_email).strip():
-            bcc_list.append(teacher_email)
-
-        # Final recipient list (To + BCC)
-        recipients = [to_email] + bcc_list
+        # Teacher email joins the BCC list if it exists
+        message = REMINDER_MESSAGE.build(to_email, subject, body, bcc=[] if DIGEST_MODE else [teacher_email])
 
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
-            server.login(EMAIL_USER, EMAIL_PASSWORD)
-            server.sendmail(EMAIL_USER, recipients, msg.as_string())
+        sender = get_sender(EMAIL_USER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT)
+        elapsed = sender.send_message(message)
 
         log_message(
-            f"Email sent → TO: {to_email} | BCC: {', '.join(bcc_list)}"
+            f"Email sent → TO: {to_email} | BCC: {', '.join(message.recipients[1:])} "
+            f"({elapsed * 1000:.0f} ms)"
         )
+        if DIGEST_MODE:
+            digest.add(summary or dict(Email=to_email), teacher=teacher_email)
+        return True
 
     except Exception as e:
         log_message(f"❌ Failed to send email to {to_email}: {e}")
-
-# ---------------- PROCESS REMINDERS -----------------#
-def process_reminders():
-    df = read_google_sheet()
-    if df is None:
-        return "No data to process."
-
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    log_message(f"Processing reminders for {today_str}")
-    sent_count = 0
-
-    for _, row in df.iterrows():
-        if row["Reminder_Date"] != today_str:
-            continue
-
-        body = f"""
-        <p><b>Dear </b>{row['Customer']},</p>
-        <p>{row['Message']}</p>
-        <p><b>Class Date:</b> {row['Reminder_Date']}<br>
-        <b>Course:</b> {row['Course']}<br>
-        <b>Class Time:</b> {row['Session']}</p>
+        raise  # dispatch records the reason in the outbox
+
+# ---------------- ADMIN / TEACHER DIGEST -----------------
+def send_digest():
+    sender = get_sender(EMAIL_USER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT)
+    return digest.send(sender.send_message)
+
+# ---------------- REMINDER EMAIL TEMPLATE -----------------
+REMINDER_EMAIL_TEMPLATE = Template("""
+        <p><b>Dear </b>{{customer}},</p>
+        <p>{{message}}</p>
+        <p><b>Class Date:</b> {{class_date}}<br>
+        <b>Course:</b> {{course}}<br>
+        <b>Class Time:</b> {{session}}</p>
         <p><img src="https://raw.githubusercontent.com/ndacademyca/images/main/Whatsapp_notification.png"
                 width="650"></p>
-        <p><b>Zoom link:</b> {row['Zoom_link']}<br>
-        <b>Zoom Meeting ID:</b> {row['Meeting_id']}<br>
-        <b>Zoom Meeting Passcode:</b> {row['Passcode']}
+        <p><b>Zoom link:</b> {{zoom_link}}<br>
+        <b>Zoom Meeting ID:</b> {{meeting_id}}<br>
+        <b>Zoom Meeting Passcode:</b> {{passcode}}
         </p>
         <p>Warm regards,<br><br>
         <img src="https://raw.githubusercontent.com/ndacademyca/images/main/NewDimensionAcademy_t.png"
@@ -141,25 +141,116 @@ def process_reminders():
         Email: <a href="mailto:info@ndacademy.ca">info@ndacademy.ca</a><br><br>
         | At New Dimension Academy, we are Expanding Minds, Unlocking New Dimensions. |
         </p>
-        """
+        """)
+
+def build_reminder_body(row):
+    return REMINDER_EMAIL_TEMPLATE.render(dict(
+        customer   = row['Customer'],
+        message    = row['Message'],
+        class_date = row['Reminder_Date'],
+        course     = row['Course'],
+        session    = row['Session'],
+        zoom_link  = row['Zoom_link'],
+        meeting_id = row['Meeting_id'],
+        passcode   = row['Passcode'],
+    ))
+
+# ---------------- COMPOSE REMINDERS -----------------
+def reminder_key(row, date_str):
+    return message_key(
+        f"{SPREADSHEET_ID}/{RANGE_NAME}",
+        (row["Email"], row["Customer"], row["Course"], row["Session"]),
+        "email",
+        date_str
+    )
+
+def build_reminder(row):
+    """row -> (recipient, outbox payload)"""
+    with timer.span("render"):
+        body = build_reminder_body(row)
+
+    teacher_email = row.get("Teacher_Email", "")
+
+    return row["Email"], dict(
+        to_email=row["Email"],
+        teacher_email=teacher_email,
+        subject=f"Reminder for {row['Customer']}",
+        body=body,
+        summary=dict(Customer=row["Customer"], Email=row["Email"], Course=row["Course"], Session=row["Session"])
+    )
+
+def compose_reminders(outbox, today_str):
+    rows = read_google_sheet(dates=[today_str])
+    if rows is None:
+        return None
 
-        teacher_email = row.get("Teacher_Email", "")
+    # Rendered the evening before by `main.py prepare`, if it ran
+    prepared = PreparedMessages(outbox, OUTBOX_JOB, today_str, PREPARE_VERSION)
 
-        send_email(
-            to_email=row["Email"],
-            teacher_email=teacher_email,
-            subject=f"Reminder for {row['Customer']}",
-            body=body
-        )
+    queued = 0
+    for row in rows:
+        key = reminder_key(row, today_str)
+        if outbox.has(key):
+            continue
+
+        if prepared.take(key, row):
+            queued += 1
+            continue
+
+        recipient, payload = build_reminder(row)
+        queued += outbox.enqueue(key, OUTBOX_JOB, "email", recipient, payload, send_date=today_str)
+
+    prepared.log()
+    log_message(f"📝 Reminders queued: {queued}")
+    return queued
+
+# ---------------- PREPARE AHEAD -----------------
+def prepare_reminders(days, today_str=None):
+    """Render the next `days` days of reminders into the outbox's prepared table; nothing is queued."""
+    today_str = today_str or datetime.now().strftime("%Y-%m-%d")
+    dates = lookahead_dates(today_str, days)
+    log_message(f"🗓️ Preparing reminders for {', '.join(dates)}")
+
+    rows = read_google_sheet(dates=dates)
+    if rows is None:
+        return 0
+    with timer.span("prepare"):
+        return prepare_rows(Outbox(), OUTBOX_JOB, "email", rows, "Reminder_Date", PREPARE_VERSION, reminder_key, build_reminder)
+
+# ---------------- PROCESS REMINDERS -----------------#
+def process_reminders(compose=True, send=True):
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    log_message(f"Processing reminders for {today_str}")
+
+    outbox = Outbox()
+    if compose and compose_reminders(outbox, today_str) is None:
+        log_message("No data to process.")
+
+    if not send:
+        log_outbox(outbox, OUTBOX_JOB)
+        log_message("Composed only.")
+        return None
 
-        sent_count += 1
+    # Also picks up anything left outstanding by an interrupted run today; older reminders expire
+    summary = outbox.drain(OUTBOX_JOB, dispatch_batch("email", send_email), send_date=today_str)
+    timer.observe_results("send", summary.results)
+    summary.log()
+    log_outbox(outbox, OUTBOX_JOB)
+    if DIGEST_MODE:
+        send_digest()
 
-    log_message(f"🎉 All reminders processed. Total emails sent: {sent_count}")
-    return f"Done — {sent_count} reminder(s) sent."
+    log_message(f"🎉 All reminders processed. Total emails sent: {summary.sent}")
+    log_message(f"Done — {summary.sent} reminder(s) sent, {summary.failed} failed.")
+    return summary
 
 # ---------------- MAIN ENTRY POINT -----------------
 if __name__ == "__main__":
-    process_reminders()
+    if is_prepare_mode(sys.argv):
+        prepare_reminders(parse_prepare_args(sys.argv).days)
+        write_run_metrics(f"{OUTBOX_JOB}_prepare")
+    else:
+        process_reminders(*run_mode(sys.argv))
+        write_run_metrics(OUTBOX_JOB)
 
 
 
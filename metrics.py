@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and run metrics export.
+
+Each job times its stages per item: fetch, parse (including the date filter), render, pdf and
+send. Shared modules time their own work, such as the SMTP handshake and
+Sheets API calls. Timings go into per-(component, stage) histograms that
+live for the whole process:
+
+    timer = stage_timer("invoices")
+    with timer.span("render"):
+        html = build_email_html(rows, month)
+    timer.observe_results("send", summary.results)
+
+At the end of a run, write_run_metrics() writes METRICS_DIR/<run>.json
+and/or METRICS_DIR/<run>.prom (Prometheus textfile format). Set
+METRICS_FORMAT to choose which. The workflows upload METRICS_DIR as an
+artifact.
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+METRICS_DIR = os.getenv("METRICS_DIR", ".metrics")
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "json,prom")
+
+# Histogram bucket upper bounds, in seconds (an implicit +Inf bucket follows)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Raw samples kept per stage for exact quantiles; counts and buckets stay exact beyond this
+MAX_SAMPLES = 100_000
+
+_lock = threading.Lock()
+_histograms = {}  # (component, stage) -> Histogram
+_counters = {}    # (component, event) -> int
+_process_started = time.time()
+
+
+# ---------------- HISTOGRAM -----------------
+class Histogram:
+    __slots__ = ("buckets", "count", "sum", "min", "max", "samples")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.samples = []
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_s": round(self.sum, 6),
+            "min_ms": round(self.min * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "p50_ms": round(self.quantile(0.50) * 1000, 3),
+            "p90_ms": round(self.quantile(0.90) * 1000, 3),
+            "p99_ms": round(self.quantile(0.99) * 1000, 3),
+            "buckets": {
+                _le(bound): n for bound, n in zip(list(BUCKETS) + [None], self.buckets)
+            },
+        }
+
+
+def _le(bound) -> str:
+    return "+Inf" if bound is None else f"{bound:g}"
+
+
+# ---------------- STAGE TIMER -----------------
+class StageTimer:
+    """Records stage timings and event counts under one component (job or shared module)."""
+
+    __slots__ = ("component",)
+
+    def __init__(self, component: str):
+        self.component = component
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage: str, seconds: float):
+        key = (self.component, stage)
+        with _lock:
+            hist = _histograms.get(key)
+            if hist is None:
+                hist = _histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    def observe_results(self, stage: str, results):
+        """
+        Record the per-message `elapsed` of DispatchResults, with sent / failed
+        counts matching DispatchSummary. Messages skipped at the run deadline
+        were never attempted; they are counted as skipped, with no timing.
+        """
+        sent = failed = skipped = 0
+        for r in results:
+            if r.skipped:
+                skipped += 1
+                continue
+            self.observe(stage, r.elapsed)
+            if r.ok:
+                sent += 1
+            else:
+                failed += 1
+        self.count("sent", sent)
+        self.count("failed", failed)
+        self.count("skipped", skipped)
+
+    def count(self, event: str, n: int = 1):
+        if not n:
+            return
+        key = (self.component, event)
+        with _lock:
+            _counters[key] = _counters.get(key, 0) + n
+
+
+def stage_timer(component: str) -> StageTimer:
+    return StageTimer(component)
+
+
+# ---------------- SNAPSHOT / EXPORT -----------------
+def snapshot() -> dict:
+    with _lock:
+        stages = {}
+        for (component, stage), hist in sorted(_histograms.items()):
+            stages.setdefault(component, {})[stage] = hist.to_dict()
+        counters = {}
+        for (component, event), n in sorted(_counters.items()):
+            counters.setdefault(component, {})[event] = n
+    return {"stages": stages, "counters": counters}
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(run: str, finished: float) -> str:
+    lines = [
+        "# HELP automation_stage_seconds Time spent per item in each stage.",
+        "# TYPE automation_stage_seconds histogram",
+    ]
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+
+    for (component, stage), hist in histograms:
+        labels = f'run="{_escape(run)}",component="{_escape(component)}",stage="{_escape(stage)}"'
+        cumulative = 0
+        for bound, n in zip(list(BUCKETS) + [None], hist.buckets):
+            cumulative += n
+            lines.append(f'automation_stage_seconds_bucket{{{labels},le="{_le(bound)}"}} {cumulative}')
+        lines.append(f"automation_stage_seconds_sum{{{labels}}} {hist.sum:.6f}")
+        lines.append(f"automation_stage_seconds_count{{{labels}}} {hist.count}")
+
+    lines += [
+        "# HELP automation_events_total Events counted during the run (messages sent, failed, ...).",
+        "# TYPE automation_events_total counter",
+    ]
+    for (component, event), n in counters:
+        lines.append(
+            f'automation_events_total{{run="{_escape(run)}",component="{_escape(component)}",'
+            f'event="{_escape(event)}"}} {n}'
+        )
+
+    lines += [
+        "# HELP automation_run_duration_seconds Wall time of the run.",
+        "# TYPE automation_run_duration_seconds gauge",
+        f'automation_run_duration_seconds{{run="{_escape(run)}"}} {finished - _process_started:.3f}',
+        "# HELP automation_run_finished_timestamp_seconds When the run finished.",
+        "# TYPE automation_run_finished_timestamp_seconds gauge",
+        f'automation_run_finished_timestamp_seconds{{run="{_escape(run)}"}} {finished:.0f}',
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def log_stage_summary():
+    data = snapshot()["stages"]
+    for component, stages in data.items():
+        parts = [
+            f"{stage} {h['count']}× p50 {h['p50_ms']:.1f} ms p99 {h['p99_ms']:.1f} ms"
+            for stage, h in stages.items()
+        ]
+        log_message(f"⏱️  {component}: " + " | ".join(parts))
+
+
+def write_run_metrics(run: str) -> list:
+    """Write the run's metrics to METRICS_DIR; returns the paths written."""
+    finished = time.time()
+    formats = {f.strip() for f in METRICS_FORMAT.split(",") if f.strip()}
+    paths = []
+    try:
+        log_stage_summary()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        if "json" in formats:
+            path = os.path.join(METRICS_DIR, f"{run}.json")
+            report = dict(
+                run=run,
+                started=round(_process_started, 3),
+                finished=round(finished, 3),
+                duration_s=round(finished - _process_started, 3),
+                **snapshot(),
+            )
+            _write_atomic(path, json.dumps(report, indent=2))
+            paths.append(path)
+        if "prom" in formats:
+            path = os.path.join(METRICS_DIR, f"{run}.prom")
+            _write_atomic(path, to_prometheus(run, finished))
+            paths.append(path)
+        if paths:
+            log_message(f"📈 Run metrics written: {', '.join(paths)}")
+    except OSError as e:
+        log_message(f"⚠️ Could not write run metrics: {e}")
+    return paths
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Copy-free MIME assembly for outgoing email.
+
+A message is kept as a list of ready-to-send byte chunks instead of an
+email.message tree:
+
+    headers | html part header | base64 html | [pdf part header | base64 pdf] | closing boundary
+
+Parts that are the same for every message of a job are encoded once, when
+its MessageTemplate is created: the From header, the multipart boundary,
+the part headers and the BCC list. Each attachment is base64-encoded
+exactly once, straight into CRLF-terminated lines. The SMTP pool writes the
+chunks to the socket one at a time, so the message is never joined into
+one string. Before, MIMEMultipart.as_string() and sendmail() each made a
+full copy.
+
+Bcc recipients only go on the SMTP envelope, never into the headers.
+"""
+
+import base64
+import hashlib
+from email.header import Header
+from email.utils import encode_rfc2231
+
+CRLF = b"\r\n"
+
+
+# ---------------- ENCODING -----------------
+def b64_lines(data: bytes) -> bytes:
+    """Base64 in 76-character lines with CRLF endings, ready for the DATA stream."""
+    return base64.encodebytes(data).replace(b"\n", CRLF)
+
+
+def header_value(value) -> str:
+    """One-line header value; non-ASCII text is RFC 2047 encoded."""
+    value = " ".join(str(value).split())  # no CR/LF can reach the header block
+    try:
+        value.encode("ascii")
+        return value
+    except UnicodeEncodeError:
+        return Header(value, "utf-8").encode(linesep="\r\n")
+
+
+def _filename_param(filename: str) -> str:
+    filename = " ".join(str(filename).split())
+    if filename.isascii() and '"' not in filename and "\\" not in filename:
+        return f'filename="{filename}"'
+    return f"filename*={encode_rfc2231(filename, 'utf-8')}"
+
+
+# ---------------- MESSAGE -----------------
+class MimeMessage:
+    """A serialized message: envelope recipients plus the byte chunks of its body."""
+
+    __slots__ = ("recipients", "chunks", "size")
+
+    def __init__(self, recipients: list, chunks: list):
+        self.recipients = recipients
+        self.chunks = chunks
+        self.size = sum(len(c) for c in chunks)
+
+    def as_bytes(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+# ---------------- TEMPLATE -----------------
+class MessageTemplate:
+    """Shared headers and part skeleton for every message one job sends."""
+
+    def __init__(self, from_addr: str, bcc=()):
+        self.bcc = [a for a in bcc if a]
+        # base64 never contains "-", so a fixed boundary cannot collide with a part body.
+        # Deriving it from the sender keeps rendered .eml files diffable between runs.
+        boundary = f"nda-{hashlib.sha1(from_addr.encode('utf-8')).hexdigest()[:32]}".encode("ascii")
+        self._head = (
+            f"From: {header_value(from_addr)}\r\n"
+            "MIME-Version: 1.0\r\n"
+            f'Content-Type: multipart/mixed; boundary="{boundary.decode()}"\r\n'
+        ).encode("ascii")
+        self._html_part = (
+            b"--" + boundary + CRLF
+            + b'Content-Type: text/html; charset="utf-8"\r\n'
+            + b"Content-Transfer-Encoding: base64\r\n\r\n"
+        )
+        self._part_start = b"--" + boundary + CRLF
+        self._close = b"--" + boundary + b"--" + CRLF
+
+    def attachment_part(self, filename: str, mime_type: str) -> bytes:
+        return self._part_start + (
+            f"Content-Type: {mime_type}\r\n"
+            "Content-Transfer-Encoding: base64\r\n"
+            f"Content-Disposition: attachment; {_filename_param(filename)}\r\n\r\n"
+        ).encode("ascii")
+
+    def build(self, to_addr: str, subject: str, html: str, attachments=(), bcc=()) -> MimeMessage:
+        """
+        attachments: (filename, mime type, bytes) tuples.
+        bcc: extra per-message Bcc recipients on top of the template's.
+        """
+        head = f"To: {header_value(to_addr)}\r\nSubject: {header_value(subject)}\r\n".encode("ascii")
+        chunks = [self._head, head, CRLF, self._html_part, b64_lines(html.encode("utf-8"))]
+        for filename, mime_type, data in attachments:
+            chunks.append(self.attachment_part(filename, mime_type))
+            chunks.append(b64_lines(data))
+        chunks.append(self._close)
+
+        recipients = [to_addr] + self.bcc + [str(a).strip() for a in bcc if a and str(a).strip()]
+        return MimeMessage(recipients, chunks)
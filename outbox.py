@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Durable send ledger and outbox (SQLite).
+
+Every composed message is stored under a deterministic key built from
+sheet + row identity + channel + date, together with its delivery state.
+Composing and sending are separate steps:
+
+    compose  -> enqueue(): INSERT OR IGNORE, so a rerun never re-queues a
+                message that already exists
+    send     -> drain(): claims outstanding messages in batches and records
+                sent / failed / uncertain per message
+
+Failed messages are retried on later runs, up to MAX_ATTEMPTS. A message
+whose send broke off after the provider may have accepted it (e.g. after
+SMTP DATA) is "uncertain" and is never retried.
+
+A rerun after a crash sends only what is still outstanding.
+Messages carry the date they are meant for. Jobs whose messages only make
+sense on that day (reminders, reports) drain with `send_date`, and anything
+still unsent from an earlier day is marked "expired" instead of going out late.
+Jobs can also keep a watermark per item (e.g. a content hash per invoice),
+which lets them skip unchanged sheet rows before doing any work on them.
+Messages rendered ahead of their day are kept apart in `prepared` until
+compose queues them (see lookahead.py). Claims are taken
+inside an IMMEDIATE transaction, so several workers or processes can drain
+the same outbox. A message left in "sending" by a dead worker is reclaimed
+after CLAIM_TIMEOUT_SECONDS. Only that in-flight message can be sent twice.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from dataclasses import dataclass
+
+from dispatch import DispatchSummary, dispatch
+from resilience import deadline
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+OUTBOX_DB = os.getenv("OUTBOX_DB", os.path.join(".outbox", "outbox.sqlite3"))
+MAX_ATTEMPTS = 3
+CLAIM_TIMEOUT_SECONDS = 15 * 60
+RETENTION_DAYS = 45
+DRAIN_BATCH_SIZE = 200
+
+PENDING, SENDING, SENT, FAILED, EXPIRED = "pending", "sending", "sent", "failed", "expired"
+# Failed after the provider may have accepted it; never retried, so it cannot go out twice
+UNCERTAIN = "uncertain"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    key         TEXT PRIMARY KEY,
+    job         TEXT NOT NULL,
+    channel     TEXT NOT NULL,
+    recipient   TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    attachment  BLOB,
+    send_date   TEXT NOT NULL DEFAULT '',
+    state       TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT NOT NULL DEFAULT '',
+    claimed_by  TEXT NOT NULL DEFAULT '',
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_job_state ON messages (job, state);
+CREATE TABLE IF NOT EXISTS watermarks (
+    job         TEXT NOT NULL,
+    item        TEXT NOT NULL,
+    digest      TEXT NOT NULL,
+    updated_at  REAL NOT NULL,
+    PRIMARY KEY (job, item)
+);
+CREATE TABLE IF NOT EXISTS prepared (
+    key         TEXT PRIMARY KEY,
+    job         TEXT NOT NULL,
+    channel     TEXT NOT NULL,
+    send_date   TEXT NOT NULL,
+    digest      TEXT NOT NULL,
+    recipient   TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    created_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prepared_job_date ON prepared (job, send_date);
+"""
+
+
+# ---------------- KEYS -----------------
+def message_key(sheet: str, row_identity, channel: str, date: str) -> str:
+    """Deterministic key for one message: same row, channel and day -> same key."""
+    if not isinstance(row_identity, str):
+        row_identity = "|".join(str(part).strip() for part in row_identity)
+    raw = "\x1f".join([sheet, row_identity, channel, date])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+# ---------------- ENTRY -----------------
+@dataclass
+class OutboxEntry:
+    key: str
+    job: str
+    channel: str
+    recipient: str
+    payload: dict
+    attachment: bytes | None
+    attempts: int
+
+
+# ---------------- OUTBOX -----------------
+class Outbox:
+    def __init__(self, path: str = OUTBOX_DB):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._migrate()
+        self._db.execute(
+            "DELETE FROM messages WHERE state IN (?, ?, ?) AND updated_at < ?",
+            (SENT, EXPIRED, UNCERTAIN, time.time() - RETENTION_DAYS * 86400),
+        )
+        self._db.execute(
+            "DELETE FROM watermarks WHERE updated_at < ?",
+            (time.time() - RETENTION_DAYS * 86400,),
+        )
+        # Prepared messages are only used on their own day
+        self._db.execute(
+            "DELETE FROM prepared WHERE send_date < ?",
+            (time.strftime("%Y-%m-%d", time.localtime(time.time() - 86400)),),
+        )
+
+    def _migrate(self):
+        """Bring an outbox cached by an older version up to the current schema."""
+        columns = {r[1] for r in self._db.execute("PRAGMA table_info(messages)")}
+        if "send_date" not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN send_date TEXT NOT NULL DEFAULT ''")
+            # Older rows were queued on the day they were meant for
+            self._db.execute("UPDATE messages SET send_date = date(created_at, 'unixepoch', 'localtime')")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # ---- compose side ----
+    def has(self, key: str) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM messages WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def enqueue(self, key, job, channel, recipient, payload: dict, attachment: bytes | None = None,
+                send_date: str = "") -> bool:
+        """Record a composed message meant for `send_date`; returns False if the key was already known."""
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO messages "
+                "(key, job, channel, recipient, payload, attachment, send_date, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, job, channel, str(recipient), json.dumps(payload, ensure_ascii=False),
+                 attachment, send_date, PENDING, now, now),
+            )
+        return cur.rowcount == 1
+
+    # ---- watermarks ----
+    def watermarks(self, job: str) -> dict:
+        """item -> digest of everything `job` has already processed."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT item, digest FROM watermarks WHERE job = ?", (job,)
+            ).fetchall()
+        return dict(rows)
+
+    def set_watermark(self, job: str, item: str, digest: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO watermarks (job, item, digest, updated_at) VALUES (?, ?, ?, ?)",
+                (job, item, digest, time.time()),
+            )
+
+    # ---- prepared ahead ----
+    def prepare(self, key, job, channel, send_date: str, digest: str, recipient, payload: dict):
+        """Store a message rendered ahead of `send_date`; replaces an earlier render of the same key."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO prepared "
+                "(key, job, channel, send_date, digest, recipient, payload, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, job, channel, send_date, digest, str(recipient),
+                 json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+
+    def prepared(self, job: str, send_date: str) -> dict:
+        """key -> row digest of everything prepared for `job` on `send_date`."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, digest FROM prepared WHERE job = ? AND send_date = ?", (job, send_date)
+            ).fetchall()
+        return dict(rows)
+
+    def enqueue_prepared(self, key: str) -> bool:
+        """Queue a prepared message as stored; False if it is gone or the key was already known."""
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO messages "
+                "(key, job, channel, recipient, payload, send_date, state, created_at, updated_at) "
+                "SELECT key, job, channel, recipient, payload, send_date, ?, ?, ? FROM prepared WHERE key = ?",
+                (PENDING, now, now, key),
+            )
+        return cur.rowcount == 1
+
+    # ---- send side ----
+    def _claimable_sql(self, retry_before: float):
+        return (
+            "(state = ? OR (state = ? AND attempts < ? AND updated_at < ?) OR (state = ? AND updated_at < ?))",
+            [PENDING, FAILED, MAX_ATTEMPTS, retry_before, SENDING, time.time() - CLAIM_TIMEOUT_SECONDS],
+        )
+
+    def claim(self, job: str, limit: int = DRAIN_BATCH_SIZE, key: str | None = None,
+              retry_before: float | None = None, send_date: str | None = None) -> list:
+        """
+        Atomically move up to `limit` outstanding messages of `job` to "sending".
+        Failed messages are retried only if they failed before `retry_before`.
+        With `send_date`, only messages meant for that day are claimed.
+        """
+        where, params = self._claimable_sql(retry_before if retry_before is not None else time.time())
+        sql = f"SELECT key FROM messages WHERE job = ? AND {where}"
+        params = [job] + params
+        if send_date is not None:
+            sql += " AND send_date = ?"
+            params.append(send_date)
+        if key is not None:
+            sql += " AND key = ?"
+            params.append(key)
+        sql += " ORDER BY created_at, rowid LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                keys = [r[0] for r in self._db.execute(sql, params).fetchall()]
+                if keys:
+                    marks = ",".join("?" * len(keys))
+                    self._db.execute(
+                        f"UPDATE messages SET state = ?, claimed_by = ?, updated_at = ? WHERE key IN ({marks})",
+                        [SENDING, self.worker_id, time.time()] + keys,
+                    )
+                    rows = self._db.execute(
+                        "SELECT key, job, channel, recipient, payload, attachment, attempts "
+                        f"FROM messages WHERE key IN ({marks}) ORDER BY created_at, rowid",
+                        keys,
+                    ).fetchall()
+                else:
+                    rows = []
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+        return [
+            OutboxEntry(k, j, c, r, json.loads(p), a, n)
+            for k, j, c, r, p, a, n in rows
+        ]
+
+    def mark(self, key: str, ok: bool, error: str = "", uncertain: bool = False):
+        """Record one attempt: sent, failed (retried later) or uncertain (never retried)."""
+        state = SENT if ok else UNCERTAIN if uncertain else FAILED
+        with self._lock:
+            self._db.execute(
+                "UPDATE messages SET state = ?, attempts = attempts + 1, last_error = ?, updated_at = ? "
+                "WHERE key = ?",
+                (state, "" if ok else error, time.time(), key),
+            )
+
+    def release(self, key: str):
+        """Hand a claimed message back as pending without counting an attempt."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE messages SET state = ?, claimed_by = '', updated_at = ? WHERE key = ? AND state = ?",
+                (PENDING, time.time(), key, SENDING),
+            )
+
+    def expire(self, job: str, send_date: str) -> int:
+        """Mark outstanding messages of `job` meant for a day before `send_date` as expired."""
+        where, params = self._claimable_sql(time.time())
+        with self._lock:
+            cur = self._db.execute(
+                f"UPDATE messages SET state = ?, claimed_by = '', updated_at = ? "
+                f"WHERE job = ? AND send_date < ? AND {where}",
+                [EXPIRED, time.time(), job, send_date] + params,
+            )
+        return cur.rowcount
+
+    def record(self, entries, summary: DispatchSummary):
+        """
+        Store per-message outcomes from a summary whose results align with
+        `entries`. Messages skipped at the run deadline go back to pending.
+        """
+        for entry, result in zip(entries, summary.results):
+            if result.skipped:
+                self.release(entry.key)
+            else:
+                self.mark(entry.key, result.ok, result.error, result.uncertain)
+
+    def counts(self, job: str) -> dict:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*) FROM messages WHERE job = ? GROUP BY state", (job,)
+            ).fetchall()
+        return dict(rows)
+
+    def drain(self, job: str, send_batch, batch_size: int = DRAIN_BATCH_SIZE,
+              retry_before: float | None = None, send_date: str | None = None) -> DispatchSummary:
+        """
+        Claim and send outstanding messages of `job` until none are left.
+        `send_batch(entries)` returns a DispatchSummary aligned with `entries`.
+        Failures are retried only if they happened before `retry_before`
+        (default: the start of this drain). Jobs that already sent during
+        compose pass their run start, so those failures are not resent here.
+        With `send_date`, only that day's messages are sent and older unsent
+        ones are expired.
+        """
+        total = DispatchSummary(channel=job)
+        started = time.perf_counter()
+        drain_start = retry_before if retry_before is not None else time.time()
+        if send_date is not None:
+            expired = self.expire(job, send_date)
+            if expired:
+                log_message(f"🗑️ {job}: {expired} message(s) from an earlier day expired unsent")
+        while True:
+            if deadline.expired():
+                left = self.counts(job).get(PENDING, 0)
+                log_message(f"⏰ {job}: stopped at the run deadline — {left} message(s) left in the outbox for the next run")
+                break
+            # Failures from this run wait for the next run instead of looping here
+            entries = self.claim(job, limit=batch_size, retry_before=drain_start, send_date=send_date)
+            if not entries:
+                break
+            summary = send_batch(entries)
+            self.record(entries, summary)
+            total.results.extend(summary.results)
+        total.elapsed = time.perf_counter() - started
+        return total
+
+
+# ---------------- HELPERS -----------------
+def run_mode(argv) -> tuple:
+    """
+    Script mode from the command line -> (compose, send):
+      python main.py           compose and send
+      python main.py compose   only compose into the outbox
+      python main.py send      only drain the outbox
+    """
+    mode = argv[1] if len(argv) > 1 else "all"
+    if mode not in ("all", "compose", "send"):
+        raise ValueError(f"Unknown mode '{mode}' (expected compose, send or nothing)")
+    return mode in ("all", "compose"), mode in ("all", "send")
+
+def dispatch_batch(channel: str, send_fn):
+    """send_batch adapter: entry payloads are keyword arguments for send_fn."""
+
+    def send_batch(entries):
+        return dispatch(channel, [(e.recipient, e.payload) for e in entries], send_fn)
+
+    return send_batch
+
+
+def log_outbox(outbox: Outbox, job: str):
+    counts = outbox.counts(job)
+    log_message(
+        f"📬 Outbox [{job}]: "
+        + " | ".join(f"{state} {counts.get(state, 0)}" for state in (SENT, PENDING, SENDING, FAILED, UNCERTAIN, EXPIRED))
+    )
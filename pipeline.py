@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded multi-stage pipeline on threads.
+
+    source -> queue -> [stage 1 workers] -> queue -> [stage 2 workers] -> ... -> caller
+
+Each stage has its own worker count and its own bounded input queue. A full
+queue blocks the stage that feeds it (backpressure), so a slow stage
+throttles the earlier ones instead of letting finished work pile up in
+memory. All stages still run at the same time: item N+1 renders while item
+N uploads, so wall time approaches that of the slowest stage.
+
+A stage function takes one item and returns the item for the next stage,
+or None to drop it. An exception drops only that item and is logged. An
+exception raised by the source stops the feed and is re-raised to the
+caller once the items already fed have drained. CPU-heavy stages should
+hand their work to a process pool from inside `fn`; the threads here only
+wait on it.
+"""
+
+import os
+import time
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+# Items that may wait in front of each stage
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable
+    workers: int = 1
+    queue_size: int = PIPELINE_QUEUE_SIZE
+
+
+@dataclass
+class _StageStats:
+    items: int = 0
+    busy: float = 0.0
+
+
+def run_pipeline(name: str, source, stages):
+    """
+    Push every item of `source` through `stages`, yielding whatever the last
+    stage returns as soon as it comes out. Worker threads start on the first
+    next() and are joined when the generator finishes or is closed.
+    """
+    stop = threading.Event()
+    lock = threading.Lock()
+    queues = [queue.Queue(maxsize=max(1, s.queue_size)) for s in stages]
+    queues.append(queue.Queue(maxsize=PIPELINE_QUEUE_SIZE))
+    remaining = [max(1, s.workers) for s in stages]
+    stats = [_StageStats() for _ in stages]
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def feed():
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                put(queues[0], item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(queues[0], _DONE)
+
+    def work(i: int, stage: Stage):
+        q_in, q_out = queues[i], queues[i + 1]
+        while True:
+            item = get(q_in)
+            if item is _DONE:
+                put(q_in, _DONE)  # let the stage's other workers see it too
+                break
+            started = time.perf_counter()
+            try:
+                out = stage.fn(item)
+            except Exception as e:
+                log_message(f"❌ {name} {stage.name} stage failed: {e}")
+                out = None
+            with lock:
+                stats[i].items += 1
+                stats[i].busy += time.perf_counter() - started
+            if out is not None:
+                put(q_out, out)
+        with lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last:
+            put(q_out, _DONE)
+
+    threads = [threading.Thread(target=feed, name=f"{name}-source", daemon=True)]
+    for i, stage in enumerate(stages):
+        threads += [
+            threading.Thread(target=work, args=(i, stage), name=f"{name}-{stage.name}-{n}", daemon=True)
+            for n in range(max(1, stage.workers))
+        ]
+
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    log_message(
+        f"🚰 {name} pipeline: {time.perf_counter() - started:.2f}s wall | "
+        + " | ".join(
+            f"{s.name} {st.items}× {st.busy:.2f}s busy on {max(1, s.workers)}"
+            for s, st in zip(stages, stats)
+        )
+    )
+    if errors:
+        raise errors[0]
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Pandas-free ingestion: sheet rows streamed straight into slotted records.
+
+read_records() maps the header to column indexes once, then walks the
+Sheets `values` list a row at a time. Each row is either dropped by the date
+filter or turned into one record, with no DataFrame, no copy of the whole
+table and no per-row dict or Series. Per column:
+
+  - text is stripped, and blank or missing cells become ""
+  - repeated values (the schema's categorical columns) share one string object
+  - amount columns ("$1,200.00", "15%") become floats, and blanks become NaN
+  - the date filter parses each distinct date cell only once
+
+Records keep the `row.get("Teacher's_Comments", "")` / `row["Email"]`
+access the builders already use; sheet headers map to slot names. A column
+the sheet does not have is left unset, so get() falls back to its default
+just as a dict without that key would. Columns a record type does not
+declare are never read.
+"""
+
+import re
+from datetime import datetime
+
+from schema import SchemaError, TabSchema
+
+# Sheet dates are "YYYY-MM-DD", optionally followed by a time
+SHEET_DATE_FORMAT = "%Y-%m-%d"
+
+
+def _slot_name(column: str) -> str:
+    """Sheet header -> attribute name: "Customer Mobile No." -> "customer_mobile_no_"."""
+    return re.sub(r"\W", "_", column).lower()
+
+
+def _columns(*names) -> dict:
+    columns = {name: _slot_name(name) for name in names}
+    assert len(set(columns.values())) == len(columns), "record slot names must be unique"
+    return columns
+
+
+# ---------------- RECORD TYPES -----------------
+class Record:
+    """One sheet row; subclasses list the sheet columns they keep in COLUMNS."""
+
+    __slots__ = ()
+    COLUMNS: dict = {}  # sheet header -> slot name
+
+    def get(self, column: str, default=None):
+        slot = self.COLUMNS.get(column)
+        return getattr(self, slot, default) if slot else default
+
+    def __getitem__(self, column: str):
+        try:
+            return getattr(self, self.COLUMNS[column])
+        except (KeyError, AttributeError):
+            raise KeyError(column) from None
+
+    def __contains__(self, column: str) -> bool:
+        slot = self.COLUMNS.get(column)
+        return slot is not None and hasattr(self, slot)
+
+    def as_dict(self) -> dict:
+        return {c: getattr(self, s) for c, s in self.COLUMNS.items() if hasattr(self, s)}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.as_dict()!r})"
+
+
+class Reminder(Record):
+    """A Time_Table / Time_Table_2 row (email, SMS and WhatsApp reminders)."""
+
+    COLUMNS = _columns(
+        "Reminder_Date", "Customer", "Email", "Phone", "Course", "Session", "Teacher",
+        "Level", "Teacher_Email", "Zoom_link", "Meeting_id", "Passcode", "Message",
+    )
+    __slots__ = tuple(COLUMNS.values())
+
+
+class ProgressReport(Record):
+    """A Current_Report row."""
+
+    COLUMNS = _columns(
+        "Report_Date", "Student_Email", "Student_Name", "Course", "Level", "Teacher",
+        "Teacher_Email", "Course_Month", "Course_Year", "Cognitive_Goals",
+        "Teacher's_Comments", "General_Comment",
+    )
+    __slots__ = tuple(COLUMNS.values())
+
+
+class InvoiceLine(Record):
+    """One line item of the Invoices tab; an invoice is all lines sharing an Invoice Number."""
+
+    COLUMNS = _columns(
+        "Invoice Date", "Invoice Number", "Customer Email", "Customer Mobile No.",
+        "Customer Mobile No", "Student", "Service Month", "Service Year", "Course", "Course_",
+        "Course Type", "Level", "Teacher", "COUNT of Class No", "Rate", "Amount",
+        "Amount after Discount", "Discount Type 1", "Discount Type 2", "Discount Type 3",
+    )
+    __slots__ = tuple(COLUMNS.values())
+
+
+# ---------------- CELL CONVERSION -----------------
+def _text(cell) -> str:
+    return cell.strip() if type(cell) is str else str(cell).strip()
+
+
+def _number(text: str) -> float:
+    try:
+        return float(text.replace(",", "").replace("$", "").replace("%", ""))
+    except ValueError:
+        return float("nan")
+
+
+def _converter(column: str, schema: TabSchema):
+    """cell -> value for one column; repeated cells are converted once."""
+    if column in schema.numeric:
+        memo = {}
+
+        def convert(cell):
+            value = memo.get(cell)
+            if value is None:
+                value = memo[cell] = _number(_text(cell))
+            return value
+        return convert
+
+    if column in schema.categorical:
+        memo = {}
+
+        def convert(cell):
+            value = memo.get(cell)
+            if value is None:
+                value = memo[cell] = _text(cell)
+            return value
+        return convert
+
+    return _text
+
+
+def _date_matcher(dates):
+    """cell -> True if its date part is one of `dates` ("YYYY-MM-DD" strings)."""
+    targets = {datetime.strptime(d, SHEET_DATE_FORMAT).date() for d in dates}
+    memo = {}
+
+    def matches(cell) -> bool:
+        hit = memo.get(cell)
+        if hit is None:
+            try:
+                hit = datetime.strptime(_text(cell)[:10], SHEET_DATE_FORMAT).date() in targets
+            except ValueError:
+                hit = False
+            memo[cell] = hit
+        return hit
+    return matches
+
+
+# ---------------- READ -----------------
+def read_records(values: list, schema: TabSchema, record_type, require=(),
+                 date_column: str | None = None, dates=None):
+    """
+    Records of `record_type` from a tab's values (header row first), keeping
+    only rows whose `date_column` falls on one of `dates` when both are given.
+
+    The header is checked at call time; SchemaError lists missing required
+    columns. Rows are converted lazily as the returned iterator is consumed.
+    """
+    header = [str(c).strip() for c in values[0]] if values else []
+    for typed, canonical in schema.aliases:
+        if typed in header and canonical not in header:
+            header[header.index(typed)] = canonical
+
+    missing = [c for c in dict.fromkeys((*schema.required, *require)) if c not in header]
+    if missing:
+        raise SchemaError(f"{schema.name}: missing column(s) {', '.join(missing)}")
+
+    plan = {}  # slot -> (cell index, converter); on duplicate headers the first column wins
+    for i, column in enumerate(header):
+        slot = record_type.COLUMNS.get(column)
+        if slot and slot not in plan:
+            plan[slot] = (i, _converter(column, schema))
+    plan = [(slot, i, convert) for slot, (i, convert) in plan.items()]
+
+    date_idx = header.index(date_column) if dates and date_column in header else None
+    matches = _date_matcher(dates) if date_idx is not None else None
+
+    def stream():
+        if dates and date_column and date_idx is None:
+            return  # nothing can match a date column the tab does not have
+        new = record_type.__new__
+        for row in values[1:]:
+            width = len(row)
+            if matches is not None and not (date_idx < width and matches(row[date_idx])):
+                continue
+            record = new(record_type)
+            for slot, i, convert in plan:
+                setattr(record, slot, convert(row[i] if i < width else ""))
+            yield record
+
+    return stream()
+
+
+def group_by(records, column: str) -> dict:
+    """column value -> its records in sheet order, in one pass."""
+    slot = _slot_name(column)
+    groups = {}
+    for record in records:
+        groups.setdefault(getattr(record, slot, ""), []).append(record)
+    return groups
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Render-only batch mode: run a job's full selection and rendering for a
+chosen date and write every finished message to disk instead of sending it.
+
+    python Invoice_Automation.py render [--date YYYY-MM-DD] [--out DIR] [--sheet-json FILE]
+    python Progress_Report.py    render [--date YYYY-MM-DD] [--out DIR] [--sheet-json FILE]
+
+Messages are composed into a throwaway in-memory outbox, so the real outbox,
+its watermarks and SMTP are never touched. Each message is written as
+<name>.eml, byte for byte what would go over SMTP (Bcc recipients are
+envelope-only, so they are not in the file). Its PDF, if any, is written
+next to it. A file that already exists is never overwritten: two messages
+with the same name, or a leftover from an earlier render, stop the run.
+Render into an empty --out directory. Invoice PDFs render in the usual process pool. Progress reports
+render serially: each one is a template fill of well under a millisecond,
+so shipping it to a worker process would cost more than it saves.
+
+PDF header and footer images are taken only from the local asset cache
+(ASSET_CACHE_DIR, filled by any normal invoice run) and never downloaded.
+An image that is not cached yet is left out of the PDF, so that file then
+differs from what a send would attach.
+
+--sheet-json reads the tab from a file instead of Google Sheets: either a
+plain values grid (header row first) or a saved Sheets API response with a
+"values" key. With it, nothing touches the network. Use it to pre-stage a
+month-end batch, to profile rendering on its own (see METRICS_DIR), or to
+diff the output of two versions.
+"""
+
+import os
+import re
+import json
+import argparse
+from datetime import datetime, timezone
+
+from sheets import preload
+from outbox import Outbox
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+RENDER_DIR = os.getenv("RENDER_DIR", "rendered")
+
+
+# ---------------- ARGUMENTS -----------------
+def is_render_mode(argv) -> bool:
+    return len(argv) > 1 and argv[1] == "render"
+
+
+def parse_render_args(argv, job: str) -> argparse.Namespace:
+    """Options after `render`. The output directory defaults to RENDER_DIR/<job>/<date>."""
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(argv[0])} render",
+        description="Render messages to disk without sending them.",
+        epilog="Invoice PDFs render in a process pool; progress reports render serially. "
+               "PDF images come only from the local asset cache (ASSET_CACHE_DIR); "
+               "an image not cached yet is left out.",
+    )
+    parser.add_argument("--date", default=datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+                        help="sheet date to render (YYYY-MM-DD, default today UTC)")
+    parser.add_argument("--out", help="output directory")
+    parser.add_argument("--sheet-json", help="read the tab from this JSON file instead of Google Sheets")
+    args = parser.parse_args(argv[2:])
+    try:
+        datetime.strptime(args.date, "%Y-%m-%d")
+    except ValueError:
+        parser.error(f"--date must be YYYY-MM-DD, got '{args.date}'")
+    args.out = args.out or os.path.join(RENDER_DIR, job, args.date)
+    return args
+
+
+def load_sheet_json(path: str, spreadsheet_id: str, range_name: str):
+    """Serve `range_name` from a local JSON file for the rest of the process."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    grid = data.get("values", []) if isinstance(data, dict) else data
+    preload(spreadsheet_id, range_name, grid)
+    log_message(f"📥 {range_name}: {max(len(grid) - 1, 0)} row(s) loaded from {path}")
+
+
+def render_outbox() -> Outbox:
+    """Scratch outbox for one render run; nothing is persisted."""
+    return Outbox(":memory:")
+
+
+# ---------------- OUTPUT -----------------
+def safe_filename(name: str) -> str:
+    return re.sub(r"[^\w.@+-]+", "_", str(name)).strip("._") or "message"
+
+
+def _create(path: str):
+    """Open a new output file; an existing one is an error, never overwritten."""
+    try:
+        return open(path, "xb")
+    except FileExistsError:
+        raise FileExistsError(f"{path} already exists — render into an empty --out directory") from None
+
+
+def write_rendered(outbox: Outbox, job: str, out_dir: str, build_message) -> int:
+    """
+    Write every message `job` queued in `outbox` to `out_dir`.
+    build_message(entry) -> (file name stem, MimeMessage).
+    Returns the number of messages written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    total_bytes = 0
+    while True:
+        entries = outbox.claim(job)
+        if not entries:
+            break
+        for entry in entries:
+            name, message = build_message(entry)
+            stem = safe_filename(name)
+            with _create(os.path.join(out_dir, f"{stem}.eml")) as f:
+                for chunk in message.chunks:
+                    f.write(chunk)
+            total_bytes += message.size
+            if entry.attachment:
+                pdf_name = safe_filename(entry.payload.get("pdf_filename") or f"{stem}.pdf")
+                with _create(os.path.join(out_dir, pdf_name)) as f:
+                    f.write(entry.attachment)
+            outbox.mark(entry.key, True)
+            written += 1
+
+    log_message(f"💾 Rendered {written} message(s) for {job} → {out_dir} ({total_bytes:,} bytes of .eml)")
+    return written
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Timeouts, retry budgets and the run deadline shared by every outbound call.
+
+  - timeouts(provider) -> (connect, read) seconds for SMTP, Sheets, Twilio
+    and WhatsApp connections. CONNECT_TIMEOUT_SECONDS / READ_TIMEOUT_SECONDS
+    set the defaults; e.g. SMTP_READ_TIMEOUT_SECONDS overrides one provider.
+  - Each provider gets a retry budget for the whole run (RETRY_BUDGET_SHEETS,
+    ...). Every retry spends one. Once the budget is spent, calls fail on the
+    first error instead of backing off again and again against a provider
+    that is down.
+  - Retries wait an exponential back-off with full jitter, capped at
+    RETRY_MAX_DELAY_SECONDS.
+  - RUN_DEADLINE_SECONDS (counted from process start, 0 = none) is when the
+    run stops dispatching. Messages not sent by then stay in the outbox for
+    the next run and are reported as left unsent, instead of the job hanging
+    until the GitHub Actions timeout kills it.
+"""
+
+import os
+import math
+import time
+import random
+import threading
+
+from metrics import stage_timer
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("CONNECT_TIMEOUT_SECONDS", "10"))
+READ_TIMEOUT_SECONDS = float(os.getenv("READ_TIMEOUT_SECONDS", "60"))
+
+# Retries each provider may spend over the whole run
+RETRY_BUDGETS = {
+    "sheets": int(os.getenv("RETRY_BUDGET_SHEETS", "10")),
+    "smtp": int(os.getenv("RETRY_BUDGET_SMTP", "20")),
+    "twilio": int(os.getenv("RETRY_BUDGET_TWILIO", "50")),
+    "whatsapp": int(os.getenv("RETRY_BUDGET_WHATSAPP", "100")),
+}
+DEFAULT_RETRY_BUDGET = 10
+
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "30"))
+
+RUN_DEADLINE_SECONDS = float(os.getenv("RUN_DEADLINE_SECONDS", "2400"))
+
+timer = stage_timer("resilience")
+
+
+# ---------------- TIMEOUTS -----------------
+def timeouts(provider: str) -> tuple:
+    """(connect, read) timeout in seconds for one provider's connections."""
+    prefix = provider.upper()
+    return (
+        float(os.getenv(f"{prefix}_CONNECT_TIMEOUT_SECONDS", CONNECT_TIMEOUT_SECONDS)),
+        float(os.getenv(f"{prefix}_READ_TIMEOUT_SECONDS", READ_TIMEOUT_SECONDS)),
+    )
+
+
+# ---------------- RUN DEADLINE -----------------
+class DeadlineExceeded(TimeoutError):
+    """The run deadline passed; nothing more should be dispatched."""
+
+
+class DeliveryUncertain(Exception):
+    """
+    A send failed after the provider may already have accepted the message
+    (e.g. the connection dropped after SMTP DATA). Resending could deliver
+    it twice, so the outbox records it as uncertain and does not retry it.
+    """
+
+
+class RunDeadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self._reported = False
+
+    def remaining(self) -> float:
+        if self.seconds <= 0:
+            return math.inf
+        return self.seconds - (time.monotonic() - self.started)
+
+    def expired(self) -> bool:
+        expired = self.remaining() <= 0
+        if expired and not self._reported:
+            self._reported = True
+            log_message(f"⏰ Run deadline of {self.seconds:.0f}s reached — no further messages will be dispatched")
+        return expired
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(f"run deadline of {self.seconds:.0f}s reached")
+
+    def sleep(self, seconds: float):
+        """time.sleep that raises DeadlineExceeded instead of sleeping past the deadline."""
+        if seconds >= self.remaining():
+            raise DeadlineExceeded(f"waiting {seconds:.0f}s would pass the run deadline")
+        time.sleep(max(0.0, seconds))
+
+
+deadline = RunDeadline(RUN_DEADLINE_SECONDS)
+
+
+# ---------------- RETRY BUDGET -----------------
+class RetryBudget:
+    def __init__(self, provider: str, retries: int):
+        self.provider = provider
+        self.left = retries
+        self._lock = threading.Lock()
+
+    def spend(self) -> bool:
+        """Take one retry; False (and a single warning) once the budget is used up."""
+        with self._lock:
+            if self.left <= 0:
+                if self.left == 0:
+                    self.left = -1
+                    log_message(f"🪫 {self.provider}: retry budget used up — failing fast from now on")
+                return False
+            self.left -= 1
+        timer.count(f"{self.provider}_retry")
+        return True
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def retry_budget(provider: str) -> RetryBudget:
+    with _budgets_lock:
+        budget = _budgets.get(provider)
+        if budget is None:
+            budget = _budgets[provider] = RetryBudget(provider, RETRY_BUDGETS.get(provider, DEFAULT_RETRY_BUDGET))
+        return budget
+
+
+# ---------------- BACK-OFF -----------------
+def backoff_delay(attempt: int, base: float = RETRY_BASE_SECONDS, cap: float = RETRY_MAX_DELAY_SECONDS) -> float:
+    """Full-jitter exponential back-off, so parallel workers don't retry in lockstep."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def wait_before_retry(provider: str, attempt: int, delay: float | None = None) -> bool:
+    """
+    Spend one retry from `provider`'s budget and sleep the back-off (or
+    `delay`). False if the budget is used up or the wait would pass the run
+    deadline; the caller should give up then.
+    """
+    if not retry_budget(provider).spend():
+        return False
+    try:
+        deadline.sleep(backoff_delay(attempt) if delay is None else delay)
+    except DeadlineExceeded:
+        return False
+    return True
+
+
+def call_with_retry(provider: str, fn, is_retryable, attempts: int = 4):
+    """
+    fn() with up to `attempts` tries. Errors for which is_retryable(error) is
+    true are retried after a back-off while the provider's budget and the run
+    deadline allow it. Anything else is raised straight away.
+    """
+    for attempt in range(1, attempts + 1):
+        deadline.check()
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts or not is_retryable(e):
+                raise
+            if not wait_before_retry(provider, attempt):
+                raise
+            log_message(f"🔁 {provider}: {type(e).__name__}: {e} — retrying (attempt {attempt + 1}/{attempts})")
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Run any subset of the automation jobs in one process.
+
+    python runner.py                          all jobs, compose and send
+    python runner.py sms_reminders invoices   selected jobs only
+    python runner.py compose email_reminders  only compose into the outbox
+    python runner.py send                     only drain the outbox
+    python runner.py prepare                  render the coming days ahead (see lookahead.py)
+
+Each sheet range the selected jobs read is prefetched up front, with one
+batchGet per spreadsheet. main.py and sms_reminder.py share the same
+Time_Table read. The jobs then run concurrently in threads. All of them
+share the process-wide clients: the SMTP pool, the Twilio client, the
+Google services and the per-channel dispatch limits. Each job gets its own
+summary at the end. One failing job does not stop the others.
+"""
+
+import sys
+import time
+import importlib
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from lookahead import LOOKAHEAD_DAYS, is_prepare_mode
+from metrics import write_run_metrics
+from outbox import run_mode
+from sheets import prefetch
+from utils import log_message
+
+# ---------------- JOBS -----------------
+# job name (= outbox job) -> (module, process function)
+JOBS = {
+    "email_reminders":    ("main",               "process_reminders"),
+    "sms_reminders":      ("sms_reminder",       "process_reminders"),
+    "whatsapp_reminders": ("whatsapp_reminder",  "process_reminders"),
+    "progress_reports":   ("Progress_Report",    "process_reminders"),
+    "invoices":           ("Invoice_Automation", "process_invoices"),
+}
+
+# job name -> prepare function, for the jobs that can render days ahead
+PREPARE = {
+    "email_reminders":    "prepare_reminders",
+    "sms_reminders":      "prepare_reminders",
+    "whatsapp_reminders": "prepare_reminders",
+    "progress_reports":   "prepare_reports",
+}
+
+MODES = ("all", "compose", "send")
+
+
+# ---------------- RESULT -----------------
+@dataclass
+class JobResult:
+    job: str
+    summary: object = None  # DispatchSummary, or None when nothing was sent
+    error: str = ""
+    elapsed: float = 0.0
+    prepared: int | None = None  # set by prepare runs
+
+    def log(self):
+        if self.error:
+            log_message(f"❌ {self.job}: {self.error} ({self.elapsed:.2f}s)")
+        elif self.prepared is not None:
+            log_message(f"✅ {self.job}: {self.prepared} message(s) prepared ({self.elapsed:.2f}s)")
+        elif self.summary is None:
+            log_message(f"✅ {self.job}: nothing sent ({self.elapsed:.2f}s)")
+        else:
+            log_message(
+                f"✅ {self.job}: sent {self.summary.sent} | failed {self.summary.failed} "
+                + (f"| left unsent {self.summary.unsent} " if self.summary.unsent else "")
+                + f"({self.elapsed:.2f}s)"
+            )
+
+
+# ---------------- ARGUMENTS -----------------
+def parse_args(argv) -> tuple:
+    """argv -> (job names, compose, send)"""
+    args = list(argv[1:])
+    mode = args.pop(0) if args and args[0] in MODES else "all"
+    jobs = args or list(JOBS)
+    unknown = [j for j in jobs if j not in JOBS]
+    if unknown:
+        raise ValueError(f"Unknown job(s): {', '.join(unknown)} (expected {', '.join(JOBS)})")
+    compose, send = run_mode([argv[0], mode])
+    return list(dict.fromkeys(jobs)), compose, send
+
+
+def parse_prepare_args(argv) -> list:
+    """`runner.py prepare [job ...]` -> job names"""
+    jobs = list(argv[2:]) or list(PREPARE)
+    unknown = [j for j in jobs if j not in PREPARE]
+    if unknown:
+        raise ValueError(f"Cannot prepare job(s): {', '.join(unknown)} (expected {', '.join(PREPARE)})")
+    return list(dict.fromkeys(jobs))
+
+
+# ---------------- RUN -----------------
+def _run_job(job: str, module, compose: bool, send: bool) -> JobResult:
+    started = time.perf_counter()
+    try:
+        summary = getattr(module, JOBS[job][1])(compose, send)
+        return JobResult(job, summary, elapsed=time.perf_counter() - started)
+    except Exception as e:
+        return JobResult(job, error=f"{type(e).__name__}: {e}", elapsed=time.perf_counter() - started)
+
+
+def _prefetch(modules):
+    wanted = {}
+    for module in modules.values():
+        wanted.setdefault(module.SPREADSHEET_ID, []).append(module.RANGE_NAME)
+    try:
+        prefetch(wanted)
+    except Exception as e:
+        # Jobs fall back to reading the sheet themselves
+        log_message(f"⚠️ Shared sheet prefetch failed: {e}")
+
+
+def run_jobs(jobs, compose: bool = True, send: bool = True) -> list:
+    modules = {job: importlib.import_module(JOBS[job][0]) for job in jobs}
+
+    if compose:
+        _prefetch(modules)
+
+    log_message(f"🚀 Running {len(jobs)} job(s): {', '.join(jobs)}")
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="job") as pool:
+        futures = [pool.submit(_run_job, job, modules[job], compose, send) for job in jobs]
+        results = [f.result() for f in futures]
+
+    log_message("📊 Run summary")
+    for result in results:
+        result.log()
+    return results
+
+
+def _prepare_job(job: str, module, days: int) -> JobResult:
+    started = time.perf_counter()
+    try:
+        prepared = getattr(module, PREPARE[job])(days)
+        return JobResult(job, prepared=prepared, elapsed=time.perf_counter() - started)
+    except Exception as e:
+        return JobResult(job, error=f"{type(e).__name__}: {e}", elapsed=time.perf_counter() - started)
+
+
+def prepare_jobs(jobs, days: int = LOOKAHEAD_DAYS) -> list:
+    """Render the next `days` days of each job's messages ahead of its send run."""
+    modules = {job: importlib.import_module(JOBS[job][0]) for job in jobs}
+    _prefetch(modules)
+
+    log_message(f"🗓️ Preparing {len(jobs)} job(s) {days} day(s) ahead: {', '.join(jobs)}")
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="prepare") as pool:
+        futures = [pool.submit(_prepare_job, job, modules[job], days) for job in jobs]
+        results = [f.result() for f in futures]
+
+    log_message("📊 Prepare summary")
+    for result in results:
+        result.log()
+    return results
+
+
+# ---------------- MAIN -----------------
+if __name__ == "__main__":
+    if is_prepare_mode(sys.argv):
+        results = prepare_jobs(parse_prepare_args(sys.argv))
+        write_run_metrics("runner_prepare")
+    else:
+        jobs, compose, send = parse_args(sys.argv)
+        results = run_jobs(jobs, compose, send)
+        write_run_metrics("runner")
+    sys.exit(1 if any(r.error for r in results) else 0)
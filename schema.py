@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Declared schemas for the sheet tabs the jobs read.
+
+records.read_records() applies them while streaming rows into records:
+
+  - header names are stripped and known aliases renamed
+  - required headers are checked up front; SchemaError lists what is missing
+  - date columns are what the per-run date filter parses
+  - amount columns ("$1,200.00", "15%") become floats, and blanks become NaN
+  - repeated values (Course, Teacher, Session, Level, ...) share one string
+"""
+
+from dataclasses import dataclass
+
+
+class SchemaError(ValueError):
+    """A tab is missing headers its readers need."""
+
+
+@dataclass(frozen=True)
+class TabSchema:
+    name: str
+    required: tuple = ()
+    dates: tuple = ()
+    numeric: tuple = ()
+    categorical: tuple = ()
+    aliases: tuple = ()  # (header as typed in the sheet, canonical name)
+
+
+# ---------------- TABS -----------------
+# Time_Table is read by both main.py and sms_reminder.py; each job passes the
+# extra columns only it needs as `require`.
+TIME_TABLE = TabSchema(
+    name="Time_Table",
+    required=("Reminder_Date", "Customer", "Course", "Session"),
+    dates=("Reminder_Date",),
+    categorical=("Course", "Session", "Teacher", "Level", "Teacher_Email",
+                 "Zoom_link", "Meeting_id", "Passcode", "Message"),
+)
+
+TIME_TABLE_2 = TabSchema(
+    name="Time_Table_2",
+    required=("Reminder_Date", "Customer", "Phone", "Course", "Session", "Zoom_link"),
+    dates=("Reminder_Date",),
+    categorical=("Course", "Session", "Teacher", "Level", "Zoom_link"),
+)
+
+CURRENT_REPORT = TabSchema(
+    name="Current_Report",
+    required=("Report_Date", "Student_Email"),
+    dates=("Report_Date",),
+    categorical=("Course", "Level", "Teacher", "Teacher_Email", "Course_Month", "Course_Year"),
+)
+
+INVOICES = TabSchema(
+    name="Invoices",
+    required=("Invoice Date", "Invoice Number", "Customer Email"),
+    dates=("Invoice Date",),
+    numeric=("Rate", "Amount", "Amount after Discount"),
+    categorical=("Course", "Course_", "Course Type", "Level", "Teacher", "Service Month",
+                 "Service Year", "Discount Type 1", "Discount Type 2", "Discount Type 3"),
+    aliases=(("Invoice Numeber", "Invoice Number"),),
+)
+
+SCHEMAS = {s.name: s for s in (TIME_TABLE, TIME_TABLE_2, CURRENT_REPORT, INVOICES)}
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Shared Google Sheets reader.
+
+Credentials and the Sheets/Drive services are built once per process, on
+first use, from the bundled static discovery documents, so no discovery fetch
+happens. The Google client libraries are only imported at that point.
+Fetched values are cached on disk under SHEETS_CACHE_DIR. The cache key is
+spreadsheet + range + the file's Drive revision. A repeated run against an
+unchanged sheet makes one small metadata call instead of downloading the
+whole range.
+
+GOOGLE_API_ENDPOINT points both services at a local stand-in (no
+credentials are used then), for benchmarking.
+
+Every request has a socket timeout. Rate-limit and 5xx replies, timeouts
+and connection errors are retried with back-off under the "sheets" retry
+budget and the run deadline (see resilience.py).
+
+prefetch() reads every range several jobs need in one batchGet per
+spreadsheet. Later reads of those ranges in the same process are served
+from memory.
+"""
+
+import os
+import json
+import base64
+import hashlib
+import threading
+
+from metrics import stage_timer
+from resilience import call_with_retry, timeouts
+from utils import log_message
+
+# ---------------- CONFIG -----------------
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+SHEETS_CACHE_DIR = os.getenv("SHEETS_CACHE_DIR", ".sheets_cache")
+GOOGLE_API_ENDPOINT = os.getenv("GOOGLE_API_ENDPOINT", "")
+
+# Responses worth retrying (rate limit / transient server errors); anything else fails at once
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_lock = threading.Lock()
+_services = {}
+
+# (spreadsheet_id, range) -> values grid, filled by prefetch()
+_prefetched = {}
+
+timer = stage_timer("sheets")
+
+
+# ---------------- SERVICE ACCOUNT -----------------
+def load_service_account_info() -> dict:
+    if "SERVICE_ACCOUNT_JSON" not in os.environ:
+        raise ValueError("SERVICE_ACCOUNT_JSON environment variable is not set!")
+    return json.loads(
+        base64.b64decode(os.environ["SERVICE_ACCOUNT_JSON"]).decode("utf-8")
+    )
+
+
+def _get_service(name: str, version: str):
+    with _lock:
+        service = _services.get(name)
+        if service is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.discovery import build
+            from google.oauth2.service_account import Credentials
+
+            client_options = None
+            creds = _services.get("_creds")
+            if GOOGLE_API_ENDPOINT:
+                from google.auth.credentials import AnonymousCredentials
+
+                creds = AnonymousCredentials()
+                client_options = {"api_endpoint": GOOGLE_API_ENDPOINT}
+            elif creds is None:
+                creds = Credentials.from_service_account_info(
+                    load_service_account_info(), scopes=SCOPES
+                )
+                _services["_creds"] = creds
+            # httplib2 has a single socket timeout, used for the connect and every read
+            http = AuthorizedHttp(creds, http=httplib2.Http(timeout=timeouts("sheets")[1]))
+            service = build(
+                name,
+                version,
+                http=http,
+                cache_discovery=False,
+                static_discovery=True,
+                client_options=client_options,
+            )
+            _services[name] = service
+        return service
+
+
+def get_sheets_service():
+    return _get_service("sheets", "v4")
+
+
+def get_drive_service():
+    return _get_service("drive", "v3")
+
+
+def _is_retryable(error) -> bool:
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS
+    # socket timeouts, resets and DNS failures (httplib2 raises its own types for some)
+    return isinstance(error, OSError) or type(error).__module__.startswith("httplib2")
+
+
+def _execute(request):
+    """request.execute() under the Sheets retry budget and the run deadline."""
+    return call_with_retry("sheets", request.execute, _is_retryable)
+
+
+# ---------------- REVISION -----------------
+def get_revision(spreadsheet_id: str) -> str | None:
+    """Drive's monotonically increasing file version, or None if unavailable."""
+    try:
+        with timer.span("revision"):
+            meta = _execute(get_drive_service().files().get(
+                fileId=spreadsheet_id,
+                fields="version",
+                supportsAllDrives=True,
+            ))
+        return str(meta.get("version") or "") or None
+    except Exception as e:
+        log_message(f"⚠️ Could not read sheet revision, cache bypassed: {e}")
+        return None
+
+
+# ---------------- DISK CACHE -----------------
+# Layout: SHEETS_CACHE_DIR/<spreadsheet_id>/<ranges digest>_<revision>.json
+def _cache_prefix(spreadsheet_id: str, ranges: list) -> str:
+    digest = hashlib.sha1("|".join(ranges).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SHEETS_CACHE_DIR, spreadsheet_id, digest)
+
+
+def _cache_load(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _cache_store(prefix: str, revision: str, values):
+    folder = os.path.dirname(prefix)
+    os.makedirs(folder, exist_ok=True)
+    path = f"{prefix}_{revision}.json"
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(values, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+    # Entries from older revisions of this spreadsheet are never read again
+    for name in os.listdir(folder):
+        if name.endswith(".json") and not name.endswith(f"_{revision}.json"):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+
+# ---------------- READ VALUES -----------------
+def _read_ranges(spreadsheet_id: str, ranges: list, revision: str | None) -> list:
+    """Fetch several ranges in one batchGet, through the revision-keyed cache."""
+    prefix = _cache_prefix(spreadsheet_id, ranges)
+
+    if revision:
+        cached = _cache_load(f"{prefix}_{revision}.json")
+        if cached is not None:
+            timer.count("cache_hit")
+            log_message(f"💾 Sheet cache hit: {', '.join(ranges)[:80]} (revision {revision})")
+            return cached
+
+    values = get_sheets_service().spreadsheets().values()
+    with timer.span("api"):
+        if len(ranges) == 1:
+            result = _execute(values.get(
+                spreadsheetId=spreadsheet_id,
+                range=ranges[0]
+            ))
+            grids = [result.get("values", [])]
+        else:
+            result = _execute(values.batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=ranges
+            ))
+            grids = [vr.get("values", []) for vr in result.get("valueRanges", [])]
+
+    if revision and any(grids):
+        try:
+            _cache_store(prefix, revision, grids)
+        except OSError as e:
+            log_message(f"⚠️ Could not write sheet cache: {e}")
+    return grids
+
+
+def read_values(spreadsheet_id: str, range_name: str) -> list:
+    """Return the raw `values` grid (header row first) for a range."""
+    grid = _prefetched.get((spreadsheet_id, range_name))
+    if grid is not None:
+        return grid
+    revision = get_revision(spreadsheet_id)
+    return _read_ranges(spreadsheet_id, [range_name], revision)[0]
+
+
+# ---------------- DATE-FILTERED READ -----------------
+# Ranges per batchGet request; keeps the request URL well under Google's limit
+BATCH_GET_CHUNK = 100
+
+
+def column_letter(index: int) -> str:
+    """0 -> A, 25 -> Z, 26 -> AA"""
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _row_blocks(row_numbers):
+    """Collapse sorted sheet row numbers into contiguous (start, end) blocks."""
+    blocks = []
+    for n in row_numbers:
+        if blocks and n == blocks[-1][1] + 1:
+            blocks[-1][1] = n
+        else:
+            blocks.append([n, n])
+    return blocks
+
+
+def _date_matches(cell, dates) -> bool:
+    return str(cell).strip().split(" ")[0] in dates
+
+
+def _filter_rows(grid: list, date_column: str, dates: set) -> list:
+    """Header plus the rows of an in-memory grid whose `date_column` is in `dates`."""
+    if not grid:
+        return grid
+    names = [str(c).strip() for c in grid[0]]
+    if date_column not in names:
+        return grid
+    idx = names.index(date_column)
+    return [grid[0]] + [row for row in grid[1:] if len(row) > idx and _date_matches(row[idx], dates)]
+
+
+def read_rows_for_dates(spreadsheet_id: str, sheet_name: str, date_column: str, dates) -> list:
+    """
+    Return the header row plus only the rows whose `date_column` falls on one
+    of `dates` ("YYYY-MM-DD" strings).
+
+    Reads the header and the date column first. It then batchGets just the
+    matching row blocks instead of the whole tab. If the tab was prefetched,
+    the rows are filtered locally instead.
+    """
+    dates = set(dates)
+    grid = _prefetched.get((spreadsheet_id, sheet_name))
+    if grid is not None:
+        return _filter_rows(grid, date_column, dates)
+
+    revision = get_revision(spreadsheet_id)
+
+    header_grid, = _read_ranges(spreadsheet_id, [f"{sheet_name}!1:1"], revision)
+    header = header_grid[0] if header_grid else []
+    names = [str(c).strip() for c in header]
+    if date_column not in names:
+        log_message(f"⚠️ Column '{date_column}' not found in {sheet_name}, reading full range")
+        return _read_ranges(spreadsheet_id, [sheet_name], revision)[0]
+
+    date_col = column_letter(names.index(date_column))
+    last_col = column_letter(len(header) - 1)
+
+    date_cells, = _read_ranges(spreadsheet_id, [f"{sheet_name}!{date_col}2:{date_col}"], revision)
+    matches = [
+        i + 2
+        for i, cell in enumerate(date_cells)
+        if cell and _date_matches(cell[0], dates)
+    ]
+    if not matches:
+        return [header]
+
+    ranges = [f"{sheet_name}!A{start}:{last_col}{end}" for start, end in _row_blocks(matches)]
+    rows = []
+    for i in range(0, len(ranges), BATCH_GET_CHUNK):
+        for grid in _read_ranges(spreadsheet_id, ranges[i:i + BATCH_GET_CHUNK], revision):
+            rows.extend(grid)
+
+    log_message(
+        f"🔎 {sheet_name}: {len(matches)} of {len(date_cells)} row(s) match "
+        f"{', '.join(sorted(dates))} ({len(ranges)} block(s))"
+    )
+    return [header] + rows
+
+
+# ---------------- SHARED PREFETCH -----------------
+def prefetch(wanted: dict):
+    """
+    Read {spreadsheet_id: [range, ...]} up front with one batchGet per
+    spreadsheet. read_values / read_rows_for_dates then serve those ranges
+    from memory for the rest of the process. preload() does the same for a grid
+read from elsewhere (render mode's --sheet-json).
+    """
+    for spreadsheet_id, ranges in wanted.items():
+        ranges = list(dict.fromkeys(ranges))
+        revision = get_revision(spreadsheet_id)
+        grids = _read_ranges(spreadsheet_id, ranges, revision)
+        with _lock:
+            for range_name, grid in zip(ranges, grids):
+                _prefetched[(spreadsheet_id, range_name)] = grid
+        log_message(
+            f"📥 Prefetched {len(ranges)} range(s) from {spreadsheet_id}: "
+            f"{', '.join(f'{r} ({max(len(g) - 1, 0)} rows)' for r, g in zip(ranges, grids))}"
+        )
+
+
+def preload(spreadsheet_id: str, range_name: str, grid: list):
+    """Serve `range_name` from an already loaded grid (e.g. a local file) instead of the API."""
+    with _lock:
+        _prefetched[(spreadsheet_id, range_name)] = grid
@@ -1,34 +1,68 @@
 # -*- coding: utf-8 -*-
 import os
-import json
-import base64
+import sys
+import threading
 from datetime import datetime
-import pandas as pd
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
-from twilio.rest import Client
+from dispatch import TokenBucket, CHANNEL_LIMITS
+from outbox import Outbox, message_key, dispatch_batch, log_outbox, run_mode
+from sheets import read_values, read_rows_for_dates
+from schema import TIME_TABLE
+from records import Reminder, read_records
+from metrics import stage_timer, write_run_metrics
+from resilience import DeliveryUncertain, timeouts, wait_before_retry
+from lookahead import is_prepare_mode, parse_prepare_args, lookahead_dates, source_digest, prepare_rows, PreparedMessages
 
 # ---------------- GOOGLE SHEET CONFIG -----------------
 SPREADSHEET_ID = "1-gAUMbVOio3mTzfDstqjpnQdibP2oYjuF-vhX5UovCw"
 RANGE_NAME = "Time_Table"
 
+# ---------------- OUTBOX -----------------
+OUTBOX_JOB = "sms_reminders"
+timer = stage_timer(OUTBOX_JOB)
+
+# Prepared messages from an older version of this script or the shared rendering modules are re-rendered
+PREPARE_VERSION = source_digest(__file__)
+
 # ---------------- TWILIO SMS CONFIG -----------------
 TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
 TWILIO_FROM_NUMBER = os.environ.get("TWILIO_FROM_NUMBER")
 
-if not all([TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_FROM_NUMBER]):
-    raise ValueError("❌ Twilio environment variables are missing")
-
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-
-# ---------------- SERVICE ACCOUNT -----------------
-if "SERVICE_ACCOUNT_JSON" not in os.environ:
-    raise ValueError("SERVICE_ACCOUNT_JSON is missing")
-
-SERVICE_ACCOUNT_INFO = json.loads(
-    base64.b64decode(os.environ["SERVICE_ACCOUNT_JSON"]).decode("utf-8")
-)
+# Account messages-per-second limit (1 for a long code, higher for toll-free / short codes)
+TWILIO_MPS = float(os.environ.get("TWILIO_MPS", "1"))
+TWILIO_MAX_ATTEMPTS = 5
+
+# Point the client at a local Twilio stand-in for benchmarking
+TWILIO_API_BASE = os.environ.get("TWILIO_API_BASE", "")
+
+sms_rate_limiter = TokenBucket(TWILIO_MPS)
+
+# The Twilio client is built on the first send, so days with nothing to send never import it
+_twilio_client = None
+_twilio_lock = threading.Lock()
+
+def get_twilio_client():
+    global _twilio_client
+    with _twilio_lock:
+        if _twilio_client is None:
+            if not all([TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_FROM_NUMBER]):
+                raise ValueError("❌ Twilio environment variables are missing")
+
+            from requests.adapters import HTTPAdapter
+            from twilio.rest import Client
+            from twilio.http.http_client import TwilioHttpClient
+
+            # One pooled HTTP session sized to the number of parallel SMS workers,
+            # with (connect, read) timeouts so a hung request cannot stall a worker
+            http_client = TwilioHttpClient(pool_connections=True)
+            http_client.timeout = timeouts("twilio")  # passed to requests; the constructor only accepts a float
+            http_client.session.mount(
+                "https://", HTTPAdapter(pool_connections=1, pool_maxsize=CHANNEL_LIMITS["sms"])
+            )
+            _twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
+            if TWILIO_API_BASE:
+                _twilio_client.api.base_url = TWILIO_API_BASE
+        return _twilio_client
 
 # ---------------- LOG FUNCTION -----------------
 def log_message(message):
@@ -59,49 +93,33 @@ def log_message(message):
 #     log_message(f"✅ Sheet loaded. Rows: {len(df)}")
 #     return df
 
-def read_google_sheet(retries=3, timeout=60):
+def read_google_sheet(dates=None):
     log_message("📌 read_google_sheet() called")
+    # Transient API errors are already retried inside sheets.py (shared budget and deadline)
+    try:
+        with timer.span("fetch"):
+            if dates:
+                values = read_rows_for_dates(SPREADSHEET_ID, RANGE_NAME, "Reminder_Date", dates)
+            else:
+                values = read_values(SPREADSHEET_ID, RANGE_NAME)
+        if not values:
+            log_message("❌ No data found in Google Sheet.")
+            return None
+        if len(values) < 2:
+            log_message("ℹ️ No matching rows in Google Sheet.")
+            return None
+
+        with timer.span("parse"):
+            rows = list(read_records(
+                values, TIME_TABLE, Reminder, require=("Phone",),
+                date_column="Reminder_Date", dates=dates,
+            ))
+        log_message(f"✅ Sheet loaded. Rows: {len(rows)}")
+        return rows
 
-    creds = Credentials.from_service_account_info(
-        SERVICE_ACCOUNT_INFO,
-        scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    )
-
-    service = build(
-        "sheets",
-        "v4",
-        credentials=creds,
-        cache_discovery=False
-    )
-
-    for attempt in range(1, retries + 1):
-        try:
-            result = service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range=RANGE_NAME
-            ).execute(num_retries=3)
-
-            values = result.get("values", [])
-            if not values:
-                log_message("❌ No data found in Google Sheet.")
-                return None
-
-            df = pd.DataFrame(values[1:], columns=values[0])
-            log_message(f"✅ Sheet loaded. Rows: {len(df)}")
-            return df
-
-        except HttpError as e:
-            log_message(f"⚠️ Google API error (attempt {attempt}): {e}")
-        except TimeoutError:
-            log_message(f"⏱ Timeout (attempt {attempt})")
-        except Exception as e:
-            log_message(f"❌ Unexpected error: {e}")
-
-        if attempt < retries:
-            time.sleep(5)
-
-    log_message("❌ Failed to read Google Sheet after retries")
-    return None
+    except Exception as e:
+        log_message(f"❌ Failed to read Google Sheet: {e}")
+        return None
 
 
 # ---------------- SEND SMS -----------------
@@ -125,34 +143,60 @@ def send_sms(
         f"New Dimension Academy"
     )
 
-    try:
-        message = twilio_client.messages.create(
-            body=message_body,
-            from_=TWILIO_FROM_NUMBER,
-            to=to_phone
-        )
-
-        log_message(f"✅ SMS sent to {to_phone} (SID: {message.sid})")
-
-    except Exception as e:
-        log_message(f"❌ Failed to send SMS to {to_phone}: {str(e)}")
-
-# ---------------- PROCESS REMINDERS -----------------
-def process_reminders():
-    df = read_google_sheet()
-    if df is None:
-        return
-
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    log_message(f"📅 Processing reminders for {today_str}")
+    from requests.exceptions import ConnectTimeout, ConnectionError as RequestsConnectionError, ReadTimeout
+    from twilio.base.exceptions import TwilioRestException
+    twilio_client = get_twilio_client()
 
-    sent_count = 0
+    for attempt in range(1, TWILIO_MAX_ATTEMPTS + 1):
+        sms_rate_limiter.acquire()
+        try:
+            message = twilio_client.messages.create(
+                body=message_body,
+                from_=TWILIO_FROM_NUMBER,
+                to=to_phone
+            )
+
+            log_message(f"✅ SMS sent to {to_phone} (SID: {message.sid})")
+            return True
+
+        except TwilioRestException as e:
+            if e.status == 429 and attempt < TWILIO_MAX_ATTEMPTS:
+                log_message(f"⏳ Twilio 429 for {to_phone}, backing off (attempt {attempt})")
+                if wait_before_retry("twilio", attempt):
+                    continue
+            log_message(f"❌ Failed to send SMS to {to_phone}: {str(e)}")
+            raise  # dispatch records the reason in the outbox
+
+        except ConnectTimeout as e:
+            # Nothing reached Twilio, so a retry cannot send the SMS twice
+            log_message(f"⏱ Twilio connect timeout for {to_phone} (attempt {attempt})")
+            if attempt < TWILIO_MAX_ATTEMPTS and wait_before_retry("twilio", attempt):
+                continue
+            log_message(f"❌ Failed to send SMS to {to_phone}: {str(e)}")
+            raise  # dispatch records the reason in the outbox
+
+        except (ReadTimeout, RequestsConnectionError) as e:
+            # The request may already have reached Twilio; resending could deliver the SMS twice
+            log_message(f"⚠️ SMS to {to_phone} may have been sent: {str(e)}")
+            raise DeliveryUncertain(f"{type(e).__name__}: {e}") from e
 
-    for _, row in df.iterrows():
-        if row["Reminder_Date"] != today_str:
-            continue
+        except Exception as e:
+            log_message(f"❌ Failed to send SMS to {to_phone}: {str(e)}")
+            raise  # dispatch records the reason in the outbox
+
+# ---------------- COMPOSE REMINDERS -----------------
+def reminder_key(row, date_str):
+    return message_key(
+        f"{SPREADSHEET_ID}/{RANGE_NAME}",
+        (row["Phone"], row["Customer"], row["Course"], row["Session"]),
+        "sms",
+        date_str
+    )
 
-        send_sms(
+def build_reminder(row):
+    """row -> (recipient, outbox payload)"""
+    with timer.span("render"):
+        payload = dict(
             to_phone=row["Phone"],
             customer=row["Customer"],
             course=row["Course"],
@@ -160,11 +204,71 @@ def process_reminders():
             class_time=row["Session"],
             #zoom_link=row["Zoom_link"]
         )
+    return row["Phone"], payload
+
+def compose_reminders(outbox, today_str):
+    rows = read_google_sheet(dates=[today_str])
+    if rows is None:
+        return None
+
+    # Rendered the evening before by `sms_reminder.py prepare`, if it ran
+    prepared = PreparedMessages(outbox, OUTBOX_JOB, today_str, PREPARE_VERSION)
+
+    queued = 0
+    for row in rows:
+        key = reminder_key(row, today_str)
+        if outbox.has(key):
+            continue
+
+        if prepared.take(key, row):
+            queued += 1
+            continue
+
+        recipient, payload = build_reminder(row)
+        queued += outbox.enqueue(key, OUTBOX_JOB, "sms", recipient, payload, send_date=today_str)
+
+    prepared.log()
+    log_message(f"📝 SMS reminders queued: {queued}")
+    return queued
+
+# ---------------- PREPARE AHEAD -----------------
+def prepare_reminders(days, today_str=None):
+    """Render the next `days` days of reminders into the outbox's prepared table; nothing is queued."""
+    today_str = today_str or datetime.now().strftime("%Y-%m-%d")
+    dates = lookahead_dates(today_str, days)
+    log_message(f"🗓️ Preparing SMS reminders for {', '.join(dates)}")
+
+    rows = read_google_sheet(dates=dates)
+    if rows is None:
+        return 0
+    with timer.span("prepare"):
+        return prepare_rows(Outbox(), OUTBOX_JOB, "sms", rows, "Reminder_Date", PREPARE_VERSION, reminder_key, build_reminder)
+
+# ---------------- PROCESS REMINDERS -----------------
+def process_reminders(compose=True, send=True):
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    log_message(f"📅 Processing reminders for {today_str}")
+
+    outbox = Outbox()
+    summary = None
+    if compose:
+        compose_reminders(outbox, today_str)
 
-        sent_count += 1
+    if send:
+        # Only today's reminders; one left over from an earlier day would say "Today" a day late
+        summary = outbox.drain(OUTBOX_JOB, dispatch_batch("sms", send_sms), send_date=today_str)
+        timer.observe_results("send", summary.results)
+        summary.log()
+        log_message(f"🎉 Done. SMS messages sent: {summary.sent}")
 
-    log_message(f"🎉 Done. SMS messages sent: {sent_count}")
+    log_outbox(outbox, OUTBOX_JOB)
+    return summary
 
 # ---------------- MAIN -----------------
 if __name__ == "__main__":
-    process_reminders()
+    if is_prepare_mode(sys.argv):
+        prepare_reminders(parse_prepare_args(sys.argv).days)
+        write_run_metrics(f"{OUTBOX_JOB}_prepare")
+    else:
+        process_reminders(*run_mode(sys.argv))
+        write_run_metrics(OUTBOX_JOB)
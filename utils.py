@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+
+# ---------------- LOG FUNCTION -----------------
+def log_message(message: str):
+    ts = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    print(f"[{ts}] {message}")
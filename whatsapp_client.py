@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Async WhatsApp Cloud API client.
+
+A single aiohttp session keeps pooled keep-alive connections to the Graph API.
+Template sends go out concurrently, up to `max_concurrency` at a time
+(CHANNEL_LIMITS["whatsapp"], i.e. DISPATCH_MAX_WHATSAPP, by default). The
+client slows down when the usage headers returned by Graph say we are close
+to the limit, and retries throttled sends after the advised wait. Requests
+have connect / read timeouts. Only throttled replies and failures to
+connect are retried; a read timeout or dropped connection may come after
+Graph accepted the message, so it is reported as uncertain, not resent.
+Retries spend the "whatsapp" retry budget, and sends stop at the run
+deadline (see resilience.py).
+
+WHATSAPP_API_BASE can point the client at a local HTTP stand-in for testing.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+
+from dispatch import CHANNEL_LIMITS, DispatchResult, DispatchSummary, deadline_skipped
+from resilience import deadline, retry_budget, timeouts
+from utils import log_message
+
+# ---------------- GRAPH API CONFIG -----------------
+WHATSAPP_API_BASE = os.getenv("WHATSAPP_API_BASE", "https://graph.facebook.com")
+GRAPH_API_VERSION = "v19.0"
+
+# Usage percentage (from X-App-Usage / X-Business-Use-Case-Usage) at which we start pacing
+USAGE_SLOWDOWN_PCT = 90
+MAX_ATTEMPTS = 4
+
+# Graph error codes that mean "throttled, try again later"
+THROTTLE_ERROR_CODES = {4, 17, 32, 613, 80007, 130429, 131056}
+
+
+# ---------------- PAYLOAD -----------------
+def build_template_payload(to_phone, template_name, parameters, language="en_US") -> dict:
+    return {
+        "messaging_product": "whatsapp",
+        "to": to_phone,
+        "type": "template",
+        "template": {
+            "name": template_name,
+            "language": {"code": language},
+            "components": [
+                {
+                    "type": "body",
+                    "parameters": [
+                        {"type": "text", "text": str(p)} for p in parameters
+                    ]
+                }
+            ]
+        }
+    }
+
+
+# ---------------- RATE-LIMIT HEADERS -----------------
+def usage_backoff(headers) -> float:
+    """
+    Seconds to pause before the next send, derived from Graph usage headers.
+
+    X-Business-Use-Case-Usage carries `estimated_time_to_regain_access` in
+    minutes once a limit is hit. X-App-Usage / X-Business-Use-Case-Usage
+    report call_count / total_time / total_cputime as percentages of the limit.
+    """
+    wait = 0.0
+    peak = 0
+
+    app_usage = headers.get("X-App-Usage")
+    if app_usage:
+        try:
+            peak = max([peak] + [int(v) for v in json.loads(app_usage).values()])
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+    buc_usage = headers.get("X-Business-Use-Case-Usage")
+    if buc_usage:
+        try:
+            for entries in json.loads(buc_usage).values():
+                for entry in entries:
+                    regain = int(entry.get("estimated_time_to_regain_access") or 0)
+                    wait = max(wait, regain * 60.0)
+                    peak = max(peak, *(int(entry.get(k) or 0)
+                                       for k in ("call_count", "total_time", "total_cputime")))
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+    if peak >= USAGE_SLOWDOWN_PCT:
+        # Ease off proportionally as we approach 100%
+        wait = max(wait, (peak - USAGE_SLOWDOWN_PCT + 1) * 0.5)
+    return wait
+
+
+# ---------------- CLIENT -----------------
+class WhatsAppClient:
+    def __init__(self, token, phone_number_id, base_url=WHATSAPP_API_BASE,
+                 max_concurrency=CHANNEL_LIMITS["whatsapp"], timeout=None):
+        self.url = f"{base_url.rstrip('/')}/{GRAPH_API_VERSION}/{phone_number_id}/messages"
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._session = None
+        self._sem = None
+        self._resume_at = 0.0
+
+    async def __aenter__(self):
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency,
+            keepalive_timeout=60,
+        )
+        connect_timeout, read_timeout = timeouts("whatsapp")
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=self.timeout,
+                sock_connect=connect_timeout,
+                sock_read=read_timeout,
+            ),
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/json",
+            },
+        )
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    def _pause(self, seconds):
+        if seconds > 0:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def _wait_for_capacity(self):
+        delay = min(self._resume_at - time.monotonic(), deadline.remaining())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, payload) -> DispatchResult:
+        import aiohttp
+
+        to_phone = payload.get("to", "")
+        error = ""
+
+        async with self._sem:
+            # Timed from here, as in dispatch._run_one: waiting for a slot is not send time
+            started = time.perf_counter()
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                if attempt > 1 and not retry_budget("whatsapp").spend():
+                    break
+                await self._wait_for_capacity()
+                if deadline.expired():
+                    return deadline_skipped(to_phone)
+                try:
+                    async with self._session.post(self.url, json=payload) as response:
+                        self._pause(usage_backoff(response.headers))
+                        if response.status == 200:
+                            return DispatchResult(to_phone, True, elapsed=time.perf_counter() - started)
+
+                        body = await response.text()
+                        error = f"HTTP {response.status}: {body}"
+                        if not _is_throttled(response.status, body):
+                            break
+
+                        retry_after = response.headers.get("Retry-After")
+                        wait = float(retry_after) if retry_after else 2 ** attempt
+                        self._pause(wait + random.uniform(0, 0.5))
+                except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                    # Nothing reached Graph, so a retry cannot send the message twice
+                    error = f"{type(e).__name__}: {e}"
+                    self._pause(2 ** attempt * 0.25)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # The message may already have been accepted; resending could deliver it twice
+                    return DispatchResult(to_phone, False, error=f"{type(e).__name__}: {e}",
+                                          elapsed=time.perf_counter() - started, uncertain=True)
+
+        return DispatchResult(to_phone, False, error=error, elapsed=time.perf_counter() - started)
+
+    async def send_many(self, payloads) -> DispatchSummary:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self.send(p) for p in payloads))
+        return DispatchSummary(
+            channel="whatsapp",
+            results=list(results),
+            elapsed=time.perf_counter() - started,
+        )
+
+
+def _is_throttled(status, body) -> bool:
+    if status == 429:
+        return True
+    try:
+        code = json.loads(body).get("error", {}).get("code")
+    except (ValueError, AttributeError):
+        return False
+    return code in THROTTLE_ERROR_CODES
+
+
+# ---------------- SYNC ENTRY POINT -----------------
+def send_templates(token, phone_number_id, payloads, **client_kwargs) -> DispatchSummary:
+    """Send all payloads concurrently; results keep the payload order."""
+
+    async def _run():
+        async with WhatsAppClient(token, phone_number_id, **client_kwargs) as client:
+            return await client.send_many(payloads)
+
+    summary = asyncio.run(_run())
+    for result in summary.results:
+        if result.ok:
+            log_message(f"✅ WhatsApp TEMPLATE sent to {result.recipient}")
+        else:
+            log_message(f"❌ Failed to send to {result.recipient}: {result.error}")
+    return summary
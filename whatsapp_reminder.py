@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import os
-import json
-import base64
-import requests
-import pandas as pd
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
+import sys
 from datetime import datetime
+import whatsapp_client
+from whatsapp_client import build_template_payload, send_templates
+from sheets import read_values, read_rows_for_dates
+from schema import TIME_TABLE_2
+from records import Reminder, read_records
+from outbox import Outbox, message_key, log_outbox, run_mode
+from metrics import stage_timer, write_run_metrics
+from lookahead import is_prepare_mode, parse_prepare_args, lookahead_dates, source_digest, prepare_rows, PreparedMessages
 
 # ---------------- GOOGLE SHEET CONFIG -----------------
 SPREADSHEET_ID = "1-gAUMbVOio3mTzfDstqjpnQdibP2oYjuF-vhX5UovCw"
@@ -16,17 +19,12 @@ RANGE_NAME = "Time_Table_2"
 WHATSAPP_TOKEN = os.environ.get("WHATSAPP_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
 
-WHATSAPP_API_URL = (
-    f"https://graph.facebook.com/v19.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-)
+# ---------------- OUTBOX -----------------
+OUTBOX_JOB = "whatsapp_reminders"
+timer = stage_timer(OUTBOX_JOB)
 
-# ---------------- SERVICE ACCOUNT -----------------
-if "SERVICE_ACCOUNT_JSON" not in os.environ:
-    raise ValueError("SERVICE_ACCOUNT_JSON is missing")
-
-SERVICE_ACCOUNT_INFO = json.loads(
-    base64.b64decode(os.environ["SERVICE_ACCOUNT_JSON"]).decode("utf-8")
-)
+# Prepared payloads from an older version of this script, the client or the shared rendering modules are rebuilt
+PREPARE_VERSION = source_digest(__file__, whatsapp_client.__file__)
 
 # ---------------- LOG FUNCTION -----------------
 def log_message(message):
@@ -34,31 +32,31 @@ def log_message(message):
     print(f"[{timestamp}] {message}")
 
 # ---------------- READ GOOGLE SHEET -----------------
-def read_google_sheet():
+def read_google_sheet(dates=None):
     log_message("📌 read_google_sheet() called")
 
-    creds = Credentials.from_service_account_info(
-        SERVICE_ACCOUNT_INFO,
-        scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    )
-
-    service = build("sheets", "v4", credentials=creds)
-    result = service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=RANGE_NAME
-    ).execute()
+    with timer.span("fetch"):
+        if dates:
+            values = read_rows_for_dates(SPREADSHEET_ID, RANGE_NAME, "Reminder_Date", dates)
+        else:
+            values = read_values(SPREADSHEET_ID, RANGE_NAME)
 
-    values = result.get("values", [])
     if not values:
         log_message("❌ No data found in Google Sheet.")
         return None
+    if len(values) < 2:
+        log_message("ℹ️ No matching rows in Google Sheet.")
+        return None
 
-    df = pd.DataFrame(values[1:], columns=values[0])
-    log_message(f"✅ Sheet loaded. Rows: {len(df)}")
-    return df
+    with timer.span("parse"):
+        rows = list(read_records(values, TIME_TABLE_2, Reminder, date_column="Reminder_Date", dates=dates))
+    log_message(f"✅ Sheet loaded. Rows: {len(rows)}")
+    return rows
 
-# ---------------- SEND WHATSAPP TEMPLATE -----------------
-def send_whatsapp_template(
+# ---------------- BUILD WHATSAPP TEMPLATE -----------------
+WHATSAPP_TEMPLATE_NAME = "class_reminder_3"
+
+def build_whatsapp_template(
     to_phone,
     customer,
     course,
@@ -66,62 +64,25 @@ def send_whatsapp_template(
     class_time,
     zoom_link
 ):
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
-
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to_phone,
-        "type": "template",
-        "template": {
-            "name": "class_reminder_3",
-            "language": {"code": "en_US"},
-            "components": [
-                {
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": customer},
-                        {"type": "text", "text": course},
-                        {"type": "text", "text": class_date},
-                        {"type": "text", "text": class_time},
-                        {"type": "text", "text": zoom_link}
-                    ]
-                }
-            ]
-        }
-    }
-
-    response = requests.post(
-        WHATSAPP_API_URL,
-        headers=headers,
-        json=payload
+    return build_template_payload(
+        to_phone,
+        WHATSAPP_TEMPLATE_NAME,
+        [customer, course, class_date, class_time, zoom_link]
     )
 
-    if response.status_code == 200:
-        log_message(f"✅ WhatsApp TEMPLATE sent to {to_phone}")
-    else:
-        log_message(
-            f"❌ Failed to send to {to_phone}: {response.text}"
-        )
-
-# ---------------- PROCESS REMINDERS -----------------
-def process_reminders():
-    df = read_google_sheet()
-    if df is None:
-        return
-
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    log_message(f"Processing reminders for {today_str}")
-
-    sent_count = 0
-
-    for _, row in df.iterrows():
-        if row["Reminder_Date"] != today_str:
-            continue
+# ---------------- COMPOSE REMINDERS -----------------
+def reminder_key(row, date_str):
+    return message_key(
+        f"{SPREADSHEET_ID}/{RANGE_NAME}",
+        (row["Phone"], row["Customer"], row["Course"], row["Session"]),
+        "whatsapp",
+        date_str
+    )
 
-        send_whatsapp_template(
+def build_reminder(row):
+    """row -> (recipient, outbox payload)"""
+    with timer.span("render"):
+        payload = build_whatsapp_template(
             to_phone=row["Phone"],
             customer=row["Customer"],
             course=row["Course"],
@@ -129,11 +90,78 @@ def process_reminders():
             class_time=row["Session"],
             zoom_link=row["Zoom_link"]
         )
+    return row["Phone"], payload
 
-        sent_count += 1
+def compose_reminders(outbox, today_str):
+    rows = read_google_sheet(dates=[today_str])
+    if rows is None:
+        return None
+
+    # Built the evening before by `whatsapp_reminder.py prepare`, if it ran
+    prepared = PreparedMessages(outbox, OUTBOX_JOB, today_str, PREPARE_VERSION)
+
+    queued = 0
+    for row in rows:
+        key = reminder_key(row, today_str)
+        if outbox.has(key):
+            continue
 
-    log_message(f"🎉 Done. WhatsApp messages sent: {sent_count}")
+        if prepared.take(key, row):
+            queued += 1
+            continue
+
+        recipient, payload = build_reminder(row)
+        queued += outbox.enqueue(key, OUTBOX_JOB, "whatsapp", recipient, payload, send_date=today_str)
+
+    prepared.log()
+    log_message(f"📝 WhatsApp reminders queued: {queued}")
+    return queued
+
+# ---------------- PREPARE AHEAD -----------------
+def prepare_reminders(days, today_str=None):
+    """Build the next `days` days of reminders into the outbox's prepared table; nothing is queued."""
+    today_str = today_str or datetime.now().strftime("%Y-%m-%d")
+    dates = lookahead_dates(today_str, days)
+    log_message(f"🗓️ Preparing WhatsApp reminders for {', '.join(dates)}")
+
+    rows = read_google_sheet(dates=dates)
+    if rows is None:
+        return 0
+    with timer.span("prepare"):
+        return prepare_rows(Outbox(), OUTBOX_JOB, "whatsapp", rows, "Reminder_Date", PREPARE_VERSION, reminder_key, build_reminder)
+
+# ---------------- SEND OUTBOX -----------------
+def send_whatsapp_batch(entries):
+    return send_templates(
+        WHATSAPP_TOKEN,
+        WHATSAPP_PHONE_NUMBER_ID,
+        [e.payload for e in entries]
+    )
+
+# ---------------- PROCESS REMINDERS -----------------
+def process_reminders(compose=True, send=True):
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    log_message(f"Processing reminders for {today_str}")
+
+    outbox = Outbox()
+    summary = None
+    if compose:
+        compose_reminders(outbox, today_str)
+
+    if send:
+        summary = outbox.drain(OUTBOX_JOB, send_whatsapp_batch, send_date=today_str)
+        timer.observe_results("send", summary.results)
+        summary.log()
+        log_message(f"🎉 Done. WhatsApp messages sent: {summary.sent}")
+
+    log_outbox(outbox, OUTBOX_JOB)
+    return summary
 
 # ---------------- MAIN -----------------
 if __name__ == "__main__":
-    process_reminders()
+    if is_prepare_mode(sys.argv):
+        prepare_reminders(parse_prepare_args(sys.argv).days)
+        write_run_metrics(f"{OUTBOX_JOB}_prepare")
+    else:
+        process_reminders(*run_mode(sys.argv))
+        write_run_metrics(OUTBOX_JOB)